@@ -219,6 +219,10 @@ export function AnalysisHeader({
                       label: "Minimum Signal Threshold",
                       value: config.minSignalThreshold,
                     },
+                    {
+                      label: "Approximate MS2 Similarity",
+                      value: config.approximateSimilarity ? "Allowed" : "Off",
+                    },
                   ].map((item, i) => (
                     <div
                       key={i}
@@ -20,6 +20,7 @@ export interface AnalysisConfig {
   rtTimeWindow: number;
   signalEnrichmentFactor: number;
   minSignalThreshold: number;
+  approximateSimilarity?: boolean;
 }
 
 // Add this type for API response
@@ -17,6 +17,7 @@ import {
 } from "../ui/card";
 import { FormControl, FormField, FormItem } from "../ui/form";
 import { Input } from "../ui/input";
+import { Switch } from "../ui/switch";
 
 export function AdvancedSetting() {
   const t = useTranslations("New");
@@ -185,6 +186,23 @@ export function AdvancedSetting() {
                 </FormItem>
               )}
             />
+            <FormField
+              control={control}
+              name="config.approximateSimilarity"
+              render={({ field: { onChange, value } }) => (
+                <FormItem>
+                  <FormLabelWithTooltip
+                    tooltip="Allow a faster, approximate MS2 similarity for very large datasets.
+                          Scores and therefore edges may differ slightly from the exact similarity."
+                  >
+                    {t("approximate-similarity")}
+                  </FormLabelWithTooltip>
+                  <FormControl>
+                    <Switch checked={value} onCheckedChange={onChange} />
+                  </FormControl>
+                </FormItem>
+              )}
+            />
           </CardContent>
         </Card>
       </AccordionContent>
@@ -64,6 +64,8 @@ export default function AnalysisCreation({
         rtTimeWindow: defaultAnalysis?.config.rtTimeWindow || 0.02,
         correlationThreshold:
           defaultAnalysis?.config.correlationThreshold || 0.95,
+        approximateSimilarity:
+          defaultAnalysis?.config.approximateSimilarity || false,
       },
     },
   });
@@ -41,6 +41,44 @@ export const triggerAnalysis = zAction({
   }),
 });
 
+// Analyses of the same raw file started together share their loading and similarity work
+export const triggerAnalyses = zAction({
+  args: {
+    analyses: z.array(AnalysisCreationInputSchema),
+    token: z.string(),
+  },
+  handler: async ({ runMutation }, { analyses, token }) => {
+    const ids: string[] = await Promise.all(
+      analyses.map(async ({ config, reactionDb, rawFile }) => {
+        const res: any = await runMutation(internal.analyses.create, {
+          config,
+          reactionDb,
+          rawFile,
+        });
+        return res.id;
+      })
+    );
+
+    const response = await fetch(
+      `${process.env.ANALYSIS_API_URL}/analysis/startBatch`,
+      {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          Authorization: `Bearer ${token}`,
+        },
+        body: JSON.stringify({ ids }),
+      }
+    );
+
+    return { ids, status: response.ok ? "success" : "error" };
+  },
+  output: z.object({
+    ids: z.array(zid("analyses")),
+    status: z.enum(["success", "error"]),
+  }),
+});
+
 export const retryAnalysis = zAction({
   args: { id: zid("analyses"), token: z.string() },
   handler: async ({ runMutation }, { id, token }) => {
@@ -59,7 +97,8 @@ export const retryAnalysis = zAction({
           "Content-Type": "application/json",
           Authorization: `Bearer ${token}`,
         },
-        body: JSON.stringify({ id }),
+        // a retry replaces the run in progress rather than joining it
+        body: JSON.stringify({ id, restart: true }),
       }
     );
 
@@ -196,7 +235,9 @@ export const removeAnalysis = zAction({
   args: { id: zid("analyses") },
   handler: async ({ runAction, runMutation, runQuery }, { id }) => {
     const analysis = await runQuery(api.analyses.get, { id });
-    if (analysis.result) {
+    // results linked from the result cache are only removed with their last analysis
+    const shared = await runQuery(api.analyses.isResultShared, { id });
+    if (analysis.result && !shared) {
       await Promise.all([
         runAction(api.actions.removeFile, {
           storageId: analysis.result.edges,
@@ -52,6 +52,23 @@ export const get = zQuery({
   },
 });
 
+// Status and step progress only, what the progress stream polls
+export const getProgress = zQuery({
+  args: { id: zid("analyses") },
+  handler: async ({ db, user }, { id }) => {
+    const analysis = await db.get(id);
+    if (!analysis) {
+      throw new Error("Analysis not found");
+    }
+
+    if (analysis.user !== user) {
+      throw new Error("Unauthorized");
+    }
+
+    return { status: analysis.status, progress: analysis.progress };
+  },
+});
+
 export const update = zMutation({
   args: {
     id: zid("analyses"),
@@ -59,17 +76,94 @@ export const update = zMutation({
     result: z.optional(AnalysisResultSchema),
     progress: z.optional(Progress),
     log: z.optional(z.string()),
+    resultKey: z.optional(z.string()),
+    peakRssBytes: z.optional(z.number()),
   },
-  handler: async ({ db }, { id, status, log, progress, result }) => {
+  handler: async (
+    { db },
+    { id, status, log, progress, result, resultKey, peakRssBytes }
+  ) => {
     db.patch(id, {
       ...(status && { status }),
       ...(log && { log }),
       ...(progress && { progress }),
       ...(result && { result }),
+      ...(resultKey && { resultKey }),
+      ...(peakRssBytes !== undefined && { peakRssBytes }),
     });
   },
 });
 
+// Result of a completed analysis of the user with the same result key, if any
+export const findResult = zQuery({
+  args: { resultKey: z.string() },
+  handler: async ({ db, user }, { resultKey }) => {
+    const analysis = await db
+      .query("analyses")
+      .withIndex("resultKey", (q) => q.eq("resultKey", resultKey))
+      .filter((q) =>
+        q.and(
+          q.eq(q.field("user"), user),
+          q.eq(q.field("status"), "complete")
+        )
+      )
+      .first();
+
+    return analysis?.result ?? null;
+  },
+});
+
+// Whether another analysis links to the same result files
+export const isResultShared = zQuery({
+  args: { id: zid("analyses") },
+  handler: async ({ db }, { id }) => {
+    const analysis = await db.get(id);
+    if (!analysis?.result || !analysis.resultKey) {
+      return false;
+    }
+    const { result, resultKey } = analysis;
+
+    const others = await db
+      .query("analyses")
+      .withIndex("resultKey", (q) => q.eq("resultKey", resultKey))
+      .filter((q) => q.neq(q.field("_id"), id))
+      .collect();
+
+    return others.some(
+      (other) =>
+        other.result?.nodes === result.nodes &&
+        other.result?.edges === result.edges
+    );
+  },
+});
+
+type StepUpdate = z.infer<typeof Progress>[number];
+
+const applyStepStatus = (
+  progress: StepUpdate[],
+  { step, status, metrics, counters }: StepUpdate
+): StepUpdate[] =>
+  !progress.find((p) => p.step === step)
+    ? [
+        ...progress,
+        {
+          step,
+          status,
+          ...(metrics && { metrics }),
+          ...(counters && { counters }),
+        },
+      ]
+    : progress.map((p) =>
+        p.step === step
+          ? {
+              ...p,
+              status,
+              ...(metrics && { metrics }),
+              ...(counters && { counters }),
+            }
+          : p
+      );
+
 export const updateStepStatus = zMutation({
   args: {
     id: zid("analyses"),
@@ -82,9 +176,7 @@ export const updateStepStatus = zMutation({
       throw new Error("Analysis not found");
     }
 
-    const progress = !analysis.progress.find((p) => p.step === step)
-      ? [...analysis.progress, { step, status }]
-      : analysis.progress.map((p) => (p.step === step ? { ...p, status } : p));
+    const progress = applyStepStatus(analysis.progress, { step, status });
 
     await db.patch(id, { progress });
 
@@ -94,6 +186,28 @@ export const updateStepStatus = zMutation({
   },
 });
 
+// Applies several step updates in order within a single transaction
+export const updateStepStatuses = zMutation({
+  args: {
+    id: zid("analyses"),
+    updates: Progress,
+  },
+  handler: async ({ db }, { id, updates }) => {
+    const analysis = await db.get(id);
+    if (!analysis) {
+      throw new Error("Analysis not found");
+    }
+
+    const progress = updates.reduce(applyStepStatus, analysis.progress);
+
+    await db.patch(id, { progress });
+
+    if (updates.some(({ status }) => status === "failed")) {
+      await db.patch(id, { status: "failed" });
+    }
+  },
+});
+
 export const AnalysisOutputSchema = z.object({
   id: zid("analyses"),
   user: z.string(),
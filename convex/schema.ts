@@ -40,6 +40,7 @@ export const AnalysisConfigSchema = z.object({
   mzErrorThreshold: z.number().default(0.01),
   rtTimeWindow: z.number().default(0.02),
   correlationThreshold: z.number().default(0.95),
+  approximateSimilarity: z.boolean().default(false),
   bioSamples: z.array(BioSampleSchema),
   drugSample: z.optional(DrugSampleSchema),
 });
@@ -69,10 +70,23 @@ export const AnalysisStep = z.enum([
   "upload_result",
 ]);
 
+// Resource usage of a step as measured by the worker
+export const StepMetrics = z.object({
+  wallSeconds: z.number(),
+  cpuSeconds: z.number(),
+  peakRssDeltaBytes: z.number(),
+});
+
+// Work done so far inside a running step, e.g. pairsScored of pairsTotal,
+// sent by the worker at most once a second
+export const StepCounters = z.record(z.string(), z.number());
+
 export const Progress = z.array(
   z.object({
     step: AnalysisStep,
     status: AnalysisStatus,
+    metrics: z.optional(StepMetrics),
+    counters: z.optional(StepCounters),
   })
 );
 
@@ -115,6 +129,10 @@ export const AnalysisSchema = z.object({
   progress: Progress,
   log: z.optional(z.string()),
   result: z.optional(AnalysisResultSchema),
+  // Hash of everything the result depends on, analyses with equal keys share results
+  resultKey: z.optional(z.string()),
+  // Peak resident memory of the worker process that ran the analysis
+  peakRssBytes: z.optional(z.number()),
 });
 
 export const MSTool = z.enum(["MZmine3", "MSDial", "MDial"]);
@@ -142,9 +160,9 @@ export const RawFileSchema = z.object({
 });
 
 export default defineSchema({
-  analyses: defineTable(zodToConvexFields(AnalysisSchema.shape)).index("user", [
-    "user",
-  ]),
+  analyses: defineTable(zodToConvexFields(AnalysisSchema.shape))
+    .index("user", ["user"])
+    .index("resultKey", ["resultKey"]),
   reactionDatabases: defineTable(
     zodToConvexFields(ReactionDatabaseSchema.shape)
   ).index("user", ["user"]),
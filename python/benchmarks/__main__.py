@@ -0,0 +1,220 @@
+"""
+Benchmarks of the pipeline steps on synthetic data.
+
+    python -m benchmarks run --scales 250 1000 4000 --output report.json
+    python -m benchmarks compare before.json after.json
+    python -m benchmarks mass --requests 50 --formulas 500
+    python -m benchmarks coldstart --repeat 3
+"""
+
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+
+from benchmarks.coldstart import run_coldstart_benchmark
+from benchmarks.harness import BenchmarkConfig, run_benchmarks
+from benchmarks.mass import run_mass_benchmark
+
+
+def _key(result: dict) -> tuple[str, str, int]:
+    return result["step"], result["variant"], result["ions"]
+
+
+def _format_bytes(value: int | None) -> str:
+    if value is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024 or unit == "GB":
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
+
+
+def print_report(report: dict) -> None:
+    """Scaling curves (wall time and peak memory per scale) of every step."""
+    scales = report["config"]["scales"]
+    results = {_key(r): r for r in report["results"]}
+    exponents = {(s["step"], s["variant"]): s["exponent"] for s in report["scaling"]}
+    rows = list(dict.fromkeys((r["step"], r["variant"]) for r in report["results"]))
+
+    header = f"{'step':<55}" + "".join(f"{n:>18}" for n in scales) + f"{'~n^k':>8}"
+    print(header)
+    print("-" * len(header))
+    for step, variant in rows:
+        cells = []
+        for ions in scales:
+            result = results.get((step, variant, ions))
+            if result is None or result["skipped"]:
+                cells.append(f"{'skipped':>18}")
+            else:
+                peak = _format_bytes(result["peakBytes"])
+                cells.append(f"{result['wallSeconds']:>8.3f}s {peak:>8}")
+        exponent = exponents.get((step, variant))
+        print(
+            f"{step + ' [' + variant + ']':<55}"
+            + "".join(cells)
+            + (f"{exponent:>8.2f}" if exponent is not None else f"{'':>8}")
+        )
+
+
+def compare(before: dict, after: dict, tolerance: float) -> bool:
+    """
+    Print the wall time and peak memory ratios of the steps both reports measured.
+
+    Returns:
+        Whether no step got slower or bigger than `tolerance` times before
+    """
+    old = {_key(r): r for r in before["results"] if not r["skipped"]}
+    new = {_key(r): r for r in after["results"] if not r["skipped"]}
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    print(f"{'step':<55}{'ions':>8}{'time':>10}{'memory':>10}")
+
+    ok = True
+    for key in [k for k in new if k in old]:
+        step, variant, ions = key
+        ratios = []
+        for field in ("wallSeconds", "peakBytes"):
+            if old[key][field] and new[key][field] is not None:
+                ratios.append(new[key][field] / old[key][field])
+            else:
+                ratios.append(None)
+        regressed = any(r is not None and r > tolerance for r in ratios)
+        ok = ok and not regressed
+        print(
+            f"{step + ' [' + variant + ']':<55}{ions:>8}"
+            + "".join(f"{r:>9.2f}x" if r is not None else f"{'-':>10}" for r in ratios)
+            + ("  <- regression" if regressed else "")
+        )
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Benchmark the pipeline steps"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Measure every step at several scales")
+    run.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[250, 1000, 4000],
+        help="Numbers of ions to measure at",
+    )
+    run.add_argument(
+        "--peaks", type=int, default=20, help="Fragment peaks per spectrum"
+    )
+    run.add_argument(
+        "--edge-density",
+        type=float,
+        default=0.3,
+        help="Share of ions derived from another ion by a reaction",
+    )
+    run.add_argument(
+        "--reactions",
+        type=int,
+        default=None,
+        help="Size of a random reaction database, the default one when omitted",
+    )
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Timed runs per step, the best is reported",
+    )
+    run.add_argument(
+        "--max-seconds",
+        type=float,
+        default=120.0,
+        help="Skip variants predicted to take longer",
+    )
+    run.add_argument(
+        "--no-memory", action="store_true", help="Skip the peak memory runs"
+    )
+    run.add_argument("--output", type=Path, help="Where to write the JSON report")
+
+    diff = commands.add_parser("compare", help="Compare two JSON reports")
+    diff.add_argument("before", type=Path)
+    diff.add_argument("after", type=Path)
+    diff.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.2,
+        help="Ratio above which a step counts as a regression",
+    )
+
+    mass = commands.add_parser("mass", help="Measure /analysis/mass requests")
+    mass.add_argument("--requests", type=int, default=50)
+    mass.add_argument(
+        "--formulas", type=int, default=500, help="Formula changes per request"
+    )
+    mass.add_argument("--seed", type=int, default=0)
+
+    coldstart = commands.add_parser(
+        "coldstart", help="Measure import to first result of fresh interpreters"
+    )
+    coldstart.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Interpreters per case, the median is reported",
+    )
+    coldstart.add_argument(
+        "--ions", type=int, default=500, help="Ions of the first result"
+    )
+
+    args = parser.parse_args()
+    if args.command == "coldstart":
+        print(
+            f"{'target':<10}{'start':<8}{'import':>10}{'first result':>14}{'total':>10}"
+        )
+        for result in run_coldstart_benchmark(args.repeat, args.ions):
+            print(
+                f"{result['target']:<10}{result['start']:<8}"
+                f"{result['import_seconds']:>9.2f}s"
+                f"{result['first_result_seconds']:>13.2f}s"
+                f"{result['total_seconds']:>9.2f}s"
+            )
+        return
+    if args.command == "mass":
+        print(f"{'engine':<12}{'cache':<8}{'median':>10}{'p95':>10}{'formulas/s':>14}")
+        for result in run_mass_benchmark(args.requests, args.formulas, args.seed):
+            print(
+                f"{result['engine']:<12}{result['cache']:<8}"
+                f"{result['median_ms']:>8.2f}ms{result['p95_ms']:>8.2f}ms"
+                f"{result['formulas_per_second']:>14.0f}"
+            )
+        return
+    if args.command == "compare":
+        ok = compare(
+            json.loads(args.before.read_text()),
+            json.loads(args.after.read_text()),
+            args.tolerance,
+        )
+        sys.exit(0 if ok else 1)
+
+    # the steps log their metrics, which would drown the tables
+    logging.disable(logging.INFO)
+    report = run_benchmarks(
+        BenchmarkConfig(
+            scales=sorted(args.scales),
+            peaks=args.peaks,
+            edge_density=args.edge_density,
+            reactions=args.reactions,
+            seed=args.seed,
+            repeat=args.repeat,
+            max_seconds=args.max_seconds,
+            memory=not args.no_memory,
+        ),
+        progress=lambda message: print(message, file=sys.stderr),
+    ).to_json()
+    print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from core.utils.assets import compile_asset_tables
+
+PYTHON_DIR = Path(__file__).resolve().parent.parent
+
+# what a fresh worker does before its first result, in a new interpreter: the
+# modules of the pipeline, then an interaction matrix and the recursive
+# analysis data. Timed in the child, interpreter startup excluded.
+_WORKER = """
+import asyncio, json, time
+start = time.perf_counter()
+import core.steps, core.recursive.run
+imported = time.perf_counter()
+import numpy as np, pandas as pd
+from core.steps import create_ion_interaction_matrix
+from core.utils.constants import TargetIonsColumn, default_reactions
+from core.recursive.run import _find_reaction_neighbors_fast, load_reactions_data
+mz = np.random.default_rng(0).uniform(100, 1000, {ions})
+ions = pd.DataFrame({{TargetIonsColumn.MZ: mz}})
+asyncio.run(create_ion_interaction_matrix(ions, default_reactions("pos")))
+reactions = load_reactions_data()
+diffs = np.array([r.mzdiff for r in reactions], dtype=np.float32)
+_find_reaction_neighbors_fast(mz[0], np.sort(mz), diffs, 0.01)
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start, "firstResult": done - imported}}))
+"""
+
+# modules of the API, which never loads spectra
+_API = """
+import json, time
+start = time.perf_counter()
+import core.graph, core.mass, core.preprocess, core.utils.convex
+print(json.dumps({"import": time.perf_counter() - start, "firstResult": 0.0}))
+"""
+
+
+def _run_child(code: str, env: dict[str, str]) -> dict[str, float]:
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=PYTHON_DIR,
+        env={**os.environ, **env, "PYTHONPATH": str(PYTHON_DIR)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run_coldstart_benchmark(repeat: int = 3, ions: int = 500) -> list[dict]:
+    """
+    Import-to-first-result seconds of fresh interpreters, median of `repeat`.
+
+    "cold" containers parse the reaction CSVs and compile the numba kernels,
+    "warm" ones start from the compiled tables and numba cache that
+    `python -m core.warmup --compile-assets` bakes into the image.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tables, numba_cache = Path(tmp_dir) / "tables", Path(tmp_dir) / "numba"
+        compile_asset_tables(tables)
+        warm = {"ASSET_CACHE_DIR": str(tables), "NUMBA_CACHE_DIR": str(numba_cache)}
+        # fills the numba cache, as the image build does
+        _run_child(_WORKER.format(ions=ions), warm)
+
+        cases = [
+            ("worker", "cold", _WORKER.format(ions=ions), None),
+            ("worker", "warm", _WORKER.format(ions=ions), warm),
+            # the API compiles nothing, only its imports matter
+            ("api", "warm", _API, warm),
+        ]
+        for target, start, code, env in cases:
+            runs = []
+            for i in range(repeat):
+                # a cold start gets empty caches every run, nothing is reused
+                empty = str(Path(tmp_dir) / f"empty-{i}")
+                cold = {"ASSET_CACHE_DIR": empty, "NUMBA_CACHE_DIR": empty}
+                runs.append(_run_child(code, env or cold))
+            imports = statistics.median(r["import"] for r in runs)
+            first = statistics.median(r["firstResult"] for r in runs)
+            results.append(
+                {
+                    "target": target,
+                    "start": start,
+                    "import_seconds": imports,
+                    "first_result_seconds": first,
+                    "total_seconds": imports + first,
+                }
+            )
+    return results
@@ -0,0 +1,346 @@
+import asyncio
+import inspect
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+import numpy as np
+from core.distributed import LocalMapExecutor
+from core.planner import (
+    DataProfile,
+    InteractionEngine,
+    SimilarityEngine,
+    similarity_seconds,
+)
+from core.recursive.run import RecursiveAnalysisConfig, RecursiveAnalyzer
+from core.steps import (
+    calculate_edge_metrics,
+    combine_matrices_and_extract_edges,
+    create_ion_interaction_matrix,
+    create_similarity_matrix,
+    edge_value_matching,
+    filter_edges,
+    plan_execution,
+    postprocessing,
+)
+from core.steps.load_data import _filter_metabolites
+from core.utils.constants import MIN_MS2_SIMILARITY_THRESHOLD, TargetIonsColumn
+
+from benchmarks.synthetic import SyntheticDataset, generate
+
+REPORT_VERSION = 1
+# parameters of the analysis every scale is run with
+MIN_SIGNAL_THRESHOLD = 1e5
+SIGNAL_ENRICHMENT_FACTOR = 3.0
+MZ_ERROR_THRESHOLD = 0.01
+MS2_SIMILARITY_THRESHOLD = 0.7
+# seeds of the recursive exploration
+RECURSIVE_SEEDS = 5
+# tiny dataset run before measuring, so that JIT compilation is not timed
+WARMUP_IONS = 50
+
+
+@dataclass
+class BenchmarkConfig:
+    scales: list[int]
+    peaks: int = 20
+    edge_density: float = 0.3
+    reactions: int | None = None
+    seed: int = 0
+    repeat: int = 3
+    # variants predicted by the cost model to take longer than this are skipped
+    max_seconds: float = 120.0
+    memory: bool = True
+
+
+@dataclass
+class Measurement:
+    step: str
+    variant: str
+    ions: int
+    # best of the repeats
+    wall_seconds: float | None = None
+    cpu_seconds: float | None = None
+    # peak of the Python heap (numpy included) while the step ran, worker
+    # processes are not covered
+    peak_bytes: int | None = None
+    skipped: str | None = None
+
+
+@dataclass
+class Report:
+    config: BenchmarkConfig
+    results: list[Measurement] = field(default_factory=list)
+    environment: dict[str, Any] = field(default_factory=dict)
+
+    def scaling(self) -> list[dict[str, Any]]:
+        """Exponent k of wall time ~ ions^k, fitted over the measured scales."""
+        curves: dict[tuple[str, str], list[Measurement]] = {}
+        for m in self.results:
+            if m.wall_seconds:
+                curves.setdefault((m.step, m.variant), []).append(m)
+        scaling = []
+        for (step, variant), points in curves.items():
+            if len(points) < 2:
+                continue
+            exponent = np.polyfit(
+                np.log([p.ions for p in points]),
+                np.log([p.wall_seconds for p in points]),
+                1,
+            )[0]
+            scaling.append(
+                {
+                    "step": step,
+                    "variant": variant,
+                    "exponent": round(float(exponent), 2),
+                }
+            )
+        return scaling
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "version": REPORT_VERSION,
+            **self.environment,
+            "config": asdict(self.config),
+            "results": [_camel(asdict(m)) for m in self.results],
+            "scaling": self.scaling(),
+        }
+
+
+def _camel(values: dict[str, Any]) -> dict[str, Any]:
+    def camel(name: str) -> str:
+        head, *rest = name.split("_")
+        return head + "".join(part.title() for part in rest)
+
+    return {camel(k): v for k, v in values.items()}
+
+
+def _environment() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "createdAt": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpuCount": os.cpu_count(),
+    }
+
+
+def _call(func: Callable, kwargs: dict[str, Any]) -> Any:
+    result = func(**kwargs)
+    return asyncio.run(result) if inspect.isawaitable(result) else result
+
+
+def _measure(
+    func: Callable, kwargs: dict[str, Any], repeat: int, memory: bool
+) -> tuple[Any, float, float, int | None]:
+    walls, cpus = [], []
+    for _ in range(max(repeat, 1)):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = _call(func, kwargs)
+        walls.append(time.perf_counter() - wall_start)
+        cpus.append(time.process_time() - cpu_start)
+
+    peak = None
+    if memory:
+        # a separate run, tracing allocations slows down the step
+        tracemalloc.start()
+        try:
+            _call(func, kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, min(walls), min(cpus), peak
+
+
+class _Run:
+    """Runs the pipeline on one dataset, measuring every step on the way."""
+
+    def __init__(
+        self, dataset: SyntheticDataset, config: BenchmarkConfig, measure: bool
+    ):
+        self.dataset = dataset
+        self.config = config
+        self.ions = len(dataset.features)
+        self.measure = measure
+        self.results: list[Measurement] = []
+
+    def step(
+        self,
+        func: Callable,
+        variant: str = "default",
+        name: str | None = None,
+        **kwargs,
+    ) -> Any:
+        name = name or func.__qualname__
+        if not self.measure:
+            return _call(func, kwargs)
+        result, wall, cpu, peak = _measure(
+            func, kwargs, self.config.repeat, self.config.memory
+        )
+        self.results.append(Measurement(name, variant, self.ions, wall, cpu, peak))
+        return result
+
+    def skip(self, name: str, variant: str, reason: str) -> None:
+        if self.measure:
+            self.results.append(Measurement(name, variant, self.ions, skipped=reason))
+
+    def run(self) -> list[Measurement]:
+        dataset = self.dataset
+        # downloads are left out, only the in-memory part of load_data is timed
+        data = self.step(
+            _filter_metabolites,
+            variant="filter",
+            name="load_data",
+            data=dataset.features,
+            bio_samples=dataset.bio_samples,
+            drug_sample=dataset.drug_sample,
+            min_signal_threshold=MIN_SIGNAL_THRESHOLD,
+            signal_enrichment_factor=SIGNAL_ENRICHMENT_FACTOR,
+        )
+        samples_df = data[TargetIonsColumn.SAMPLE]
+        targeted_ions_df = data[""]
+        spectra, reaction_df = dataset.spectra, dataset.reaction_df
+        ids = targeted_ions_df[TargetIonsColumn.ID].values
+
+        interaction_engine, similarity_engine, workers, _ = self.step(
+            plan_execution,
+            spectra=spectra,
+            targeted_ions_df=targeted_ions_df,
+            reaction_df=reaction_df,
+            mz_error_threshold=MZ_ERROR_THRESHOLD,
+        )
+
+        # every engine is measured, the planned one feeds the following steps
+        matrices = {}
+        for engine in InteractionEngine:
+            matrices[engine] = self.step(
+                create_ion_interaction_matrix,
+                variant=engine.value,
+                targeted_ions_df=targeted_ions_df,
+                reaction_df=reaction_df,
+                mz_error_threshold=MZ_ERROR_THRESHOLD,
+                engine=engine,
+            )
+        ion_interaction_matrix = matrices[interaction_engine]
+
+        # the exact engine is quadratic, it is left out once it gets too slow
+        predicted = similarity_seconds(
+            DataProfile.measure(
+                spectra, targeted_ions_df, reaction_df, MZ_ERROR_THRESHOLD
+            )
+        )
+        similarity = {}
+        for engine in SimilarityEngine:
+            if predicted[engine] > self.config.max_seconds:
+                self.skip(
+                    "create_similarity_matrix",
+                    engine.value,
+                    f"predicted {predicted[engine]:.0f}s",
+                )
+                continue
+            similarity[engine] = self.step(
+                create_similarity_matrix,
+                variant=engine.value,
+                spectra=spectra,
+                ids=ids,
+                engine=engine,
+                candidates=ion_interaction_matrix,
+                workers=workers,
+            )
+        # the blocks other containers would score, scored by local processes
+        if SimilarityEngine.CANDIDATES in similarity:
+            self.step(
+                create_similarity_matrix,
+                variant="distributed",
+                spectra=spectra,
+                ids=ids,
+                engine=SimilarityEngine.CANDIDATES,
+                candidates=ion_interaction_matrix,
+                distributed=True,
+                executor=LocalMapExecutor(),
+            )
+        similarity_matrix = similarity.get(similarity_engine)
+        if similarity_matrix is None:
+            similarity_matrix = next(iter(similarity.values()))
+
+        candidate_edges = self.step(
+            combine_matrices_and_extract_edges,
+            ion_interaction_matrix=ion_interaction_matrix,
+            similarity_matrix=similarity_matrix,
+            ids=ids,
+            ms2_similarity_threshold=MIN_MS2_SIMILARITY_THRESHOLD,
+        )
+        candidate_edges = self.step(
+            calculate_edge_metrics,
+            samples_df=samples_df,
+            targeted_ions_df=targeted_ions_df,
+            edge_data_df=candidate_edges,
+        )
+        edges = self.step(
+            filter_edges,
+            edges=candidate_edges,
+            ms2_similarity_threshold=MS2_SIMILARITY_THRESHOLD,
+        )
+        edges = self.step(
+            edge_value_matching,
+            edges=edges,
+            reaction_df=reaction_df,
+            mz_error_threshold=MZ_ERROR_THRESHOLD,
+        )
+        self.step(
+            postprocessing,
+            targeted_ions_df=targeted_ions_df,
+            spectra=spectra,
+            samples_df=samples_df,
+            edges=edges,
+            bio_samples=dataset.bio_samples,
+            drug_sample=dataset.drug_sample,
+        )
+        self.skip("upload_result", "default", "uploads to Convex")
+
+        config = RecursiveAnalysisConfig(
+            parent_mz_list=dataset.targeted_ions_df[TargetIonsColumn.MZ]
+            .values[:RECURSIVE_SEEDS]
+            .tolist(),
+            max_workers=os.cpu_count() or 1,
+        )
+        ms1_df = dataset.targeted_ions_df.reset_index(drop=True)
+        analyzer = self.step(
+            RecursiveAnalyzer, config=config, ms2_spectra=spectra, ms1_df=ms1_df
+        )
+        self.step(analyzer.explore_metabolic_network)
+        return self.results
+
+
+def run_benchmarks(
+    config: BenchmarkConfig, progress: Callable[[str], None] = print
+) -> Report:
+    """Measure every step at every scale of `config`."""
+    report = Report(config=config, environment=_environment())
+
+    def dataset(ions: int) -> SyntheticDataset:
+        return generate(
+            ions=ions,
+            peaks=config.peaks,
+            edge_density=config.edge_density,
+            reactions=config.reactions,
+            seed=config.seed,
+        )
+
+    progress(f"warming up on {WARMUP_IONS} ions")
+    _Run(dataset(WARMUP_IONS), config, measure=False).run()
+    for ions in config.scales:
+        progress(f"measuring {ions} ions")
+        report.results.extend(_Run(dataset(ions), config, measure=True).run())
+    return report
@@ -0,0 +1,127 @@
+import statistics
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import pyteomics.mass
+from core.mass import formula_masses, parse_fragment
+from core.utils.constants import ReactionColumn
+
+ASSET_DIR = Path(__file__).resolve().parent.parent / "asset"
+# elements of the formula changes reaction databases are made of
+ELEMENTS = ["C", "H", "N", "O", "P", "S", "Cl"]
+
+
+def pyteomics_masses(formula_changes: list[str]) -> list[float]:
+    """What `/analysis/mass` computed before `core.mass`, one fragment at a time."""
+    masses = []
+    for formula_change in formula_changes:
+        if formula_change[0] == "(" and formula_change[-1] == ")":
+            formula_change = formula_change[1:-1]
+        try:
+            mass = sum(
+                [
+                    -pyteomics.mass.calculate_mass(formula=formula[1:])
+                    if formula[0] == "-"
+                    else pyteomics.mass.calculate_mass(formula=formula)
+                    for formula in formula_change.split("+")
+                ]
+            )
+        except Exception:
+            mass = 0
+        masses.append(mass)
+    return masses
+
+
+def reaction_formula_changes() -> list[str]:
+    """Formula changes of the reaction databases shipped in `asset/`."""
+    changes = []
+    for path in sorted(ASSET_DIR.glob("*.csv")):
+        df = pd.read_csv(path)
+        if ReactionColumn.FORMULA_CHANGE in df:
+            changes.extend(df[ReactionColumn.FORMULA_CHANGE].dropna().astype(str))
+    return changes
+
+
+def random_formula_changes(count: int, seed: int = 0) -> list[str]:
+    """Distinct made up changes, for requests no cache has seen before."""
+    rng = np.random.default_rng(seed)
+    changes = []
+    for _ in range(count):
+        fragments = []
+        for _ in range(rng.integers(1, 4)):
+            elements = rng.choice(ELEMENTS, rng.integers(1, 5), replace=False)
+            formula = "".join(f"{e}{rng.integers(1, 30)}" for e in elements)
+            fragments.append(("-" if rng.random() < 0.4 else "") + formula)
+        # subtracted fragments are joined as "+-", the way the handler splits them
+        changes.append(f"({'+'.join(fragments)})")
+    return changes
+
+
+@dataclass
+class MassBenchmark:
+    engine: str
+    cache: str
+    requests: int
+    formulas_per_request: int
+    median_ms: float
+    p95_ms: float
+    formulas_per_second: float
+
+
+def _time_requests(
+    compute: Callable[[list[str]], object],
+    requests: list[list[str]],
+    engine: str,
+    cache: str,
+) -> MassBenchmark:
+    latencies = []
+    for request in requests:
+        start = time.perf_counter()
+        compute(request)
+        latencies.append(time.perf_counter() - start)
+    formulas = sum(len(r) for r in requests)
+    return MassBenchmark(
+        engine=engine,
+        cache=cache,
+        requests=len(requests),
+        formulas_per_request=formulas // len(requests),
+        median_ms=statistics.median(latencies) * 1e3,
+        p95_ms=float(np.percentile(latencies, 95)) * 1e3,
+        formulas_per_second=formulas / sum(latencies),
+    )
+
+
+def run_mass_benchmark(
+    requests: int = 50, formulas_per_request: int = 500, seed: int = 0
+) -> list[dict]:
+    """
+    Latency and throughput of `/analysis/mass` requests, pyteomics against `core.mass`.
+
+    Cold requests are made of formulas no request had before, warm ones are
+    drawn from the shipped reaction databases, like the reaction editor sends.
+    """
+    rng = np.random.default_rng(seed)
+    known = reaction_formula_changes()
+    warm = [
+        [known[i] for i in rng.integers(len(known), size=formulas_per_request)]
+        for _ in range(requests)
+    ]
+    fresh = random_formula_changes(requests * formulas_per_request, seed)
+    cold = [
+        fresh[i : i + formulas_per_request]
+        for i in range(0, len(fresh), formulas_per_request)
+    ]
+
+    results = [
+        _time_requests(pyteomics_masses, cold, "pyteomics", "cold"),
+        _time_requests(pyteomics_masses, warm, "pyteomics", "warm"),
+    ]
+    parse_fragment.cache_clear()
+    results.append(_time_requests(formula_masses, cold, "core.mass", "cold"))
+    formula_masses(known)
+    results.append(_time_requests(formula_masses, warm, "core.mass", "warm"))
+    return [asdict(result) for result in results]
@@ -0,0 +1,173 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from core.models.analysis import BioSample, DrugSample
+from core.utils.constants import (
+    SCANS_KEY,
+    ReactionColumn,
+    TargetIonsColumn,
+    default_reactions,
+)
+from matchms.exporting import save_as_mgf
+from matchms.Spectrum import Spectrum
+
+MZ_RANGE = (100.0, 1000.0)
+RT_RANGE = (0.5, 30.0)
+MIN_FRAGMENT_MZ = 50.0
+# fragment m/z noise of a derived ion, well within the similarity tolerance
+FRAGMENT_JITTER = 0.001
+
+
+@dataclass
+class SyntheticDataset:
+    """
+    Inputs of an analysis, shaped like the uploaded files after preprocessing.
+
+    `features` has the ("", id/mz/rt) and ("sample", <column>) columns the
+    targeted ions parquet files have, so it can go through `load_data`.
+    """
+
+    features: pd.DataFrame
+    spectra: list[Spectrum]
+    reaction_df: pd.DataFrame
+    bio_samples: list[BioSample]
+    drug_sample: DrugSample
+
+    @property
+    def targeted_ions_df(self) -> pd.DataFrame:
+        return self.features[""]
+
+    @property
+    def samples_df(self) -> pd.DataFrame:
+        return self.features[TargetIonsColumn.SAMPLE]
+
+    def write(self, directory: str | Path) -> dict[str, Path]:
+        """Write the feature table, MGF file and reaction database to `directory`."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        paths = {
+            "features": directory / "features.parquet",
+            "spectra": directory / "spectra.mgf",
+            "reactions": directory / "reactions.csv",
+        }
+        self.features.to_parquet(paths["features"], index=True)
+        paths["spectra"].unlink(missing_ok=True)  # matchms appends to existing files
+        save_as_mgf(self.spectra, str(paths["spectra"]))
+        self.reaction_df.to_csv(paths["reactions"], index=False)
+        return paths
+
+
+def generate_reactions(count: int | None = None, seed: int = 0) -> pd.DataFrame:
+    """
+    A reaction database of `count` reactions, the default positive one when None.
+    """
+    if count is None:
+        return default_reactions("pos").copy()
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            ReactionColumn.MZ_DIFF: np.round(rng.uniform(1.0, 200.0, count), 4),
+            ReactionColumn.FORMULA_CHANGE: [f"(+X{i})" for i in range(count)],
+            ReactionColumn.REACTION_DESCRIPTION: [
+                f"synthetic reaction {i}" for i in range(count)
+            ],
+        }
+    )
+
+
+def _fragments(rng: np.random.Generator, precursor_mz: float, peaks: int):
+    mz = np.sort(
+        rng.uniform(MIN_FRAGMENT_MZ, max(precursor_mz, MIN_FRAGMENT_MZ + 1), peaks)
+    )
+    return mz, rng.uniform(0.05, 1.0, peaks)
+
+
+def generate(
+    ions: int = 1000,
+    peaks: int = 20,
+    edge_density: float = 0.3,
+    reactions: int | None = None,
+    samples: int = 6,
+    seed: int = 0,
+) -> SyntheticDataset:
+    """
+    Generate an analysis of `ions` features with an MS2 spectrum each.
+
+    Args:
+        ions: Number of features, and of spectra
+        peaks: Fragment peaks per spectrum
+        edge_density: Share of the ions derived from another ion by a reaction,
+            i.e. the expected number of edges per ion. A derived ion is a
+            reaction mass difference away from its parent and keeps its
+            fragments, half of them shifted by the difference, so that the
+            pair becomes an edge. All other ions are unrelated.
+        reactions: Size of a random reaction database, the default positive
+            database when None
+        samples: Number of sample columns, half bio samples and half drug
+            sample groups, plus one blank
+        seed: Seed of the random generator, equal seeds give equal datasets
+    """
+    rng = np.random.default_rng(seed)
+    reaction_df = generate_reactions(reactions, seed)
+    diffs = reaction_df[ReactionColumn.MZ_DIFF].astype(float).values
+
+    mz = np.empty(ions)
+    fragments: list[tuple[np.ndarray, np.ndarray]] = []
+    derived = rng.random(ions) < edge_density
+    for i in range(ions):
+        if i == 0 or not derived[i]:
+            mz[i] = rng.uniform(*MZ_RANGE)
+            fragments.append(_fragments(rng, mz[i], peaks))
+            continue
+        parent = rng.integers(i)
+        diff = diffs[rng.integers(len(diffs))]
+        mz[i] = mz[parent] + diff
+        parent_mz, parent_intensities = fragments[parent]
+        shifted = rng.random(len(parent_mz)) < 0.5
+        child_mz = parent_mz + np.where(shifted, diff, 0.0)
+        child_mz = child_mz + rng.normal(0, FRAGMENT_JITTER, len(child_mz))
+        order = np.argsort(child_mz)
+        fragments.append(
+            (
+                child_mz[order],
+                (parent_intensities * rng.uniform(0.8, 1.2, len(order)))[order],
+            )
+        )
+
+    ids = np.arange(1, ions + 1)
+    spectra = [
+        Spectrum(
+            mz=fragment_mz,
+            intensities=intensities,
+            metadata={SCANS_KEY: str(id_), "precursor_mz": float(precursor_mz)},
+        )
+        for id_, precursor_mz, (fragment_mz, intensities) in zip(ids, mz, fragments)
+    ]
+
+    sample_names = [f"S{i}" for i in range(samples)]
+    bio_names, drug_names = sample_names[: samples // 2], sample_names[samples // 2 :]
+    intensities = rng.lognormal(14, 1.5, (ions, samples))
+    blank = rng.lognormal(11, 1.5, (ions, 1))
+    columns = pd.MultiIndex.from_tuples(
+        [
+            ("", TargetIonsColumn.ID),
+            ("", TargetIonsColumn.MZ),
+            ("", TargetIonsColumn.RT),
+        ]
+        + [(TargetIonsColumn.SAMPLE, name) for name in [*sample_names, "B0"]]
+    )
+    features = pd.DataFrame(
+        np.column_stack([ids, mz, rng.uniform(*RT_RANGE, ions), intensities, blank]),
+        columns=columns,
+    )
+    features[("", TargetIonsColumn.ID)] = ids
+
+    return SyntheticDataset(
+        features=features,
+        spectra=spectra,
+        reaction_df=reaction_df,
+        bio_samples=[BioSample(name="bio", sample=bio_names, blank=["B0"])],
+        drug_sample=DrugSample(name="drug", groups=drug_names),
+    )
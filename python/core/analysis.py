@@ -1,120 +1,425 @@
-from typing import Any, Callable
+import asyncio
+import functools
+import hashlib
+import json
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any
 
 import numpy as np
 import pandas as pd
+from core.artifacts import ArtifactStore
+from core.distributed import MapExecutor
 from core.models.analysis import Analysis, AnalysisStatus
-from core.utils.constants import TargetIonsColumn
+from core.pipeline import (
+    CheckpointMissing,
+    ResumePlan,
+    Step,
+    execute_step,
+    plan_resume,
+    run_dag,
+)
+from core.shared import SharedSpectra
+from core.utils.constants import MIN_MS2_SIMILARITY_THRESHOLD, TargetIonsColumn
+from core.utils.convex import file_exists
+from core.utils.logger import (
+    collect_metrics,
+    logger,
+    peak_rss,
+    step_metrics,
+    write_metrics,
+)
+from core.utils.memory import MemoryBudget
+from core.utils.progress import track_progress
+from core.utils.status import StatusPublisher
 from pydantic import BaseModel
-from scipy.sparse import coo_matrix
 
 from convex import ConvexClient
 
+# checkpoints of shared steps are reused by every analysis of the same data
+SHARED_NAMESPACE = "shared"
+# bump when a pipeline change alters results, so that older ones are not linked
+RESULT_VERSION = 3
+
+
+def result_key(analysis: Analysis) -> str:
+    """
+    Canonical hash of everything the result of an analysis depends on.
+
+    Names are left out, so a renamed duplicate of an analysis gets the same key.
+    """
+    reaction_db = analysis.reactionDb
+    if not isinstance(reaction_db, str):
+        reaction_db = reaction_db.model_dump(mode="json", exclude={"name"})
+    payload = {
+        "version": RESULT_VERSION,
+        "rawFile": analysis.rawFile.model_dump(mode="json", exclude={"name"}),
+        "reactionDb": reaction_db,
+        "config": analysis.config.model_dump(mode="json"),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+async def _ion_ids(targeted_ions_df: pd.DataFrame) -> np.ndarray:
+    return targeted_ions_df[TargetIonsColumn.ID].values
+
 
 class AnalysisWorker(BaseModel):
     id: str
     convex: ConvexClient
+    # step outputs are checkpointed here so that a retry resumes where it failed
+    store: ArtifactStore | None = None
+    # parsed inputs keyed by their content, shared across containers in Redis
+    cache: ArtifactStore | None = None
+    # per-step timings and sizes are written here as JSON when set
+    metrics_path: str | None = None
+    # spectra and similarity work shared with other analyses of a batch
+    shared: SharedSpectra | None = None
+    # bounds the memory of intermediates, unbounded when not set
+    memory_budget: MemoryBudget | None = None
+    # containers the similarity of the largest analyses is fanned out to
+    map_executor: MapExecutor | None = None
 
     class Config:
         arbitrary_types_allowed = True
 
-    def _convex_mutation_wrapper(self, step: str, status: AnalysisStatus) -> None:
-        self.convex.mutation(
-            "analyses:updateStepStatus",
-            {"id": self.id, "step": step, "status": status},
-        )
+    def _namespace(self, step: Step) -> str:
+        return SHARED_NAMESPACE if step.share else self.id
+
+    async def _execute(
+        self,
+        step: Step,
+        kwargs: dict[str, Any],
+        plan: ResumePlan,
+        executor: Executor | None,
+    ) -> Any:
+        key = plan.keys[step.name]
+        namespace = self._namespace(step)
+        if step.name in plan.restored:
+            try:
+                artifacts = await asyncio.to_thread(self.store.load, namespace, key)
+            except (FileNotFoundError, KeyError) as e:
+                raise CheckpointMissing(step.name, key) from e
+            return step.pack(artifacts)
+
+        result = await execute_step(step, kwargs, executor)
+        if self.store and step.checkpoint:
+            await asyncio.to_thread(
+                self.store.save, namespace, key, step.unpack(result)
+            )
+        return result
 
-    async def _run_step(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+    async def _run_step(
+        self,
+        step: Step,
+        kwargs: dict[str, Any],
+        plan: ResumePlan,
+        status: StatusPublisher,
+        executor: Executor | None = None,
+    ) -> Any:
         """
-        Executes a step function with the provided arguments, automatically inferring the step name from the function name.
-        Handles the Convex mutations for step start and completion.
+        Executes a step with the provided arguments, using the step function's name
+        as the step name.
+        Publishes the step start and completion without waiting for Convex.
         """
-        step = func.__name__
-        self._convex_mutation_wrapper(step=step, status=AnalysisStatus.RUNNING)
+        if not step.track:
+            return await self._execute(step, kwargs, plan, executor)
+
+        status.publish(step.name, AnalysisStatus.RUNNING)
         try:
-            result = await func(*args, **kwargs)
-            self._convex_mutation_wrapper(step=step, status=AnalysisStatus.COMPLETE)
+            with track_progress(step.name, status.progress):
+                result = await self._execute(step, kwargs, plan, executor)
+            metrics = step_metrics(step.name)
+            status.publish(
+                step.name, AnalysisStatus.COMPLETE, metrics and metrics.summary()
+            )
         except Exception as e:
-            self._convex_mutation_wrapper(step=step, status=AnalysisStatus.FAILED)
+            status.publish(step.name, AnalysisStatus.FAILED)
             raise e
         return result
 
-    async def run(self) -> None:
+    def _steps(self, analysis: Analysis, result_key: str | None = None) -> list[Step]:
         from core.steps import (
             calculate_edge_metrics,
             combine_matrices_and_extract_edges,
             create_ion_interaction_matrix,
             create_similarity_matrix,
             edge_value_matching,
+            filter_edges,
             load_data,
+            plan_execution,
             postprocessing,
             upload_result,
         )
 
-        analysis_raw = self.convex.query("analyses:get", {"id": self.id})
+        config = analysis.config
+        fanout = self.map_executor.parallelism if self.map_executor else 1
+        similarity_inputs = {
+            "spectra": "spectra",
+            "ids": "ids",
+            "engine": "similarity_engine",
+            "candidates": "ion_interaction_matrix",
+            "workers": "workers",
+            "distributed": "distributed",
+        }
+        return [
+            Step(
+                load_data,
+                outputs=("spectra", "targeted_ions_df", "samples_df", "reaction_df"),
+                # only what shapes the loaded data, so that changing a downstream
+                # threshold leaves the keys of the expensive steps untouched
+                params={
+                    "raw_file": analysis.rawFile,
+                    "reaction_db": analysis.reactionDb,
+                    "bio_samples": config.bioSamples,
+                    "drug_sample": config.drugSample,
+                    "min_signal_threshold": config.minSignalThreshold,
+                    "signal_enrichment_factor": config.signalEnrichmentFactor,
+                }
+                | ({"low_memory": True} if self.memory_budget else {}),
+                resources={"convex": self.convex, "cache": self.cache}
+                | ({"spectra": self.shared.spectra} if self.shared else {}),
+                offload=False,
+            ),
+            Step(
+                _ion_ids,
+                inputs=["targeted_ions_df"],
+                outputs=("ids",),
+                offload=False,
+                track=False,
+                checkpoint=False,
+            ),
+            # engines are picked from the size of the loaded data, they change
+            # how the matrices are computed but not the result, unless the
+            # config allows the approximate similarity. The fanout then decides
+            # whether it is used, so it goes into the keys of the matrices
+            Step(
+                plan_execution,
+                inputs=["spectra", "targeted_ions_df", "reaction_df"],
+                outputs=(
+                    "interaction_engine",
+                    "similarity_engine",
+                    "workers",
+                    "distributed",
+                ),
+                params={
+                    "mz_error_threshold": config.mzErrorThreshold,
+                    "approximate_similarity": config.approximateSimilarity,
+                }
+                | ({"fanout": fanout} if config.approximateSimilarity else {}),
+                resources={"memory_budget": self.memory_budget}
+                | ({} if config.approximateSimilarity else {"fanout": fanout}),
+                offload=False,
+                track=False,
+                checkpoint=False,
+            ),
+            Step(
+                create_ion_interaction_matrix,
+                inputs={
+                    "targeted_ions_df": "targeted_ions_df",
+                    "reaction_df": "reaction_df",
+                    "engine": "interaction_engine",
+                },
+                outputs=("ion_interaction_matrix",),
+                params={"mz_error_threshold": config.mzErrorThreshold},
+                share=True,
+            ),
+            (
+                # only the interacting ion pairs are scored, unless the plan
+                # finds scoring all of them cheaper
+                Step(
+                    create_similarity_matrix,
+                    inputs=similarity_inputs,
+                    outputs=("similarity_matrix",),
+                    resources={"executor": self.map_executor},
+                    share=True,
+                )
+                if self.shared is None
+                # the pairs of the whole batch are scored at once when that is
+                # cheaper, the step then only waits for its slice
+                else Step(
+                    self.shared.create_similarity_matrix,
+                    inputs=similarity_inputs,
+                    outputs=("similarity_matrix",),
+                    resources={"member": self.id, "executor": self.map_executor},
+                    offload=False,
+                )
+            ),
+            # candidate edges are extracted at the loosest threshold and kept
+            # across analyses, a re-analysis with other thresholds only filters them
+            Step(
+                combine_matrices_and_extract_edges,
+                inputs=["ion_interaction_matrix", "similarity_matrix", "ids"],
+                outputs=("candidate_edges_raw",),
+                params={"ms2_similarity_threshold": MIN_MS2_SIMILARITY_THRESHOLD},
+            ),
+            Step(
+                calculate_edge_metrics,
+                inputs={
+                    "samples_df": "samples_df",
+                    "targeted_ions_df": "targeted_ions_df",
+                    "edge_data_df": "candidate_edges_raw",
+                },
+                outputs=("candidate_edges",),
+                resources={"memory_budget": self.memory_budget},
+                share=True,
+                # the correlation covers every sample column again
+                version=1,
+            ),
+            Step(
+                filter_edges,
+                inputs={"edges": "candidate_edges"},
+                outputs=("edges_with_metrics",),
+                params={"ms2_similarity_threshold": config.ms2SimilarityThreshold},
+                offload=False,
+                track=False,
+                checkpoint=False,
+            ),
+            Step(
+                edge_value_matching,
+                inputs={"edges": "edges_with_metrics", "reaction_df": "reaction_df"},
+                outputs=("matched_edges",),
+                params={
+                    "rt_time_window": config.rtTimeWindow,
+                    "mz_error_threshold": config.mzErrorThreshold,
+                    "correlation_threshold": config.correlationThreshold,
+                },
+            ),
+            Step(
+                postprocessing,
+                inputs={
+                    "targeted_ions_df": "targeted_ions_df",
+                    "spectra": "spectra",
+                    "samples_df": "samples_df",
+                    "edges": "matched_edges",
+                },
+                outputs=("edges", "nodes"),
+                params={
+                    "bio_samples": config.bioSamples,
+                    "drug_sample": config.drugSample,
+                },
+            ),
+            Step(
+                upload_result,
+                inputs=["nodes", "edges"],
+                resources={
+                    "id": self.id,
+                    "convex": self.convex,
+                    "result_key": result_key,
+                },
+                offload=False,
+                checkpoint=False,
+            ),
+        ]
 
-        try:
-            if analysis_raw["rawFile"]["tool"] == "MDial":
-                analysis_raw["rawFile"]["tool"] = "MSDial"
+    async def _result_stored(self, result: dict[str, str]) -> bool:
+        stored = await asyncio.gather(
+            *(file_exists(storage_id, self.convex) for storage_id in result.values())
+        )
+        return all(stored)
 
-            analysis = Analysis(**analysis_raw)
-            config = analysis.config
-            spectra, targeted_ions_df, samples_df, reaction_df = await self._run_step(
-                load_data, analysis, convex=self.convex
-            )
+    async def _link_result(
+        self, analysis: Analysis, result: dict[str, str], key: str
+    ) -> None:
+        async with StatusPublisher(self.id, self.convex) as status:
+            for step in self._steps(analysis):
+                if step.track:
+                    status.publish(step.name, AnalysisStatus.COMPLETE)
 
-            ids: np.ndarray = targeted_ions_df[TargetIonsColumn.ID].values
+        self.convex.mutation(
+            "analyses:update",
+            {
+                "id": self.id,
+                "result": result,
+                "status": AnalysisStatus.COMPLETE,
+                "resultKey": key,
+            },
+        )
 
-            ion_interaction_matrix: coo_matrix = await self._run_step(
-                create_ion_interaction_matrix,
-                targeted_ions_df,
-                reaction_df,
-                mz_error_threshold=config.mzErrorThreshold,
-            )
+    async def run(self) -> None:
+        analysis_raw = self.convex.query("analyses:get", {"id": self.id})
+        run_info: dict[str, Any] = {}
 
-            similarity_matrix: coo_matrix = await self._run_step(
-                create_similarity_matrix,
-                spectra,
-                ids,
-            )
+        with collect_metrics() as metrics:
+            try:
+                if analysis_raw["rawFile"]["tool"] == "MDial":
+                    analysis_raw["rawFile"]["tool"] = "MSDial"
 
-            edges_raw: pd.DataFrame = await self._run_step(
-                combine_matrices_and_extract_edges,
-                ion_interaction_matrix,
-                similarity_matrix,
-                ids,
-                ms2_similarity_threshold=config.ms2SimilarityThreshold,
-            )
+                analysis = Analysis(**analysis_raw)
+                key = result_key(analysis)
 
-            edges_with_metrics = await self._run_step(
-                calculate_edge_metrics,
-                samples_df,
-                targeted_ions_df,
-                edges_raw,
-            )
+                cached = self.convex.query("analyses:findResult", {"resultKey": key})
+                if cached and not await self._result_stored(cached):
+                    # e.g. removed from the bucket, computing it again restores it
+                    logger.warning("result %s is no longer stored", key)
+                    cached = None
+                run_info = {
+                    "resultKey": key,
+                    "resultCache": "hit" if cached else "miss",
+                }
+                logger.info("result cache %s", json.dumps(run_info))
 
-            edges = await self._run_step(
-                edge_value_matching,
-                edges_with_metrics,
-                reaction_df,
-                rt_time_window=config.rtTimeWindow,
-                mz_error_threshold=config.mzErrorThreshold,
-                correlation_threshold=config.correlationThreshold,
-            )
+                if cached:
+                    await self._link_result(analysis, cached, key)
+                else:
+                    await self._run(analysis, key)
+            except Exception as e:
+                print(f"Analysis workflow failed: {e}")
+                raise
+            finally:
+                if self.shared:
+                    self.shared.leave(self.id)
+                run_info["peakRssBytes"] = peak_rss()
+                if self.metrics_path:
+                    write_metrics(metrics, self.metrics_path, **run_info)
 
-            edges, nodes = await self._run_step(
-                postprocessing,
-                targeted_ions_df=targeted_ions_df,
-                spectra=spectra,
-                samples_df=samples_df,
-                edges=edges,
-                bio_samples=config.bioSamples,
-                drug_sample=config.drugSample,
+    async def _run(self, analysis: Analysis, key: str) -> None:
+        steps = self._steps(analysis, key)
+        # checkpoints found at planning that could not be restored, e.g. expired
+        # or on an unavailable cache, the steps are executed instead
+        missing: set[str] = set()
+        while True:
+            plan = plan_resume(
+                steps,
+                completed=lambda step, key: (
+                    bool(self.store)
+                    and key not in missing
+                    and self.store.exists(self._namespace(step), key)
+                ),
             )
+            try:
+                await self._run_plan(plan)
+                break
+            except CheckpointMissing as e:
+                logger.warning("%s, planning again without it", e)
+                missing.add(e.key)
 
-            await self._run_step(
-                upload_result, self.id, nodes, edges, convex=self.convex
-            )
+        self.convex.mutation(
+            "analyses:update", {"id": self.id, "peakRssBytes": peak_rss()}
+        )
 
-        except Exception as e:
-            print(f"Analysis workflow failed: {e}")
-            raise
+        if self.store:
+            self.store.clear(self.id)
+
+    async def _run_plan(self, plan: ResumePlan) -> None:
+        if self.shared and not any(
+            step.name == "create_similarity_matrix" and step.name not in plan.restored
+            for step in plan.steps
+        ):
+            # nothing to wait for, the batch can compute without this analysis
+            self.shared.leave(self.id)
+        async with StatusPublisher(self.id, self.convex) as status:
+            # steps whose results are no longer needed count as done for the frontend
+            for step in plan.skipped:
+                if step.track:
+                    status.publish(step.name, AnalysisStatus.COMPLETE)
+
+            # CPU-bound steps run on this pool, independent ones concurrently,
+            # so that the event loop stays free for status updates
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                await run_dag(
+                    plan.steps,
+                    run_step=functools.partial(
+                        self._run_step, plan=plan, status=status, executor=executor
+                    ),
+                )
@@ -0,0 +1,367 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import struct
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Awaitable, Callable, TypeVar
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import redis
+from core.utils.logger import logger
+from matchms.Spectrum import Spectrum
+from scipy import sparse
+
+T = TypeVar("T")
+
+# fast enough to pay for itself over the network and on disk, ships with pyarrow
+CODEC = "zstd"
+# artifacts keyed by a hash of their source, such as the spectra of an MGF file
+CONTENT_NAMESPACE = "content"
+
+
+def _compress(data: bytes) -> bytes:
+    # the size is needed to decompress, it is kept in front
+    return struct.pack("<Q", len(data)) + pa.compress(data, codec=CODEC, asbytes=True)
+
+
+def _decompress(data: bytes) -> bytes:
+    (size,) = struct.unpack_from("<Q", data)
+    return pa.decompress(data[8:], size, codec=CODEC, asbytes=True)
+
+
+def _is_spectra(value: Any) -> bool:
+    return isinstance(value, list) and bool(value) and isinstance(value[0], Spectrum)
+
+
+def pack_spectra(spectra: list[Spectrum]) -> bytes:
+    """
+    Compressed buffer of the spectra, their peak arrays laid out one after the
+    other behind the pickled rest.
+
+    The arrays are pickled out of band, so they are not copied into the pickle
+    stream and are read back as views of the buffer, without rebuilding the
+    spectra one by one.
+    """
+    buffers: list[pickle.PickleBuffer] = []
+    head = pickle.dumps(spectra, protocol=5, buffer_callback=buffers.append)
+    parts = [head, *(buffer.raw() for buffer in buffers)]
+    sizes = struct.pack(f"<Q{len(parts)}Q", len(parts), *(len(p) for p in parts))
+    return _compress(sizes + b"".join(parts))
+
+
+def unpack_spectra(data: bytes) -> list[Spectrum]:
+    # writable, so that the peaks can be modified like freshly parsed ones
+    packed = memoryview(bytearray(_decompress(data)))
+    (count,) = struct.unpack_from("<Q", packed)
+    sizes = struct.unpack_from(f"<{count}Q", packed, 8)
+    offsets = np.cumsum([8 * (count + 1), *sizes])
+    head, *buffers = (packed[a:b] for a, b in zip(offsets[:-1], offsets[1:]))
+    return pickle.loads(head, buffers=buffers)
+
+
+def encode_artifact(value: Any) -> bytes:
+    """Compressed bytes of `value`, in the format picked from its type."""
+    buffer = io.BytesIO()
+    if isinstance(value, pd.DataFrame):
+        value.to_parquet(buffer, compression=CODEC)
+        return b"P" + buffer.getvalue()
+    if _is_spectra(value):
+        return b"S" + pack_spectra(value)
+    if sparse.issparse(value):
+        sparse.save_npz(buffer, value, compressed=False)
+        return b"Z" + _compress(buffer.getvalue())
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        np.save(buffer, value)
+        return b"N" + _compress(buffer.getvalue())
+    return b"K" + _compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def decode_artifact(data: bytes) -> Any:
+    kind, body = data[:1], data[1:]
+    if kind == b"P":
+        return pd.read_parquet(io.BytesIO(body))
+    if kind == b"S":
+        return unpack_spectra(body)
+    if kind == b"Z":
+        return sparse.load_npz(io.BytesIO(_decompress(body)))
+    if kind == b"N":
+        return np.load(io.BytesIO(_decompress(body)))
+    return pickle.loads(_decompress(body))
+
+
+def _write(path: Path, value: Any) -> None:
+    """Write `value` next to `path`, picking the file format from its type."""
+    if isinstance(value, pd.DataFrame):
+        value.to_parquet(path.with_suffix(".parquet"))
+    elif _is_spectra(value):
+        path.with_suffix(".spectra").write_bytes(pack_spectra(value))
+    elif sparse.issparse(value):
+        sparse.save_npz(path.with_suffix(".npz"), value)
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        np.save(path.with_suffix(".npy"), value)
+    else:
+        with open(path.with_suffix(".pkl"), "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read(path: Path) -> Any:
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    if path.suffix == ".spectra":
+        return unpack_spectra(path.read_bytes())
+    if path.suffix == ".npz":
+        return sparse.load_npz(path)
+    if path.suffix == ".npy":
+        return np.load(path)
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+class ArtifactStore(ABC):
+    """Persists step outputs under a namespace (the analysis id) and a step key."""
+
+    @abstractmethod
+    def exists(self, namespace: str, key: str) -> bool: ...
+
+    @abstractmethod
+    def save(self, namespace: str, key: str, artifacts: dict[str, Any]) -> None: ...
+
+    @abstractmethod
+    def load(self, namespace: str, key: str) -> dict[str, Any]: ...
+
+    @abstractmethod
+    def clear(self, namespace: str) -> None: ...
+
+
+class LocalArtifactStore(ArtifactStore):
+    """
+    Stores artifacts as files under `root/<namespace>/<key>/`.
+
+    Matrices are saved as npz, data frames as parquet, spectra packed and
+    anything else is pickled. A step directory is written under a temporary
+    name and renamed once complete, so a crash never leaves a partial
+    checkpoint behind.
+
+    Steps unused for more than `ttl` seconds are gone. Once the store holds
+    more than `max_bytes`, the least recently used steps are removed first.
+    """
+
+    def __init__(
+        self,
+        root: str | Path,
+        ttl: float | None = None,
+        max_bytes: int | None = None,
+    ):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def _path(self, namespace: str, key: str) -> Path:
+        return self.root / namespace / key
+
+    def _expired(self, path: Path) -> bool:
+        return self.ttl is not None and time.time() - path.stat().st_mtime > self.ttl
+
+    def exists(self, namespace: str, key: str) -> bool:
+        path = self._path(namespace, key)
+        try:
+            return path.is_dir() and not self._expired(path)
+        except FileNotFoundError:
+            return False
+
+    def _evict(self) -> None:
+        steps = []
+        for path in self.root.glob("*/*"):
+            if not path.is_dir() or path.name.startswith("."):
+                continue
+            try:
+                if self._expired(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                    continue
+                files = [f.stat().st_size for f in path.iterdir()]
+                steps.append((path.stat().st_mtime, sum(files), path))
+            except FileNotFoundError:
+                continue  # removed concurrently
+        if self.max_bytes is None:
+            return
+        total = sum(size for _, size, _ in steps)
+        for _, size, path in sorted(steps):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def save(self, namespace: str, key: str, artifacts: dict[str, Any]) -> None:
+        path = self._path(namespace, key)
+        tmp_path = path.with_name(f".{key}.{uuid.uuid4().hex}")
+        tmp_path.mkdir(parents=True)
+        try:
+            for name, value in artifacts.items():
+                _write(tmp_path / name, value)
+            shutil.rmtree(path, ignore_errors=True)
+            tmp_path.rename(path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        if self.ttl is not None or self.max_bytes is not None:
+            self._evict()
+
+    def load(self, namespace: str, key: str) -> dict[str, Any]:
+        path = self._path(namespace, key)
+        artifacts = {file.stem: _read(file) for file in path.iterdir()}
+        # the modification time is that of the last use, for expiry and eviction
+        os.utime(path)
+        return artifacts
+
+    def clear(self, namespace: str) -> None:
+        shutil.rmtree(self.root / namespace, ignore_errors=True)
+
+
+class RedisArtifactStore(ArtifactStore):
+    """
+    Stores the artifacts of a step as one Redis hash of encoded artifacts,
+    shared by every container connected to the same server.
+
+    Steps expire `ttl` seconds after they were last used. A step larger than
+    `max_bytes` encoded is not stored at all, so that a single huge matrix
+    cannot evict everything else, the total is up to the `maxmemory` policy
+    of the server. Being a cache, errors of the server count as misses.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        ttl: float = 24 * 3600,
+        max_bytes: int = 256 * 2**20,
+        prefix: str = "artifacts:",
+    ):
+        self.client = client
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisArtifactStore":
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    def exists(self, namespace: str, key: str) -> bool:
+        try:
+            return bool(self.client.exists(self._key(namespace, key)))
+        except redis.RedisError as e:
+            logger.warning("artifact cache unavailable: %s", e)
+            return False
+
+    def save(self, namespace: str, key: str, artifacts: dict[str, Any]) -> None:
+        encoded = {name: encode_artifact(value) for name, value in artifacts.items()}
+        size = sum(len(value) for value in encoded.values())
+        if size > self.max_bytes:
+            logger.info("not caching %s/%s of %d bytes", namespace, key, size)
+            return
+        # replaced as a whole, readers never see a mix of two writes
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.delete(self._key(namespace, key))
+        pipeline.hset(self._key(namespace, key), mapping=encoded)
+        pipeline.expire(self._key(namespace, key), int(self.ttl))
+        try:
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning("artifact cache unavailable: %s", e)
+
+    def load(self, namespace: str, key: str) -> dict[str, Any]:
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.hgetall(self._key(namespace, key))
+        pipeline.expire(self._key(namespace, key), int(self.ttl))
+        try:
+            values, _ = pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning("artifact cache unavailable: %s", e)
+            raise KeyError(f"{namespace}/{key}") from e
+        if not values:
+            raise KeyError(f"{namespace}/{key}")
+        return {name.decode(): decode_artifact(value) for name, value in values.items()}
+
+    def clear(self, namespace: str) -> None:
+        try:
+            for key in self.client.scan_iter(match=self._key(namespace, "*")):
+                self.client.delete(key)
+        except redis.RedisError as e:
+            logger.warning("artifact cache unavailable: %s", e)
+
+
+class TieredArtifactStore(ArtifactStore):
+    """
+    A local store backed by a shared one, for the `namespaces` worth sharing.
+
+    Steps are read from the local store when it has them and from the shared
+    one otherwise, and written to both. Other namespaces, such as the
+    checkpoints of a single analysis, only ever touch the local store.
+    """
+
+    def __init__(
+        self, local: ArtifactStore, shared: ArtifactStore, namespaces: set[str]
+    ):
+        self.local = local
+        self.shared = shared
+        self.namespaces = namespaces
+
+    def _stores(self, namespace: str) -> list[ArtifactStore]:
+        if namespace in self.namespaces:
+            return [self.local, self.shared]
+        return [self.local]
+
+    def exists(self, namespace: str, key: str) -> bool:
+        return any(store.exists(namespace, key) for store in self._stores(namespace))
+
+    def save(self, namespace: str, key: str, artifacts: dict[str, Any]) -> None:
+        for store in self._stores(namespace):
+            store.save(namespace, key, artifacts)
+
+    def load(self, namespace: str, key: str) -> dict[str, Any]:
+        if namespace not in self.namespaces:
+            return self.local.load(namespace, key)
+        try:
+            return self.local.load(namespace, key)
+        except (FileNotFoundError, KeyError):
+            return self.shared.load(namespace, key)
+
+    def clear(self, namespace: str) -> None:
+        for store in self._stores(namespace):
+            store.clear(namespace)
+
+
+def content_key(*parts: Any) -> str:
+    """Hash of JSON serializable `parts`, such as a kind and a storage id."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+async def cached(
+    store: ArtifactStore | None, key: str, load: Callable[[], Awaitable[T]]
+) -> T:
+    """
+    The value `load()` returned for an earlier call with the same content key,
+    kept in `store`, or that of a new call when there is none or it cannot be
+    read.
+    """
+    if store is not None:
+        try:
+            if await asyncio.to_thread(store.exists, CONTENT_NAMESPACE, key):
+                artifacts = await asyncio.to_thread(store.load, CONTENT_NAMESPACE, key)
+                return artifacts["value"]
+        except (FileNotFoundError, KeyError):
+            pass  # expired in between, or the shared store is unavailable
+    value = await load()
+    if store is not None:
+        await asyncio.to_thread(store.save, CONTENT_NAMESPACE, key, {"value": value})
+    return value
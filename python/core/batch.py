@@ -0,0 +1,78 @@
+import asyncio
+from collections import defaultdict
+
+from core.analysis import AnalysisWorker
+from core.artifacts import ArtifactStore, cached, content_key
+from core.shared import SharedSpectra
+from core.utils.convex import load_mgf
+from core.utils.memory import MemoryBudget
+from pydantic import BaseModel
+
+from convex import ConvexClient
+
+
+class BatchAnalysisWorker(BaseModel):
+    """
+    Runs several analyses at once, sharing the work they have in common.
+
+    Analyses are grouped by their MGF file. The spectra of a group are
+    downloaded and parsed once and the candidate pairs of all its analyses are
+    scored at once when that is cheaper, while the configuration specific
+    steps run per analysis.
+    """
+
+    ids: list[str]
+    convex: ConvexClient
+    store: ArtifactStore | None = None
+    cache: ArtifactStore | None = None
+    # per-step timings of each analysis are written here as <id>.json when set
+    metrics_dir: str | None = None
+    memory_budget: MemoryBudget | None = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _worker(self, id: str, shared: SharedSpectra) -> AnalysisWorker:
+        return AnalysisWorker(
+            id=id,
+            convex=self.convex,
+            store=self.store,
+            cache=self.cache,
+            metrics_path=f"{self.metrics_dir}/{id}.json" if self.metrics_dir else None,
+            shared=shared,
+            memory_budget=self.memory_budget,
+        )
+
+    async def _run_group(self, mgf: str, ids: list[str]) -> list[BaseException | None]:
+        try:
+            spectra = await cached(
+                self.cache,
+                content_key("mgf", mgf),
+                lambda: load_mgf(mgf, convex=self.convex),
+            )
+            shared = SharedSpectra(spectra, ids, self.memory_budget)
+        except Exception as e:
+            return [e] * len(ids)
+        return await asyncio.gather(
+            *(self._worker(id, shared).run() for id in ids), return_exceptions=True
+        )
+
+    async def run(self) -> dict[str, BaseException]:
+        """
+        Returns:
+            The error of every analysis that failed, by analysis id
+        """
+        groups: dict[str, list[str]] = defaultdict(list)
+        for id in dict.fromkeys(self.ids):
+            analysis = self.convex.query("analyses:get", {"id": id})
+            groups[analysis["rawFile"]["mgf"]].append(id)
+
+        results = await asyncio.gather(
+            *(self._run_group(mgf, ids) for mgf, ids in groups.items())
+        )
+        return {
+            id: error
+            for ids, errors in zip(groups.values(), results)
+            for id, error in zip(ids, errors)
+            if error is not None
+        }
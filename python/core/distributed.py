@@ -0,0 +1,54 @@
+import multiprocessing
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MapExecutor(ABC):
+    """
+    Runs one function over many inputs, possibly in other containers.
+
+    Results are yielded in the order of the inputs, so callers merge partial
+    results and report progress while the rest is still running. `fn` must be
+    importable by name wherever it runs, and inputs and results picklable.
+    """
+
+    # inputs processed at once, work is split into at least this many blocks
+    parallelism: int = 1
+
+    @abstractmethod
+    def map(self, fn: Callable[[T], R], items: Iterable[T]) -> Iterator[R]: ...
+
+
+class LocalMapExecutor(MapExecutor):
+    """Processes of this machine, stands in for containers in tests and local runs."""
+
+    def __init__(self, workers: int | None = None):
+        self.parallelism = workers or os.cpu_count() or 1
+
+    def map(self, fn: Callable[[T], R], items: Iterable[T]) -> Iterator[R]:
+        # spawned rather than forked, the pipeline runs steps in threads
+        with ProcessPoolExecutor(
+            max_workers=self.parallelism,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            yield from executor.map(fn, items)
+
+
+class ModalMapExecutor(MapExecutor):
+    """
+    Containers of a Modal function that returns `fn(item)` for its arguments
+    `fn` and `item`, such as `run_block` of the worker app.
+    """
+
+    def __init__(self, function: Any, parallelism: int):
+        self.function = function
+        self.parallelism = parallelism
+
+    def map(self, fn: Callable[[T], R], items: Iterable[T]) -> Iterator[R]:
+        items = list(items)
+        yield from self.function.map([fn] * len(items), items)
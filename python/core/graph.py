@@ -0,0 +1,217 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from core.utils.constants import EdgeColumn, TargetIonsColumn
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# suffix of the node columns holding the share of a sample group, see postprocessing
+RATIO_SUFFIX = "_ratio"
+COMPONENT_KEY = "component"
+
+
+@dataclass
+class Subgraph:
+    """A page of the components matching a query."""
+
+    nodes: pd.DataFrame
+    edges: pd.DataFrame
+    # components matching the query, of which this page holds [offset, offset + limit)
+    total_components: int
+    total_nodes: int
+    total_edges: int
+
+
+def _sorted_index(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(values, kind="stable")
+    return order, values[order]
+
+
+def _range(
+    order: np.ndarray, sorted_values: np.ndarray, low: float | None, high: float | None
+) -> np.ndarray:
+    """Positions of the values within [low, high], found by binary search."""
+    start = 0 if low is None else np.searchsorted(sorted_values, low, side="left")
+    stop = (
+        len(sorted_values)
+        if high is None
+        else np.searchsorted(sorted_values, high, side="right")
+    )
+    return order[start:stop]
+
+
+def _grouped_index(codes: np.ndarray, groups: int) -> tuple[np.ndarray, np.ndarray]:
+    """Positions of every group, group g at order[offsets[g]:offsets[g + 1]]."""
+    order = np.argsort(codes, kind="stable")
+    offsets = np.searchsorted(codes[order], np.arange(groups + 1))
+    return order, offsets
+
+
+class ResultIndex:
+    """
+    The nodes and edges of an analysis result, indexed for subgraph queries.
+
+    Built once per result: m/z and rt are kept sorted for range lookups, edges
+    are grouped by the formula change of their reaction and nodes by the
+    connected component they belong to, so that a query only touches the rows
+    it returns. Edges whose ions are not among the nodes are dropped, as the
+    graph view does.
+    """
+
+    def __init__(self, nodes: pd.DataFrame, edges: pd.DataFrame):
+        self.nodes = nodes.reset_index(drop=True)
+        ids = self.nodes[TargetIonsColumn.ID].to_numpy(np.int64)
+        id_order = np.argsort(ids)
+        sorted_ids = ids[id_order]
+
+        def positions(column: str) -> np.ndarray:
+            values = edges[column].to_numpy(np.int64)
+            found = np.clip(
+                np.searchsorted(sorted_ids, values), 0, max(len(ids) - 1, 0)
+            )
+            known = (
+                sorted_ids[found] == values if len(ids) else np.zeros(len(values), bool)
+            )
+            return np.where(known, id_order[found], -1)
+
+        source, target = positions(EdgeColumn.ID1), positions(EdgeColumn.ID2)
+        known = (source >= 0) & (target >= 0)
+        self.edges = edges[known].reset_index(drop=True)
+        self.source, self.target = source[known], target[known]
+
+        self._mz = _sorted_index(self.nodes[TargetIonsColumn.MZ].to_numpy(np.float64))
+        self._rt = _sorted_index(self.nodes[TargetIonsColumn.RT].to_numpy(np.float64))
+        self.is_prototype = (
+            self.nodes[TargetIonsColumn.IS_PROTOTYPE].fillna(False).to_numpy(bool)
+            if TargetIonsColumn.IS_PROTOTYPE in self.nodes
+            else np.zeros(len(self.nodes), bool)
+        )
+
+        codes, self.reactions = pd.factorize(
+            self.edges[EdgeColumn.MATCHED_FORMULA_CHANGE]
+        )
+        self._reaction_codes = {
+            reaction: code for code, reaction in enumerate(self.reactions)
+        }
+        self._by_reaction = _grouped_index(codes, len(self.reactions))
+
+        self.component_count, self.component = self._components(
+            np.ones(len(self.nodes), bool), np.ones(len(self.edges), bool)
+        )
+
+    @property
+    def ratio_columns(self) -> list[str]:
+        return [col for col in self.nodes.columns if col.endswith(RATIO_SUFFIX)]
+
+    def _components(
+        self, node_mask: np.ndarray, edge_mask: np.ndarray
+    ) -> tuple[int, np.ndarray]:
+        """Component labels of the kept nodes, -1 for the others."""
+        kept = np.flatnonzero(node_mask)
+        local = np.full(len(self.nodes), -1)
+        local[kept] = np.arange(len(kept))
+        graph = coo_matrix(
+            (
+                np.ones(int(edge_mask.sum()), dtype=np.int8),
+                (local[self.source[edge_mask]], local[self.target[edge_mask]]),
+            ),
+            shape=(len(kept), len(kept)),
+        )
+        count, labels = connected_components(graph, directed=False)
+        component = np.full(len(self.nodes), -1)
+        component[kept] = labels
+        return count, component
+
+    def query(
+        self,
+        mz_range: tuple[float | None, float | None] | None = None,
+        rt_range: tuple[float | None, float | None] | None = None,
+        reactions: list[str] | None = None,
+        ratio_column: str | None = None,
+        ratio_range: tuple[float | None, float | None] | None = None,
+        prototype_only: bool = False,
+        include_isolated: bool = True,
+        offset: int = 0,
+        limit: int = 50,
+    ) -> Subgraph:
+        """
+        Components of the subgraph matching every given filter, largest first.
+
+        Nodes are kept by m/z, rt and the ratio of `ratio_column`, edges by the
+        formula change of their reaction and only between kept nodes. With
+        `prototype_only`, only components with a prototype ion are returned.
+
+        Raises:
+            KeyError: If `ratio_column` is not a ratio column of the nodes
+        """
+        node_mask = np.ones(len(self.nodes), bool)
+        for index, bounds in ((self._mz, mz_range), (self._rt, rt_range)):
+            if bounds is not None:
+                in_range = np.zeros(len(self.nodes), bool)
+                in_range[_range(*index, *bounds)] = True
+                node_mask &= in_range
+        if ratio_column is not None and ratio_range is not None:
+            if ratio_column not in self.ratio_columns:
+                raise KeyError(f"Unknown ratio column: {ratio_column}")
+            low, high = ratio_range
+            ratio = self.nodes[ratio_column].to_numpy(np.float64)
+            node_mask &= (ratio >= (-np.inf if low is None else low)) & (
+                ratio <= (np.inf if high is None else high)
+            )
+
+        edge_mask = node_mask[self.source] & node_mask[self.target]
+        if reactions is not None:
+            order, offsets = self._by_reaction
+            matched = np.zeros(len(self.edges), bool)
+            for reaction in reactions:
+                code = self._reaction_codes.get(reaction)
+                if code is not None:
+                    matched[order[offsets[code] : offsets[code + 1]]] = True
+            edge_mask &= matched
+
+        if node_mask.all() and edge_mask.all():
+            count, component = self.component_count, self.component
+        else:
+            count, component = self._components(node_mask, edge_mask)
+
+        kept = np.flatnonzero(node_mask)
+        sizes = np.bincount(component[kept], minlength=count)
+        selected = np.ones(count, bool)
+        if prototype_only:
+            selected &= (
+                np.bincount(
+                    component[kept], weights=self.is_prototype[kept], minlength=count
+                )
+                > 0
+            )
+        if not include_isolated:
+            selected &= sizes > 1
+
+        # largest first, ties in the order of the nodes
+        first = np.full(count, len(self.nodes))
+        np.minimum.at(first, component[kept], kept)
+        ranked = np.flatnonzero(selected)
+        ranked = ranked[np.lexsort((first[ranked], -sizes[ranked]))]
+        rank = np.full(count + 1, -1)
+        rank[ranked] = np.arange(len(ranked))
+
+        node_rank = rank[component]  # -1 for dropped nodes, via rank[-1]
+        on_page = (node_rank >= offset) & (node_rank < offset + limit)
+        page_nodes = np.flatnonzero(on_page)
+        page_edges = np.flatnonzero(edge_mask & on_page[self.source])
+
+        nodes = self.nodes.iloc[page_nodes].assign(
+            **{COMPONENT_KEY: node_rank[page_nodes]}
+        )
+        edges = self.edges.iloc[page_edges].assign(
+            **{COMPONENT_KEY: node_rank[self.source[page_edges]]}
+        )
+        in_result = node_rank >= 0
+        return Subgraph(
+            nodes=nodes.sort_values(COMPONENT_KEY, kind="stable"),
+            edges=edges.sort_values(COMPONENT_KEY, kind="stable"),
+            total_components=len(ranked),
+            total_nodes=int(in_result.sum()),
+            total_edges=int((edge_mask & in_result[self.source]).sum()),
+        )
@@ -0,0 +1,106 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+from pyteomics.mass import nist_mass
+
+# distinct fragments kept parsed, reaction databases repeat the same few hundred
+FRAGMENT_CACHE_SIZE = 1 << 14
+
+# an element with an optional isotope and count, as `pyteomics.mass.Composition`
+# parses formulas. Fragments never contain "+", so labels are plain elements.
+_ATOM = re.compile(r"([A-Z][a-z]*)(?:\[(\d+)\])?([+-]?\d+)?")
+_FORMULA = re.compile(rf"(?:{_ATOM.pattern})*")
+
+
+def _isotope_label(element: str, isotope: int) -> str:
+    return f"{element}[{isotope}]" if isotope else element
+
+
+def _mass_table() -> tuple[dict[str, int], np.ndarray]:
+    labels, masses = {}, []
+    for element, isotopes in nist_mass.items():
+        for isotope, (mass, _abundance) in isotopes.items():
+            labels[_isotope_label(element, isotope)] = len(masses)
+            masses.append(mass)
+    return labels, np.array(masses)
+
+
+# monoisotopic mass of every element, and of every isotope as "C[13]"
+ELEMENT_INDEX, MONOISOTOPIC_MASSES = _mass_table()
+
+Composition = tuple[tuple[int, int], ...]
+
+
+@lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def parse_fragment(formula: str) -> Composition | None:
+    """
+    Atom counts of a formula, as (index into `MONOISOTOPIC_MASSES`, count) pairs.
+
+    None when pyteomics would reject the formula: it does not match the
+    formula grammar or names an element or isotope without a known mass.
+    """
+    if not _FORMULA.fullmatch(formula):
+        return None
+    counts: dict[int, int] = {}
+    for element, isotope, number in _ATOM.findall(formula):
+        index = ELEMENT_INDEX.get(_isotope_label(element, int(isotope or 0)))
+        if index is None:
+            return None
+        counts[index] = counts.get(index, 0) + (int(number) if number else 1)
+    return tuple(counts.items())
+
+
+def parse_formula_change(formula_change: str) -> dict[int, int] | None:
+    """
+    Net atom counts of a formula change such as "(+C2H2O-H2O)".
+
+    Parentheses around the change are dropped, then every "+" separated
+    fragment is added, or subtracted when it starts with "-". None when any
+    fragment is invalid, including the empty fragment of a leading "+".
+
+    Raises:
+        ValueError: If `formula_change` is empty
+    """
+    if not formula_change:
+        raise ValueError("Empty formula change")
+    if formula_change[0] == "(" and formula_change[-1] == ")":
+        formula_change = formula_change[1:-1]
+
+    counts: dict[int, int] = {}
+    for fragment in formula_change.split("+"):
+        if not fragment:
+            return None
+        sign = -1 if fragment[0] == "-" else 1
+        composition = parse_fragment(fragment[1:] if sign < 0 else fragment)
+        if composition is None:
+            return None
+        for index, count in composition:
+            counts[index] = counts.get(index, 0) + sign * count
+    return counts
+
+
+def formula_masses(formula_changes: list[str]) -> np.ndarray:
+    """
+    Monoisotopic mass differences of formula changes.
+
+    All changes are computed together as one product of their composition
+    matrix and the masses of the elements they use. Invalid changes get a mass
+    of 0, as they always have in `/analysis/mass`.
+
+    Raises:
+        ValueError: If a formula change is empty
+    """
+    compositions = [parse_formula_change(change) for change in formula_changes]
+    rows, cols, counts = [], [], []
+    for row, composition in enumerate(compositions):
+        if composition:
+            rows.extend([row] * len(composition))
+            cols.extend(composition.keys())
+            counts.extend(composition.values())
+
+    # only the columns of the elements that occur, a handful in practice
+    used, cols = np.unique(np.array(cols, dtype=np.intp), return_inverse=True)
+    matrix = np.zeros((len(compositions), len(used)))
+    np.add.at(matrix, (np.array(rows, dtype=np.intp), cols), counts)
+    return matrix @ MONOISOTOPIC_MASSES[used]
@@ -2,11 +2,17 @@ from enum import Enum
 from typing import Literal
 
 from core.utils.constants import AutoValueEnumMeta
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class AnalysisTriggerInput(BaseModel):
     id: str
+    # cancel the run of the analysis in progress, if any, rather than join it
+    restart: bool = False
+
+
+class AnalysisBatchTriggerInput(BaseModel):
+    ids: list[str]
 
 
 class AnalysisResult(BaseModel):
@@ -34,6 +40,9 @@ class AnalysisConfig(BaseModel):
     correlationThreshold: float
     bioSamples: list[BioSample]
     drugSample: DrugSample | None = None
+    # allows the binned cosine in place of the modified cosine for the largest
+    # runs, faster but with slightly different scores and thus edges
+    approximateSimilarity: bool = False
 
     class Config:
         arbitrary_types_allowed = True
@@ -102,3 +111,22 @@ class PreprocessIonsInput(BaseModel):
 
     targetedIons: str
     tool: MSTool
+
+
+class SubgraphQueryInput(BaseModel):
+    """Input model for the subgraph query endpoint, unset bounds are open"""
+
+    id: str
+    mzMin: float | None = None
+    mzMax: float | None = None
+    rtMin: float | None = None
+    rtMax: float | None = None
+    # formula changes of the reactions whose edges are kept
+    reactions: list[str] | None = None
+    ratioColumn: str | None = None
+    ratioMin: float | None = None
+    ratioMax: float | None = None
+    prototypeOnly: bool = False
+    includeIsolated: bool = True
+    offset: int = Field(0, ge=0)
+    limit: int = Field(50, ge=1, le=1000)
@@ -0,0 +1,270 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+from concurrent.futures import Executor
+from dataclasses import dataclass, field, replace
+from enum import Enum
+from typing import Any, Awaitable, Callable, Mapping, Sequence
+
+from pydantic import BaseModel
+
+
+@dataclass
+class Step:
+    """
+    A pipeline step with explicitly declared data dependencies.
+
+    `inputs` maps the step function's parameter names to the artifacts they are
+    read from (a plain sequence means parameter and artifact share the name),
+    `outputs` names the artifacts the result is unpacked into and `params`
+    holds the remaining keyword arguments. `resources` are passed like params
+    (clients, ids) but do not affect the result, so they are not fingerprinted.
+    """
+
+    func: Callable[..., Awaitable[Any]]
+    inputs: Mapping[str, str] | Sequence[str] = field(default_factory=dict)
+    outputs: tuple[str, ...] = ()
+    params: dict[str, Any] = field(default_factory=dict)
+    resources: dict[str, Any] = field(default_factory=dict)
+    # CPU-bound steps run in an executor so that independent ones overlap
+    offload: bool = True
+    # whether status updates are published for the step, glue steps have none
+    track: bool = True
+    # whether the outputs are worth persisting so that a retry can resume from them
+    checkpoint: bool = True
+    # whether the checkpoint is kept for other analyses with the same step key
+    share: bool = False
+    # bumped when the step computes something else from the same inputs, so
+    # that checkpoints of the older code are not restored
+    version: int = 0
+
+    def __post_init__(self):
+        if not isinstance(self.inputs, Mapping):
+            self.inputs = {name: name for name in self.inputs}
+
+    @property
+    def name(self) -> str:
+        return self.func.__name__
+
+    def bind(self, artifacts: dict[str, Any]) -> dict[str, Any]:
+        return (
+            {param: artifacts[name] for param, name in self.inputs.items()}
+            | self.params
+            | self.resources
+        )
+
+    def unpack(self, result: Any) -> dict[str, Any]:
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: result}
+        return dict(zip(self.outputs, result or ()))
+
+    def pack(self, artifacts: dict[str, Any]) -> Any:
+        """Inverse of `unpack`, rebuilds the step result from its artifacts."""
+        if len(self.outputs) == 1:
+            return artifacts[self.outputs[0]]
+        return tuple(artifacts[name] for name in self.outputs)
+
+
+class CheckpointMissing(Exception):
+    """A checkpoint planned to be restored is gone, e.g. expired since planning."""
+
+    def __init__(self, step: str, key: str):
+        super().__init__(f"Checkpoint {key} of {step} is missing")
+        self.step = step
+        self.key = key
+
+
+@dataclass
+class ResumePlan:
+    """Which steps to execute, restore from a checkpoint or skip altogether."""
+
+    keys: dict[str, str]
+    steps: list[Step]
+    restored: set[str]
+    skipped: list[Step]
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"Cannot fingerprint {type(value).__name__}")
+
+
+def step_keys(steps: list[Step]) -> dict[str, str]:
+    """
+    Fingerprint every step from its name, params, version and the keys of its
+    inputs.
+
+    A key only changes when something upstream of the step changed, so equal
+    keys mean equal outputs.
+    """
+    producers = {output: step for step in steps for output in step.outputs}
+    keys: dict[str, str] = {}
+
+    def key(step: Step) -> str:
+        if step.name not in keys:
+            payload = {
+                "step": step.name,
+                "params": step.params,
+                "inputs": {
+                    param: f"{key(producers[name])}:{name}"
+                    for param, name in step.inputs.items()
+                },
+            }
+            if step.version:
+                payload["version"] = step.version
+            keys[step.name] = hashlib.sha256(
+                json.dumps(payload, default=_encode, sort_keys=True).encode()
+            ).hexdigest()
+        return keys[step.name]
+
+    for step in steps:
+        key(step)
+    return keys
+
+
+class _Action(Enum):
+    EXECUTE = "execute"
+    RESTORE = "restore"
+    SKIP = "skip"
+
+
+def plan_resume(
+    steps: list[Step], completed: Callable[[Step, str], bool]
+) -> ResumePlan:
+    """
+    Work out the cheapest way to finish `steps` given the completed checkpoints.
+
+    Planning goes backwards from the final steps, which always run unless they
+    are checkpointed. Any other step is only needed when a step that executes
+    consumes its outputs; it is then restored if it has a checkpoint and
+    executed otherwise. Steps that are not needed are skipped, so a restored
+    step cuts off everything upstream of it. Restored steps lose their inputs
+    since they never run.
+    """
+    keys = step_keys(steps)
+    producers = {output: step for step in steps for output in step.outputs}
+    consumers: dict[str, list[Step]] = {step.name: [] for step in steps}
+    for step in steps:
+        for name in step.inputs.values():
+            consumers[producers[name].name].append(step)
+
+    actions: dict[str, _Action] = {}
+
+    def action(step: Step) -> _Action:
+        if step.name not in actions:
+            needed = not consumers[step.name] or any(
+                action(consumer) is _Action.EXECUTE for consumer in consumers[step.name]
+            )
+            if step.checkpoint and completed(step, keys[step.name]):
+                # a completed final step has nothing left to do
+                actions[step.name] = (
+                    _Action.RESTORE if needed and consumers[step.name] else _Action.SKIP
+                )
+            else:
+                actions[step.name] = _Action.EXECUTE if needed else _Action.SKIP
+        return actions[step.name]
+
+    for step in steps:
+        action(step)
+
+    restored = {name for name, a in actions.items() if a is _Action.RESTORE}
+    return ResumePlan(
+        keys=keys,
+        steps=[
+            replace(step, inputs={}) if step.name in restored else step
+            for step in steps
+            if actions[step.name] is not _Action.SKIP
+        ],
+        restored=restored,
+        skipped=[step for step in steps if actions[step.name] is _Action.SKIP],
+    )
+
+
+StepRunner = Callable[[Step, dict[str, Any]], Awaitable[Any]]
+
+
+def _run_in_thread(func: Callable[..., Awaitable[Any]], kwargs: dict[str, Any]) -> Any:
+    return asyncio.run(func(**kwargs))
+
+
+async def execute_step(
+    step: Step, kwargs: dict[str, Any], executor: Executor | None = None
+) -> Any:
+    """Run a single step, off the event loop if it is CPU-bound."""
+    if step.offload and executor is not None:
+        loop = asyncio.get_running_loop()
+        # context variables, such as the metrics collector, follow the step into
+        # the thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            executor, context.run, _run_in_thread, step.func, kwargs
+        )
+    return await step.func(**kwargs)
+
+
+def _validate(steps: list[Step], artifacts: dict[str, Any]) -> None:
+    produced = set(artifacts)
+    for step in steps:
+        duplicates = produced.intersection(step.outputs)
+        if duplicates:
+            raise ValueError(f"Artifacts produced more than once: {duplicates}")
+        produced.update(step.outputs)
+
+    for step in steps:
+        missing = set(step.inputs.values()) - produced
+        if missing:
+            raise ValueError(
+                f"Step {step.name} depends on unknown artifacts: {missing}"
+            )
+
+
+async def run_dag(
+    steps: list[Step],
+    run_step: StepRunner,
+    artifacts: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    """
+    Run `steps` as soon as their inputs are available.
+
+    Steps whose inputs are ready are started together, so independent steps
+    run concurrently. The first failure cancels the steps still waiting and is
+    re-raised.
+
+    Returns:
+        All artifacts, the initial ones included
+    """
+    artifacts = dict(artifacts or {})
+    _validate(steps, artifacts)
+
+    pending = list(steps)
+    running: dict[asyncio.Task, Step] = {}
+    try:
+        while pending or running:
+            ready = [
+                step
+                for step in pending
+                if all(name in artifacts for name in step.inputs.values())
+            ]
+            if not ready and not running:
+                raise ValueError(
+                    f"Steps with cyclic dependencies: {[s.name for s in pending]}"
+                )
+            for step in ready:
+                pending.remove(step)
+                task = asyncio.create_task(run_step(step, step.bind(artifacts)))
+                running[task] = step
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                step = running.pop(task)
+                artifacts.update(step.unpack(task.result()))
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    return artifacts
@@ -0,0 +1,311 @@
+import math
+import os
+from dataclasses import asdict, dataclass, field
+from enum import Enum
+
+import numpy as np
+import pandas as pd
+from core.utils.constants import SCANS_KEY, ReactionColumn, TargetIonsColumn
+from matchms.Spectrum import Spectrum
+
+# ions sampled to estimate how many pairs are a reaction apart
+PROFILE_SAMPLE_SIZE = 1000
+# beyond this much single core work the exact similarity is given up
+MAX_EXACT_SIMILARITY_SECONDS = 30 * 60
+# similarity work below this is not worth starting another process for
+MIN_SECONDS_PER_WORKER = 20
+# similarity work beyond this on the local processes is fanned out to containers
+MIN_DISTRIBUTED_SECONDS = 5 * 60
+
+
+class InteractionEngine(str, Enum):
+    # tests every pair of ions, no setup but quadratic
+    PAIRWISE = "pairwise"
+    # binary searches the sorted masses around every theoretical difference
+    SWEEP = "sweep"
+
+
+class SimilarityEngine(str, Enum):
+    # matchms all-vs-all, least overhead per pair
+    EXACT = "exact"
+    # only the pairs with an ion interaction, the only ones that can become edges
+    CANDIDATES = "candidates"
+    # binned cosine of fragments and neutral losses over the candidate pairs
+    APPROXIMATE = "approximate"
+
+
+@dataclass(frozen=True)
+class CostModel:
+    """
+    Seconds and bytes per unit of work of every engine.
+
+    Measured on a single core, the defaults are only meant to rank the engines
+    and to give an idea of the order of magnitude of a run.
+    """
+
+    pairwise_seconds_per_pair: float = 2.2e-8
+    sweep_seconds_per_search: float = 1.4e-8
+    exact_seconds_per_pair: float = 1.6e-4
+    candidate_seconds_per_pair: float = 6.5e-5
+    approximate_seconds_per_spectrum: float = 7e-5
+    approximate_seconds_per_pair: float = 1.2e-6
+    worker_startup_seconds: float = 5.0
+    # starting containers and sending them their spectra
+    container_startup_seconds: float = 15.0
+    # matchms fills a dense structured array of (score, matches) for all pairs
+    exact_bytes_per_pair: int = 16
+    candidate_bytes_per_pair: int = 48
+    approximate_bytes_per_peak: int = 24
+    # row, column and value of both orientations of a sparse entry
+    interaction_bytes_per_pair: int = 18
+
+
+@dataclass
+class DataProfile:
+    """The sizes the cost of a run depends on, as estimated after loading."""
+
+    ions: int
+    spectra: int
+    reactions: int
+    # fraction of ion pairs whose mass difference matches a reaction
+    candidate_density: float
+    mean_peaks: float
+
+    @property
+    def ion_pairs(self) -> float:
+        return self.ions * (self.ions + 1) / 2
+
+    @property
+    def spectrum_pairs(self) -> float:
+        return self.spectra * (self.spectra + 1) / 2
+
+    @property
+    def candidate_pairs(self) -> float:
+        return self.ion_pairs * self.candidate_density
+
+    @property
+    def spectrum_candidate_pairs(self) -> float:
+        return self.spectrum_pairs * self.candidate_density
+
+    @classmethod
+    def measure(
+        cls,
+        spectra: list[Spectrum],
+        targeted_ions_df: pd.DataFrame,
+        reaction_df: pd.DataFrame,
+        mz_error_threshold: float,
+    ) -> "DataProfile":
+        masses = np.sort(
+            targeted_ions_df[TargetIonsColumn.MZ].values.astype(np.float64)
+        )
+        diffs = np.unique(
+            np.abs(reaction_df[ReactionColumn.MZ_DIFF].values.astype(np.float64))
+        )
+
+        ids = set(targeted_ions_df[TargetIonsColumn.ID].values.tolist())
+        analysed = [s for s in spectra if int(s.metadata[SCANS_KEY]) in ids]
+
+        return cls(
+            ions=len(masses),
+            spectra=len(analysed),
+            reactions=len(diffs),
+            candidate_density=_candidate_density(masses, diffs, mz_error_threshold),
+            mean_peaks=float(np.mean([len(s.peaks) for s in analysed]))
+            if analysed
+            else 0.0,
+        )
+
+
+def _candidate_density(
+    masses: np.ndarray, diffs: np.ndarray, mz_error_threshold: float
+) -> float:
+    """Estimate the share of ion pairs a reaction apart from a sample of ions."""
+    if len(masses) == 0 or len(diffs) == 0:
+        return 0.0
+    # evenly spaced rather than random, so that equal data gets an equal plan
+    sample = masses[
+        np.linspace(0, len(masses) - 1, min(len(masses), PROFILE_SAMPLE_SIZE)).astype(
+            int
+        )
+    ]
+    targets = sample[:, None] + diffs[None, :]
+    counts = np.searchsorted(
+        masses, targets + mz_error_threshold, side="left"
+    ) - np.searchsorted(masses, targets - mz_error_threshold, side="right")
+    pairs = counts.sum() * len(masses) / len(sample)
+    return float(min(1.0, pairs / (len(masses) * (len(masses) + 1) / 2)))
+
+
+@dataclass
+class ExecutionPlan:
+    """The engine of every step that has a choice, and the predicted cost of the run."""
+
+    interaction: InteractionEngine
+    similarity: SimilarityEngine
+    # processes scoring spectrum pairs
+    workers: int
+    profile: DataProfile
+    # candidate pairs scored in blocks across containers rather than locally
+    distributed: bool = False
+    predicted_seconds: dict[str, float] = field(default_factory=dict)
+    predicted_bytes: dict[str, int] = field(default_factory=dict)
+
+    def summary(self) -> dict:
+        return {
+            "interaction": self.interaction.value,
+            "similarity": self.similarity.value,
+            "workers": self.workers,
+            "distributed": self.distributed,
+            "profile": asdict(self.profile),
+            "predictedSeconds": {
+                k: round(v, 3) for k, v in self.predicted_seconds.items()
+            },
+            "predictedBytes": self.predicted_bytes,
+        }
+
+
+def interaction_seconds(
+    profile: DataProfile, model: CostModel = CostModel()
+) -> dict[InteractionEngine, float]:
+    """Predicted single core seconds of every interaction engine."""
+    searches = (
+        profile.ions * max(profile.reactions, 1) * math.log2(max(profile.ions, 2))
+    )
+    return {
+        InteractionEngine.PAIRWISE: profile.ion_pairs * model.pairwise_seconds_per_pair,
+        InteractionEngine.SWEEP: searches * model.sweep_seconds_per_search,
+    }
+
+
+def similarity_seconds(
+    profile: DataProfile, model: CostModel = CostModel()
+) -> dict[SimilarityEngine, float]:
+    """Predicted single core seconds of every similarity engine."""
+    return {
+        SimilarityEngine.EXACT: profile.spectrum_pairs * model.exact_seconds_per_pair,
+        SimilarityEngine.CANDIDATES: profile.spectrum_candidate_pairs
+        * model.candidate_seconds_per_pair,
+        SimilarityEngine.APPROXIMATE: profile.spectra
+        * model.approximate_seconds_per_spectrum
+        + profile.spectrum_candidate_pairs * model.approximate_seconds_per_pair,
+    }
+
+
+def choose_engines(
+    profile: DataProfile,
+    memory_limit: int | None = None,
+    cpu_count: int | None = None,
+    fanout: int = 1,
+    approximate: bool = False,
+    model: CostModel = CostModel(),
+) -> ExecutionPlan:
+    """
+    Choose the cheapest engine of every step for the given data.
+
+    Engines are exchangeable without changing the result, except for the
+    approximate similarity. It is only allowed with `approximate`, and then
+    chosen when the exact candidates would take longer than
+    `MAX_EXACT_SIMILARITY_SECONDS` of single core work on each of the `fanout`
+    containers the similarity can be spread over. Engines predicted to exceed
+    `memory_limit` are avoided.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+
+    interaction_costs = interaction_seconds(profile, model)
+    interaction = min(interaction_costs, key=interaction_costs.get)
+    interaction_bytes = int(profile.candidate_pairs * model.interaction_bytes_per_pair)
+
+    similarity_costs = similarity_seconds(profile, model)
+    candidate_seconds = similarity_costs[SimilarityEngine.CANDIDATES]
+    workers = 1
+    if candidate_seconds > MIN_SECONDS_PER_WORKER:
+        workers = max(
+            1, min(cpu_count, int(candidate_seconds // MIN_SECONDS_PER_WORKER))
+        )
+        similarity_costs[SimilarityEngine.CANDIDATES] = (
+            candidate_seconds / workers + model.worker_startup_seconds
+        )
+    similarity_bytes = {
+        SimilarityEngine.EXACT: int(profile.spectra**2 * model.exact_bytes_per_pair),
+        SimilarityEngine.CANDIDATES: int(
+            profile.spectrum_candidate_pairs * model.candidate_bytes_per_pair
+        ),
+        SimilarityEngine.APPROXIMATE: int(
+            profile.spectra * profile.mean_peaks * model.approximate_bytes_per_peak
+            + profile.spectrum_candidate_pairs * model.candidate_bytes_per_pair
+        ),
+    }
+
+    if approximate and candidate_seconds > MAX_EXACT_SIMILARITY_SECONDS * max(
+        fanout, 1
+    ):
+        similarity = SimilarityEngine.APPROXIMATE
+        workers = 1
+    else:
+        exact = [SimilarityEngine.EXACT, SimilarityEngine.CANDIDATES]
+        fitting = [
+            engine
+            for engine in exact
+            if memory_limit is None or similarity_bytes[engine] <= memory_limit
+        ]
+        similarity = min(fitting or exact, key=similarity_costs.get)
+        if similarity is SimilarityEngine.EXACT:
+            workers = 1
+
+    distributed = (
+        similarity is SimilarityEngine.CANDIDATES
+        and fanout > 1
+        and similarity_costs[similarity] > MIN_DISTRIBUTED_SECONDS
+    )
+    if distributed:
+        workers = 1
+        similarity_costs[similarity] = (
+            candidate_seconds / fanout + model.container_startup_seconds
+        )
+
+    return ExecutionPlan(
+        interaction=interaction,
+        similarity=similarity,
+        workers=workers,
+        profile=profile,
+        distributed=distributed,
+        predicted_seconds={
+            "create_ion_interaction_matrix": interaction_costs[interaction],
+            "create_similarity_matrix": similarity_costs[similarity],
+        },
+        predicted_bytes={
+            "create_ion_interaction_matrix": interaction_bytes,
+            "create_similarity_matrix": similarity_bytes[similarity],
+        },
+    )
+
+
+def plan_shared_similarity(
+    union: DataProfile,
+    members: list[DataProfile],
+    memory_limit: int | None = None,
+    cpu_count: int | None = None,
+    model: CostModel = CostModel(),
+) -> ExecutionPlan | None:
+    """
+    Plan the similarity of a batch, scored once over the union of the pairs of
+    its members rather than by each member on its own.
+
+    The shared job is planned like any other. It is only worth it when it is
+    predicted to take less than the separate runs together, i.e. when the
+    members have enough pairs in common, so None is returned otherwise.
+    """
+    shared = choose_engines(
+        union, memory_limit=memory_limit, cpu_count=cpu_count, model=model
+    )
+    separate = sum(
+        choose_engines(
+            member, memory_limit=memory_limit, cpu_count=cpu_count, model=model
+        ).predicted_seconds["create_similarity_matrix"]
+        for member in members
+    )
+    shared_seconds = shared.predicted_seconds["create_similarity_matrix"]
+    # equal up to rounding when no pair is shared, not worth waiting for the others
+    if shared_seconds < separate and not math.isclose(shared_seconds, separate):
+        return shared
+    return None
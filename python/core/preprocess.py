@@ -1,83 +1,257 @@
+import csv
 import io
-from io import BytesIO
-from typing import Callable
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Callable, TypeVar
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from core.models.analysis import MSTool
 from core.utils.constants import MSDialColumn, TargetIonsColumn
 
+ENCODING = "utf-8"
+# large blocks keep the multithreaded parser busy on wide alignment exports
+BLOCK_SIZE = 1 << 24
+# in streaming mode the block size bounds memory, one block becomes one row group
+STREAM_BLOCK_SIZE = 1 << 22
+MSDIAL_HEADER_ROWS = 5
 
-def _preprocess_mzmine3(bytesIO: BytesIO) -> tuple[pd.DataFrame, list[str]]:
-    df = pd.read_csv(bytesIO)
-    # Generate a dictionary that maps original column names to new column names
-    rename_dict = {col: col.split(".")[0] for col in df.columns if ".raw Peak" in col}
+TableOrBatch = TypeVar("TableOrBatch", pa.Table, pa.RecordBatch)
+
+
+def _read_header_rows(buffer: BinaryIO, delimiter: str, n_rows: int) -> list[list[str]]:
+    """Consume the first `n_rows` lines of `buffer` and split them into fields."""
+    lines = [buffer.readline().decode(ENCODING).rstrip("\r\n") for _ in range(n_rows)]
+    # the utf-8 BOM written by Excel would otherwise end up in the first column name
+    lines[0] = lines[0].removeprefix("\ufeff")
+    return list(csv.reader(lines, delimiter=delimiter))
+
+
+def _deduplicate(names: list[str]) -> list[str]:
+    """Name empty and repeated columns the same way `pd.read_csv` does."""
+    seen: dict[str, int] = {}
+    result = []
+    for i, name in enumerate(names):
+        name = name or f"Unnamed: {i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        result.append(name)
+    return result
+
+
+@dataclass
+class _ExportLayout:
+    """Everything needed to parse the body of an export once its header is read."""
+
+    delimiter: str
+    column_names: list[str]
+    include_columns: list[str]
+    intensity_columns: list[str]
+    key_types: dict[str, pa.DataType]
+    renames: dict[str, str]
+    msms_assigned_column: str | None = None
+
+    @property
+    def sample_cols(self) -> list[str]:
+        return [self.renames.get(col, col) for col in self.intensity_columns]
+
+    def column_types(self, streaming: bool) -> dict[str, pa.DataType]:
+        types = {col: pa.float32() for col in self.intensity_columns} | self.key_types
+        if streaming:
+            # types inferred from the first block are frozen for the whole stream,
+            # so annotation columns that start out empty must not become nulls
+            types = {col: pa.string() for col in self.include_columns} | types
+        return types
 
-    # Drop columns with all NaN values
-    df.dropna(axis=1, how="all", inplace=True)
+    def convert_options(self, streaming: bool = False) -> pacsv.ConvertOptions:
+        return pacsv.ConvertOptions(
+            include_columns=self.include_columns,
+            column_types=self.column_types(streaming),
+            strings_can_be_null=True,
+        )
 
-    # Normalize column names
-    df = df.rename(
-        columns={
+    def read_options(self, streaming: bool = False) -> pacsv.ReadOptions:
+        return pacsv.ReadOptions(
+            column_names=self.column_names,
+            block_size=STREAM_BLOCK_SIZE if streaming else BLOCK_SIZE,
+            use_threads=True,
+        )
+
+    def parse_options(self) -> pacsv.ParseOptions:
+        return pacsv.ParseOptions(delimiter=self.delimiter)
+
+
+def _mzmine3_layout(buffer: BinaryIO) -> _ExportLayout:
+    (header,) = _read_header_rows(buffer, ",", 1)
+    column_names = _deduplicate(header)
+    # Generate a dictionary that maps original column names to new column names
+    rename_dict = {col: col.split(".")[0] for col in column_names if ".raw Peak" in col}
+
+    return _ExportLayout(
+        delimiter=",",
+        column_names=column_names,
+        include_columns=column_names,
+        intensity_columns=list(rename_dict),
+        key_types={
+            "row ID": pa.int64(),
+            "row m/z": pa.float64(),
+            "row retention time": pa.float64(),
+        },
+        # Normalize column names
+        renames={
             "row m/z": TargetIonsColumn.MZ,
             "row retention time": TargetIonsColumn.RT,
             "row ID": TargetIonsColumn.ID,
         }
-        | rename_dict
+        | rename_dict,
     )
 
-    sample_cols = list(rename_dict.values())
 
-    return df, sample_cols
+def _msdial_layout(buffer: BinaryIO) -> _ExportLayout:
+    # The first four rows hold per-file metadata, the fifth one the column names
+    header_rows = _read_header_rows(buffer, "\t", MSDIAL_HEADER_ROWS)
+    column_names = _deduplicate(header_rows[-1])
+    # Columns marked NA in the first metadata row are class averages and deviations
+    na_cols_mask = ["NA" in value for value in header_rows[0]]
 
+    include_columns = [
+        col for col, is_na in zip(column_names, na_cols_mask) if not is_na
+    ]
 
-def _preprocess_msdial(bytesIO: BytesIO) -> tuple[pd.DataFrame, list[str]]:
-    # Read the first row to get the columns with NA values
-    na_cols_mask = pd.read_csv(bytesIO, sep="\t", nrows=1).columns.str.contains(
-        "NA", na=False
-    )
-    bytesIO.seek(0)
-    df = pd.read_csv(bytesIO, sep="\t", skiprows=4)
-    # retain rows with only MS/MS assigned
-    df = df[df[MSDialColumn.MSMS_ASSIGNED]]
-    # Drop the selected columns
-    df = df.drop(
-        df.columns[
-            # Drop columns with NA values and columns with all NaN or empty values
-            na_cols_mask | (df.isna() | (df == "")).all()
+    return _ExportLayout(
+        delimiter="\t",
+        column_names=column_names,
+        include_columns=include_columns,
+        # all columns after MS/MS Spectrum are sample columns
+        intensity_columns=include_columns[
+            include_columns.index(MSDialColumn.MSMS_SPECTRUM) + 1 :
         ],
-        axis=1,
-    )
-
-    # Normalize column names
-    df = df.rename(
-        columns={
+        key_types={
+            "Alignment ID": pa.int64(),
+            "Average Mz": pa.float64(),
+            "Average Rt(min)": pa.float64(),
+            MSDialColumn.MSMS_ASSIGNED: pa.bool_(),
+        },
+        # Normalize column names
+        renames={
             "Average Mz": TargetIonsColumn.MZ,
             "Average Rt(min)": TargetIonsColumn.RT,
             "Alignment ID": TargetIonsColumn.ID,
-        }
+        },
+        # retain rows with only MS/MS assigned
+        msms_assigned_column=MSDialColumn.MSMS_ASSIGNED,
     )
 
-    # all columns after MS/MS Spectrum are sample columns
-    sample_cols = df.columns[
-        df.columns.get_loc(MSDialColumn.MSMS_SPECTRUM) + 1 :
-    ].tolist()
 
-    return df, sample_cols
+layouts: dict[MSTool, Callable[[BinaryIO], _ExportLayout]] = {
+    MSTool.MZmine3: _mzmine3_layout,
+    MSTool.MSDial: _msdial_layout,
+}
 
 
-preprocessors: dict[MSTool, Callable[[BytesIO], tuple[pd.DataFrame, list[str]]]] = {
-    MSTool.MZmine3: _preprocess_mzmine3,
-    MSTool.MSDial: _preprocess_msdial,
-}
+def _normalize(data: TableOrBatch, layout: _ExportLayout) -> TableOrBatch:
+    if layout.msms_assigned_column:
+        data = data.filter(pc.equal(data[layout.msms_assigned_column], True))
+    return data.rename_columns(
+        [layout.renames.get(col, col) for col in data.schema.names]
+    )
+
+
+def _empty_columns(table: pa.Table) -> set[str]:
+    # empty strings are parsed as nulls, so the null count tells which columns
+    # hold no data
+    return {
+        name
+        for name, column in zip(table.column_names, table.columns)
+        if column.null_count == table.num_rows
+    }
+
+
+def _tag_columns(columns: list[str], sample_cols: list[str]) -> list[tuple[str, str]]:
+    # tag sample columns with 'sample' so they can be told apart from ion metadata
+    return [
+        (TargetIonsColumn.SAMPLE if col in sample_cols else "", col) for col in columns
+    ]
+
+
+def _pandas_schema(schema: pa.Schema, columns: list[tuple[str, str]]) -> pa.Schema:
+    """Attach the pandas metadata that restores `columns` as a MultiIndex on read."""
+    df = schema.empty_table().to_pandas()
+    df.columns = pd.MultiIndex.from_tuples(columns)
+    metadata = json.loads(pa.Schema.from_pandas(df).metadata[b"pandas"])
+    metadata["index_columns"] = []
+    return pa.schema(
+        [field.with_name(str(col)) for field, col in zip(schema, columns)],
+        metadata={b"pandas": json.dumps(metadata)},
+    )
 
 
 def preprocess_targeted_ions_file(
     blob: bytes, tool: MSTool
 ) -> tuple[pd.DataFrame, list[str]]:
-    df, sample_cols = preprocessors[tool](io.BytesIO(blob))
-    # create multi-index columns for sample columns, tag them with 'sample'
-    df.columns = pd.MultiIndex.from_tuples(
-        [("sample" if col in sample_cols else "", col) for col in df.columns]
+    buffer = io.BytesIO(blob)
+    layout = layouts[tool](buffer)
+    # Parse the remainder of the buffer in a single multithreaded pass
+    table = pacsv.read_csv(
+        buffer,
+        read_options=layout.read_options(),
+        parse_options=layout.parse_options(),
+        convert_options=layout.convert_options(),
     )
+    table = _normalize(table, layout)
+    # Drop columns with all NaN or empty values
+    empty_columns = _empty_columns(table)
+    df = table.drop_columns(list(empty_columns)).to_pandas()
+
+    sample_cols = [col for col in layout.sample_cols if col not in empty_columns]
+    df.columns = pd.MultiIndex.from_tuples(_tag_columns(list(df.columns), sample_cols))
 
     return df, sample_cols
+
+
+def preprocess_targeted_ions_file_streaming(
+    source: str | Path, tool: MSTool, destination: str | Path
+) -> list[str]:
+    """
+    Preprocess an export on disk into a parquet file with bounded memory.
+
+    The export is parsed in record batches; each batch is filtered and
+    normalized on its own and appended to `destination` as a row group, so
+    memory use does not grow with the file size. Empty columns cannot be known
+    before the last batch, so they stay in the file and are only left out of
+    the returned sample columns.
+
+    Returns:
+        Names of the non-empty sample columns
+    """
+    with open(source, "rb") as buffer:
+        layout = layouts[tool](buffer)
+        reader = pacsv.open_csv(
+            buffer,
+            read_options=layout.read_options(streaming=True),
+            parse_options=layout.parse_options(),
+            convert_options=layout.convert_options(streaming=True),
+        )
+        columns = [layout.renames.get(col, col) for col in reader.schema.names]
+        schema = _pandas_schema(
+            reader.schema, _tag_columns(columns, layout.sample_cols)
+        )
+
+        null_counts = dict.fromkeys(columns, 0)
+        n_rows = 0
+        with pq.ParquetWriter(destination, schema) as writer:
+            for batch in reader:
+                batch = _normalize(batch, layout)
+                writer.write_batch(pa.record_batch(batch.columns, schema=schema))
+                n_rows += batch.num_rows
+                for col, column in zip(columns, batch.columns):
+                    null_counts[col] += column.null_count
+
+    return [col for col in layout.sample_cols if null_counts.get(col, 0) < n_rows]
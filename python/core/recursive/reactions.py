@@ -1,6 +1,6 @@
-from pathlib import Path
+from functools import lru_cache
 
-import pandas as pd
+from core.utils.assets import read_asset_table
 from pydantic import BaseModel, Field
 
 
@@ -10,15 +10,18 @@ class ReactionData(BaseModel):
     mzdiff: float = Field(..., alias="MW Difference")
 
 
+@lru_cache(maxsize=1)
 def load_reactions_data() -> list[ReactionData]:
     """
     Load and parse the reactions data from the deduplicated_reactions.csv file.
 
+    Parsed once, on first use: importing the recursive analysis does not pay
+    for the 1700+ reactions.
+
     Returns:
         List[ReactionData]: A list of validated reaction data objects
     """
-    folder = Path(__file__).parents[2] / "asset"
-    reactions_df = pd.read_csv(folder / "deduplicated_reactions.csv")
+    reactions_df = read_asset_table("deduplicated_reactions")
 
     # Convert DataFrame to list of ReactionData objects
     reactions = [
@@ -27,5 +30,8 @@ def load_reactions_data() -> list[ReactionData]:
     return reactions
 
 
-# Load reactions data on module import for direct use
-reactions_data: list[ReactionData] = load_reactions_data()
+def __getattr__(name: str):
+    # `reactions_data` used to be loaded on module import
+    if name == "reactions_data":
+        return load_reactions_data()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
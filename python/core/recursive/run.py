@@ -1,5 +1,7 @@
 import logging
 import os
+import weakref
+from collections import Counter
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass
 from typing import Any, Dict, List, NamedTuple, Optional, TypeAlias
@@ -7,13 +9,21 @@ from typing import Any, Dict, List, NamedTuple, Optional, TypeAlias
 import networkx as nx
 import numpy as np
 import pandas as pd
-from core.recursive.reactions import ReactionData, reactions_data
+from core.artifacts import pack_spectra, unpack_spectra
+from core.recursive.reactions import ReactionData, load_reactions_data
 from core.utils.constants import SCANS_KEY, TargetIonsColumn
+from core.utils.memory import (
+    SpilledArray,
+    attach,
+    share,
+    shared_copy,
+    shared_zeros,
+)
 from matchms import calculate_scores
 from matchms.similarity import ModifiedCosine
 from matchms.Spectrum import Spectrum
 from numba import jit
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from tqdm import tqdm
 
 # Enhanced logging setup
@@ -60,49 +70,60 @@ class AnalysisConstants:
     MAX_WORKERS: int = 32
 
 
-@jit(nopython=True)
-def _build_mz_diff_matrix_fast(mz_array: np.ndarray) -> np.ndarray:
-    """JIT-compiled function to build mass difference matrix efficiently.
-
-    Args:
-        mz_array: Array of m/z values
-
-    Returns:
-        Matrix of pairwise mass differences
-    """
-    n = len(mz_array)
-    mz_diff_matrix = np.zeros((n, n), dtype=np.float32)
-
-    for i in range(n):
-        # Compute differences for upper triangle only
-        j_indices = np.arange(i, n)
-        diffs = np.abs(mz_array[j_indices] - mz_array[i])
-        mz_diff_matrix[i, j_indices] = diffs
-        mz_diff_matrix[j_indices, i] = diffs  # Mirror the values
-
-    return mz_diff_matrix
-
-
-@jit(nopython=True)
-def _find_matching_reactions_fast(
-    mz_diff: float,
+@jit(nopython=True, cache=True)
+def _find_reaction_neighbors_fast(
+    source_mz: float,
+    sorted_mz: np.ndarray,
     reaction_mz_diffs: np.ndarray,
-    reaction_indices: np.ndarray,
     delta_mz_threshold: float,
-) -> np.ndarray:
-    """JIT-compiled function to find matching reactions efficiently.
+) -> tuple[np.ndarray, np.ndarray]:
+    """JIT-compiled search for the ions one reaction away from a mass.
+
+    The ions of every reaction lie in a window of the sorted masses on either
+    side of `source_mz`, found by binary search, so the cost grows with the
+    number of reactions and matches rather than with the number of ions.
 
     Args:
-        mz_diff: Mass difference to match
+        source_mz: m/z value to search from
+        sorted_mz: Ascending m/z values of all ions
         reaction_mz_diffs: Array of reaction mass differences
-        reaction_indices: Array of indices for valid reactions
         delta_mz_threshold: Threshold for mass difference matching
 
     Returns:
-        Array of indices of matching reactions
+        Tuple of (positions in sorted_mz, reaction indices) of every match
     """
-    matches = np.abs(reaction_mz_diffs - mz_diff) <= delta_mz_threshold
-    return reaction_indices[matches]
+    n_reactions = len(reaction_mz_diffs)
+    # windows below and above the source mass, per reaction
+    starts = np.zeros(2 * n_reactions, dtype=np.int64)
+    stops = np.zeros(2 * n_reactions, dtype=np.int64)
+    total = 0
+    for r in range(n_reactions):
+        low = reaction_mz_diffs[r] - delta_mz_threshold
+        high = reaction_mz_diffs[r] + delta_mz_threshold
+        if high < 0:
+            continue
+        if low <= 0:
+            # the two windows meet at the source mass
+            starts[2 * r] = np.searchsorted(sorted_mz, source_mz - high, side="left")
+            stops[2 * r] = np.searchsorted(sorted_mz, source_mz + high, side="right")
+        else:
+            starts[2 * r] = np.searchsorted(sorted_mz, source_mz - high, side="left")
+            stops[2 * r] = np.searchsorted(sorted_mz, source_mz - low, side="right")
+            starts[2 * r + 1] = np.searchsorted(sorted_mz, source_mz + low, side="left")
+            stops[2 * r + 1] = np.searchsorted(
+                sorted_mz, source_mz + high, side="right"
+            )
+        total += stops[2 * r] - starts[2 * r] + stops[2 * r + 1] - starts[2 * r + 1]
+
+    positions = np.empty(total, dtype=np.int64)
+    reactions = np.empty(total, dtype=np.int32)
+    k = 0
+    for w in range(2 * n_reactions):
+        for position in range(starts[w], stops[w]):
+            positions[k] = position
+            reactions[k] = w // 2
+            k += 1
+    return positions, reactions
 
 
 @dataclass
@@ -114,22 +135,89 @@ class ProcessingResult:
     processed_nodes: set[NodeId]
 
 
-class BatchData(NamedTuple):
-    """Data structure for batch processing."""
+class NodeBatch(NamedTuple):
+    """What is sent to a worker per batch, the rest of the state is mapped once."""
 
-    node_batch: list[tuple[NodeId, float, np.ndarray]]
-    mz_array: np.ndarray
-    id_array: np.ndarray
-    reactions: list[ReactionData]
+    # positions of the nodes in the id array
+    node_indices: np.ndarray
+    # version of the visited nodes the batch was planned against
+    visited_version: int
+
+
+@dataclass(frozen=True)
+class SharedState:
+    """
+    Read-only state of an analyzer, passed to each of its workers once.
+
+    Arrays are passed through `share`, so the workers map them rather than
+    receive copies. Only the visited nodes change, between layers, when no
+    batch is running.
+    """
+
+    # m/z values of the ions in ascending order, and the positions they come from
+    sorted_mz: np.ndarray | SpilledArray
+    mz_order: np.ndarray | SpilledArray
+    # fixed width strings, so that they can be mapped
+    id_array: np.ndarray | SpilledArray
+    # 1 for the nodes visited before the current layer
+    visited: np.ndarray | SpilledArray
+    # one element, incremented whenever `visited` is rewritten
+    visited_version: np.ndarray | SpilledArray
+    # `pack_spectra` of the spectra of the ions, as bytes
+    spectra: np.ndarray | SpilledArray
+    reaction_mz_diffs: np.ndarray | SpilledArray
+    products: list[str]
     delta_mz_threshold: float
-    spectrum_lookup: dict[NodeId, Spectrum]
     modcos_threshold: float
     tolerance: float
-    visited_nodes: set[NodeId]
-    mz_diff_matrix: np.ndarray
-    id_to_index: dict[str, int]
-    reaction_mz_diffs: np.ndarray  # New field for reaction mass differences
-    reaction_indices: np.ndarray  # New field for reaction indices
+
+
+@dataclass
+class _WorkerState:
+    """The shared state as mapped by one worker process."""
+
+    shared: SharedState
+    mz_array: np.ndarray
+    sorted_mz: np.ndarray
+    mz_order: np.ndarray
+    ids: list[NodeId]
+    # equal ids get equal codes, cheaper to compare than the strings
+    id_codes: np.ndarray
+    visited: np.ndarray
+    visited_version: np.ndarray
+    spectrum_lookup: dict[NodeId, Spectrum]
+    reaction_mz_diffs: np.ndarray
+
+    @classmethod
+    def attach(cls, shared: SharedState) -> "_WorkerState":
+        id_array = attach(shared.id_array)
+        _, id_codes = np.unique(id_array, return_inverse=True)
+        spectra = unpack_spectra(attach(shared.spectra).tobytes())
+        sorted_mz = attach(shared.sorted_mz)
+        mz_order = attach(shared.mz_order)
+        mz_array = np.empty_like(sorted_mz)
+        mz_array[mz_order] = sorted_mz
+        return cls(
+            shared=shared,
+            mz_array=mz_array,
+            sorted_mz=sorted_mz,
+            mz_order=mz_order,
+            ids=id_array.tolist(),
+            id_codes=id_codes,
+            visited=attach(shared.visited),
+            visited_version=attach(shared.visited_version),
+            spectrum_lookup={str(s.metadata[SCANS_KEY]): s for s in spectra},
+            reaction_mz_diffs=np.asarray(attach(shared.reaction_mz_diffs)),
+        )
+
+
+# the analyzer state of a pool worker, set once by `_init_worker`
+_worker_state: _WorkerState | None = None
+
+
+def _init_worker(shared: SharedState) -> None:
+    global _worker_state
+    _worker_state = _WorkerState.attach(shared)
 
 
 def process_mass_differences(
@@ -202,66 +290,72 @@ def calculate_modcos_scores(
     return filtered_scores
 
 
-def process_node_batch(batch_data: BatchData) -> ProcessingResult:
+def process_node_batch(batch: NodeBatch) -> ProcessingResult:
     """Process a batch of nodes to find their neighbors.
 
+    Runs in a worker of the analyzer's pool, on the state `_init_worker` mapped.
+
     Args:
-        batch_data: Batch data containing all necessary information
+        batch: Positions of the nodes and the visited version they expect
 
     Returns:
         ProcessingResult containing new neighbors and their products
     """
+    state = _worker_state
+    shared = state.shared
+    if state.visited_version[0] != batch.visited_version:
+        raise RuntimeError("Visited nodes changed while a layer was processed")
+
     batch_neighbors = set()
     neighbor_products: NeighborProductsMap = {}
     processed_nodes = set()
 
-    for current_node, _, unvisited_indices in batch_data.node_batch:
-        # Get pre-computed mass differences for the current node
-        node_idx = batch_data.id_to_index[current_node]
-        mass_differences = batch_data.mz_diff_matrix[node_idx, unvisited_indices]
-        potential_neighbors: NeighborProductsMap = {}
+    for node_idx in batch.node_indices:
+        current_node = state.ids[node_idx]
+        # Find potential neighbors by searching the sorted masses per reaction
+        positions, reactions = _find_reaction_neighbors_fast(
+            state.mz_array[node_idx],
+            state.sorted_mz,
+            state.reaction_mz_diffs,
+            shared.delta_mz_threshold,
+        )
+        targets = state.mz_order[positions]
+        # a node is not its own neighbor, nor are other ions with its id
+        keep = (state.visited[targets] == 0) & (
+            state.id_codes[targets] != state.id_codes[node_idx]
+        )
+        targets, reactions = targets[keep], reactions[keep]
 
-        # Find potential neighbors based on mass differences using vectorized operations
-        for mz_diff, target_id in zip(
-            mass_differences, batch_data.id_array[unvisited_indices]
+        # by ion, and by reaction within an ion, as the products are listed
+        order = np.lexsort((reactions, targets))
+        target_indices, starts = np.unique(targets[order], return_index=True)
+        potential_neighbors: NeighborProductsMap = {}
+        for target_idx, matching_indices in zip(
+            target_indices, np.split(reactions[order], starts[1:])
         ):
-            if target_id in batch_data.visited_nodes:
-                continue
-
-            # Use the JIT-compiled function to find matching reactions
-            matching_indices = _find_matching_reactions_fast(
-                float(mz_diff),
-                batch_data.reaction_mz_diffs,
-                batch_data.reaction_indices,
-                batch_data.delta_mz_threshold,
-            )
-
-            if len(matching_indices) > 0:
-                products = []
-                for idx in matching_indices:
-                    products.append(batch_data.reactions[idx].product)
-                potential_neighbors[target_id] = products
+            potential_neighbors[state.ids[target_idx]] = [
+                shared.products[idx] for idx in matching_indices
+            ]
 
         # Validate neighbors using ModCos scores
-        if potential_neighbors and current_node in batch_data.spectrum_lookup:
-            source_spectrum = batch_data.spectrum_lookup[current_node]
+        if potential_neighbors and current_node in state.spectrum_lookup:
+            source_spectrum = state.spectrum_lookup[current_node]
             target_ids = list(potential_neighbors.keys())
             target_spectra = [
-                batch_data.spectrum_lookup[target_id]
+                state.spectrum_lookup[target_id]
                 for target_id in target_ids
-                if target_id in batch_data.spectrum_lookup
+                if target_id in state.spectrum_lookup
             ]
 
             for i, _ in calculate_modcos_scores(
                 source_spectrum,
                 target_spectra,
-                batch_data.modcos_threshold,
-                batch_data.tolerance,
+                shared.modcos_threshold,
+                shared.tolerance,
             ):
                 neighbor_id = target_ids[i]
-                if neighbor_id not in batch_data.visited_nodes:
-                    batch_neighbors.add(neighbor_id)
-                    neighbor_products[neighbor_id] = potential_neighbors[neighbor_id]
+                batch_neighbors.add(neighbor_id)
+                neighbor_products[neighbor_id] = potential_neighbors[neighbor_id]
 
         processed_nodes.add(current_node)
 
@@ -316,22 +410,25 @@ class RecursiveAnalyzer(BaseModel):
     id_array: np.ndarray = Field(default=None, exclude=True)
     batch_size: int = Field(default=1000, exclude=True)
     reactions: list[ReactionData] = Field(default_factory=list, exclude=True)
-    # New fields for mz difference matrix
-    mz_diff_matrix: np.ndarray = Field(default=None, exclude=True)
+    # ions in ascending m/z order, searched for the neighbors of a node
+    sorted_mz: np.ndarray = Field(default=None, exclude=True)
+    mz_order: np.ndarray = Field(default=None, exclude=True)
     id_to_index: dict[str, int] = Field(default_factory=dict, exclude=True)
     # New fields for reaction matching optimization
     reaction_mz_diffs: np.ndarray = Field(default=None, exclude=True)
-    reaction_indices: np.ndarray = Field(default=None, exclude=True)
+    # workers kept from the first layer on, with the arrays they map
+    _pool: Optional[ProcessPoolExecutor] = PrivateAttr(default=None)
+    _shared: dict[str, np.ndarray] = PrivateAttr(default_factory=dict)
 
     class Config:
         arbitrary_types_allowed = True
 
     def __init__(self, **data):
         super().__init__(**data)
-        self.reactions = reactions_data
+        self.reactions = load_reactions_data()
         self._build_spectrum_lookup()
         self._prepare_arrays()
-        self._build_mz_diff_matrix()
+        self._build_mz_index()
         self._prepare_reaction_arrays()
 
     def _prepare_arrays(self) -> None:
@@ -350,15 +447,60 @@ class RecursiveAnalyzer(BaseModel):
         self.reaction_mz_diffs = np.array(
             [r.mzdiff for r in self.reactions], dtype=np.float32
         )
-        self.reaction_indices = np.arange(len(self.reactions), dtype=np.int32)
 
-    def _build_mz_diff_matrix(self) -> None:
-        """Build a pre-computed mass difference matrix and id-to-index mapping."""
+    def _build_mz_index(self) -> None:
+        """Sort the ions by m/z and build the id-to-index mapping."""
         self.id_to_index = {id_: idx for idx, id_ in enumerate(self.id_array)}
-        self.mz_diff_matrix = _build_mz_diff_matrix_fast(self.mz_array)
+        self.mz_order = np.argsort(self.mz_array, kind="stable")
+        self.sorted_mz = self.mz_array[self.mz_order]
+
+    def _worker_pool(self) -> ProcessPoolExecutor:
+        """
+        The worker processes of the analyzer, started on first use.
+
+        Each worker maps the read-only arrays and unpacks the spectra once,
+        batches only carry node positions.
+        """
+        if self._pool is not None:
+            return self._pool
+
+        n = len(self.id_array)
+        spectra = pack_spectra(list(self.spectrum_lookup.values()))
+        self._shared = {
+            "sorted_mz": shared_copy(self.sorted_mz),
+            "mz_order": shared_copy(self.mz_order),
+            "id_array": shared_copy(self.id_array.astype(str)),
+            "visited": shared_zeros((n,), np.uint8),
+            "visited_version": shared_zeros((1,), np.int64),
+            "spectra": shared_copy(np.frombuffer(spectra, dtype=np.uint8)),
+            "reaction_mz_diffs": shared_copy(self.reaction_mz_diffs),
+        }
+        state = SharedState(
+            **{name: share(array) for name, array in self._shared.items()},
+            products=[reaction.product for reaction in self.reactions],
+            delta_mz_threshold=self.config.delta_mz_threshold,
+            modcos_threshold=self.config.modcos_threshold,
+            tolerance=self.config.tolerance,
+        )
+        # the platform's start method as before, scripts such as the app have
+        # no main guard for spawned workers to import them by
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.config.max_workers,
+            initializer=_init_worker,
+            initargs=(state,),
+        )
+        weakref.finalize(self, self._pool.shutdown, cancel_futures=True)
+        return self._pool
+
+    def close(self) -> None:
+        """Stop the workers, a later analysis starts new ones."""
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+            self._shared = {}
 
     def _get_mass_differences(self, node_id: str) -> tuple[np.ndarray, np.ndarray]:
-        """Get pre-computed mass differences for a given node ID.
+        """Get mass differences to all ions for a given node ID.
 
         Args:
             node_id: The ID of the node to get mass differences for
@@ -370,34 +512,36 @@ class RecursiveAnalyzer(BaseModel):
             return np.array([]), np.array([])
 
         node_idx = self.id_to_index[node_id]
-        return self.mz_diff_matrix[node_idx], self.id_array
+        return np.abs(self.mz_array - self.mz_array[node_idx]), self.id_array
 
     def _prepare_node_batches(
         self, nodes: list[NodeId], visited_nodes: set[NodeId]
-    ) -> list[tuple[NodeId, float, np.ndarray]]:
-        """Prepare batches of nodes for processing.
+    ) -> list[int]:
+        """Prepare the nodes of a layer for processing.
+
+        Marks `visited_nodes` in the mask the workers map, which must not be in
+        use by a running batch.
 
         Args:
             nodes: List of nodes to process
             visited_nodes: Set of already visited nodes
 
         Returns:
-            List of node batches with their mass and unvisited indices
+            Positions of the nodes that have unvisited ions left to compare with
         """
-        node_batches = []
-        for node_id in nodes:
-            if node_id not in self.id_to_index:
-                continue
-
-            node_idx = self.id_to_index[node_id]
-            current_mz = float(self.mz_array[node_idx])
-            unvisited_mask = ~np.isin(self.id_array, list(visited_nodes | {node_id}))
-            unvisited_indices = np.where(unvisited_mask)[0]
-
-            if len(unvisited_indices) > 0:
-                node_batches.append((node_id, current_mz, unvisited_indices))
-
-        return node_batches
+        visited = np.isin(self.id_array, list(visited_nodes))
+        self._shared["visited"][:] = visited
+        self._shared["visited_version"][0] += 1
+
+        # ions a node is compared with: the unvisited ones, but for its own id
+        unvisited = Counter(self.id_array[~visited].tolist())
+        unvisited_count = len(self.id_array) - int(visited.sum())
+        return [
+            self.id_to_index[node_id]
+            for node_id in nodes
+            if node_id in self.id_to_index
+            and unvisited_count - unvisited.get(node_id, 0) > 0
+        ]
 
     def _process_layer(
         self,
@@ -415,57 +559,44 @@ class RecursiveAnalyzer(BaseModel):
         Returns:
             Tuple of (new neighbors, products, processed nodes, neighbor products map)
         """
+        executor = self._worker_pool()
         current_layer_nodes = list(nodes_to_process.copy())
-        node_batches = self._prepare_node_batches(current_layer_nodes, visited_nodes)
+        node_indices = self._prepare_node_batches(current_layer_nodes, visited_nodes)
 
-        if not node_batches:
+        if not node_indices:
             return set(), [], set(), {}
 
         batch_size = max(
-            1, min(len(node_batches) // max_workers, self.config.batch_size)
+            1, min(len(node_indices) // max_workers, self.config.batch_size)
         )
+        version = int(self._shared["visited_version"][0])
 
         all_neighbors = set()
         all_products = []
         processed_nodes = set()
         neighbor_products_map: dict[NodeId, list[str]] = {}
 
-        with ProcessPoolExecutor(max_workers=self.config.max_workers) as executor:
-            futures = []
-            common_data = BatchData(
-                node_batch=[],  # Will be replaced for each batch
-                mz_array=self.mz_array,
-                id_array=self.id_array,
-                reactions=self.reactions,
-                delta_mz_threshold=self.config.delta_mz_threshold,
-                spectrum_lookup=self.spectrum_lookup,
-                modcos_threshold=self.config.modcos_threshold,
-                tolerance=self.config.tolerance,
-                visited_nodes=visited_nodes.copy(),
-                mz_diff_matrix=self.mz_diff_matrix,
-                id_to_index=self.id_to_index,
-                reaction_mz_diffs=self.reaction_mz_diffs,
-                reaction_indices=self.reaction_indices,
+        futures = [
+            executor.submit(
+                process_node_batch,
+                NodeBatch(np.array(node_indices[i : i + batch_size]), version),
             )
-
-            for i in range(0, len(node_batches), batch_size):
-                batch = node_batches[i : i + batch_size]
-                batch_data = common_data._replace(node_batch=batch)
-                futures.append(executor.submit(process_node_batch, batch_data))
-
-            for future in as_completed(futures):
-                result = future.result()
-                valid_neighbors = result.new_neighbors - visited_nodes
-                all_neighbors.update(valid_neighbors)
-                processed_nodes.update(result.processed_nodes)
-
-                # Update neighbor_products_map with products from this batch
-                for neighbor_id, products in result.neighbor_products.items():
-                    if neighbor_id in valid_neighbors:
-                        if neighbor_id not in neighbor_products_map:
-                            neighbor_products_map[neighbor_id] = []
-                        neighbor_products_map[neighbor_id].extend(products)
-                        all_products.extend(products)
+            for i in range(0, len(node_indices), batch_size)
+        ]
+
+        for future in as_completed(futures):
+            result = future.result()
+            valid_neighbors = result.new_neighbors - visited_nodes
+            all_neighbors.update(valid_neighbors)
+            processed_nodes.update(result.processed_nodes)
+
+            # Update neighbor_products_map with products from this batch
+            for neighbor_id, products in result.neighbor_products.items():
+                if neighbor_id in valid_neighbors:
+                    if neighbor_id not in neighbor_products_map:
+                        neighbor_products_map[neighbor_id] = []
+                    neighbor_products_map[neighbor_id].extend(products)
+                    all_products.extend(products)
 
         # Deduplicate products for each neighbor
         for neighbor_id in neighbor_products_map:
@@ -0,0 +1,179 @@
+import asyncio
+import json
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+from core.distributed import MapExecutor
+from core.planner import (
+    DataProfile,
+    ExecutionPlan,
+    SimilarityEngine,
+    plan_shared_similarity,
+)
+from core.utils.logger import logger
+from core.utils.memory import MemoryBudget
+from matchms.Spectrum import Spectrum
+from scipy.sparse import coo_matrix
+
+
+def _slice(matrix: coo_matrix, union_ids: np.ndarray, ids: np.ndarray) -> coo_matrix:
+    """Restrict a matrix over `union_ids` to the rows and columns of `ids`."""
+    # the last duplicate wins, as in create_similarity_matrix
+    index = pd.Series(np.arange(len(ids)), index=ids)
+    index = index[~index.index.duplicated(keep="last")]
+    positions = index.reindex(union_ids).fillna(-1).values.astype(np.intp)
+    rows, cols = positions[matrix.row], positions[matrix.col]
+    keep = (rows >= 0) & (cols >= 0)
+    return coo_matrix(
+        (matrix.data[keep], (rows[keep], cols[keep])), shape=(len(ids), len(ids))
+    )
+
+
+def _union_candidates(
+    members: Iterable[tuple[np.ndarray, coo_matrix]], union_ids: np.ndarray
+) -> coo_matrix:
+    """The candidate pairs of all members, over `union_ids`."""
+    rows, cols = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+    for ids, candidates in members:
+        candidates = candidates.tocoo()
+        positions = np.searchsorted(union_ids, ids)
+        rows.append(positions[candidates.row])
+        cols.append(positions[candidates.col])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return coo_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(len(union_ids), len(union_ids))
+    )
+
+
+def _profile(
+    spectra: list[Spectrum], ids: np.ndarray, candidates: coo_matrix
+) -> DataProfile:
+    """What scoring the candidate pairs of `ids` costs, counted, not estimated."""
+    from core.steps.create_similarity_matrix import _candidate_pairs, _ion_spectra
+
+    ion_spectra, indices = _ion_spectra(spectra, ids)
+    pairs = len(_candidate_pairs(candidates, indices, len(ids))[0])
+    spectrum_pairs = len(ion_spectra) * (len(ion_spectra) + 1) / 2
+    return DataProfile(
+        ions=len(ids),
+        spectra=len(ion_spectra),
+        reactions=0,
+        candidate_density=pairs / spectrum_pairs if spectrum_pairs else 0.0,
+        mean_peaks=float(np.mean([len(s.peaks) for s in ion_spectra]))
+        if ion_spectra
+        else 0.0,
+    )
+
+
+class SharedSpectra:
+    """
+    Spectra of one MGF file shared by a batch of analyses.
+
+    The similarity of two spectra does not depend on the other ions, so the
+    candidate pairs of all members are scored once and each member gets its
+    own slice. Pairs that are not candidates of a member cannot become its
+    edges, so the slice gives the member the same edges as a run of its own.
+    The shared job is planned like any other, and skipped when the members
+    have too few pairs in common for it to be cheaper than separate runs.
+
+    The computation starts once every member has either asked for its matrix
+    or left, e.g. because it failed or restored the matrix from a checkpoint.
+    """
+
+    def __init__(
+        self,
+        spectra: list[Spectrum],
+        members: Iterable[str],
+        memory_budget: MemoryBudget | None = None,
+    ):
+        self.spectra = spectra
+        self.memory_budget = memory_budget
+        self._pending = set(members)
+        self._members: dict[str, tuple[np.ndarray, coo_matrix]] = {}
+        self._started = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def leave(self, member: str) -> None:
+        self._pending.discard(member)
+        if not self._pending and self._members and self._task is None:
+            self._task = asyncio.create_task(self._compute())
+            self._started.set()
+
+    def _plan(self) -> tuple[np.ndarray, coo_matrix, ExecutionPlan | None]:
+        union_ids = np.unique(
+            np.concatenate([ids for ids, _ in self._members.values()])
+        )
+        candidates = _union_candidates(self._members.values(), union_ids)
+        plan = plan_shared_similarity(
+            _profile(self.spectra, union_ids, candidates),
+            [
+                _profile(self.spectra, ids, member_candidates)
+                for ids, member_candidates in self._members.values()
+            ],
+            memory_limit=self.memory_budget.limit_bytes if self.memory_budget else None,
+        )
+        if plan is None:
+            logger.info("shared similarity skipped, separate runs are cheaper")
+        else:
+            logger.info("shared similarity plan %s", json.dumps(plan.summary()))
+        return union_ids, candidates, plan
+
+    async def _compute(self) -> tuple[np.ndarray, coo_matrix] | None:
+        from core.steps import create_similarity_matrix
+
+        union_ids, candidates, plan = await asyncio.to_thread(self._plan)
+        if plan is None:
+            return None
+        matrix = await asyncio.to_thread(
+            asyncio.run,
+            create_similarity_matrix(
+                spectra=self.spectra,
+                ids=union_ids,
+                engine=plan.similarity,
+                candidates=candidates,
+                workers=plan.workers,
+            ),
+        )
+        return union_ids, matrix
+
+    async def create_similarity_matrix(
+        self,
+        spectra: list[Spectrum],
+        ids: np.ndarray,
+        member: str,
+        engine: SimilarityEngine = SimilarityEngine.EXACT,
+        candidates: coo_matrix | None = None,
+        workers: int = 1,
+        distributed: bool = False,
+        executor: MapExecutor | None = None,
+    ) -> coo_matrix:
+        """Stands in for the step of the same name for a member of the batch."""
+        from core.steps import create_similarity_matrix
+
+        def own() -> coo_matrix:
+            return asyncio.run(
+                create_similarity_matrix(
+                    spectra=spectra,
+                    ids=ids,
+                    engine=engine,
+                    candidates=candidates,
+                    workers=workers,
+                    distributed=distributed,
+                    executor=executor,
+                )
+            )
+
+        if engine is SimilarityEngine.APPROXIMATE or distributed or candidates is None:
+            # scored otherwise or elsewhere, there is nothing to share
+            self.leave(member)
+            return await asyncio.to_thread(own)
+
+        self._members[member] = (ids, candidates)
+        self.leave(member)
+        await self._started.wait()
+        shared = await self._task
+        if shared is None:
+            return await asyncio.to_thread(own)
+        union_ids, matrix = shared
+        return _slice(matrix, union_ids, ids)
@@ -3,7 +3,9 @@ from .combine_matrices_and_extract_edges import combine_matrices_and_extract_edg
 from .create_ion_interaction_matrix import create_ion_interaction_matrix
 from .create_similarity_matrix import create_similarity_matrix
 from .edge_value_matching import edge_value_matching
+from .filter_edges import filter_edges
 from .load_data import load_data
+from .plan_execution import plan_execution
 from .postprocessing import postprocessing
 from .upload_result import upload_result
 
@@ -11,9 +13,11 @@ __all__ = [
     "calculate_edge_metrics",
     "combine_matrices_and_extract_edges",
     "edge_value_matching",
+    "filter_edges",
     "create_similarity_matrix",
     "create_ion_interaction_matrix",
     "load_data",
+    "plan_execution",
     "upload_result",
     "postprocessing",
 ]
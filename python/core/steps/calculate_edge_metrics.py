@@ -1,7 +1,55 @@
+import numpy as np
 import pandas as pd
 from core.utils.constants import EdgeColumn, TargetIonsColumn
 from core.utils.logger import log
-from scipy.spatial.distance import cosine
+from core.utils.memory import MemoryBudget
+from core.utils.progress import current_progress
+
+# edges are processed in chunks to bound the gathered sample rows
+EDGE_CHUNK_SIZE = 1 << 16
+
+
+def _zeros(shape: tuple[int, ...], memory_budget: MemoryBudget | None) -> np.ndarray:
+    if memory_budget is None:
+        return np.zeros(shape)
+    return memory_budget.zeros(shape, np.float64)
+
+
+def _sample_matrix(
+    samples_df: pd.DataFrame, index: pd.Index, memory_budget: MemoryBudget | None
+) -> np.ndarray:
+    """Intensities of the ions of `index` over all samples, as float64."""
+    selected = samples_df.loc[index]
+    if memory_budget is None:
+        return selected.values.astype(np.float64)
+    # converted one column at a time, so that no float64 copy is held besides
+    # the result, which is spilled when it exceeds the budget
+    samples = memory_budget.zeros(selected.shape, np.float64)
+    for position, (_, column) in enumerate(selected.items()):
+        samples[:, position] = column.to_numpy(np.float64)
+    return samples
+
+
+def _cosine_similarity(
+    samples: np.ndarray,
+    source: np.ndarray,
+    target: np.ndarray,
+    memory_budget: MemoryBudget | None = None,
+) -> np.ndarray:
+    """Row-wise cosine similarity of `samples[source]` and `samples[target]`."""
+    norms = np.linalg.norm(samples, axis=1)
+    similarity = _zeros((len(source),), memory_budget)
+    progress = current_progress()
+    progress.set("edgesTotal", len(source))
+    for start in range(0, len(source), EDGE_CHUNK_SIZE):
+        s = source[start : start + EDGE_CHUNK_SIZE]
+        t = target[start : start + EDGE_CHUNK_SIZE]
+        dot = np.einsum("ij,ij->i", samples[s], samples[t])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarity[start : start + len(s)] = dot / (norms[s] * norms[t])
+        progress.add("edgesMeasured", len(s))
+    # same bounds as scipy's cosine distance, rounding can step outside [0, 2]
+    return 1 - np.clip(1 - similarity, 0.0, 2.0)
 
 
 @log("Calculating edge metrics")
@@ -9,43 +57,33 @@ async def calculate_edge_metrics(
     samples_df: pd.DataFrame,
     targeted_ions_df: pd.DataFrame,
     edge_data_df: pd.DataFrame,
+    memory_budget: MemoryBudget | None = None,
 ) -> pd.DataFrame:
-    # Pre-calculate and map ID to mz and rt values for efficient lookup
-    id_to_mz_rt = targeted_ions_df.set_index(TargetIonsColumn.ID)[
-        [TargetIonsColumn.MZ, TargetIonsColumn.RT]
-    ].to_dict("index")
-
-    def calculate_metrics(row):
-        source, target = row[EdgeColumn.ID1], row[EdgeColumn.ID2]
-        if source not in id_to_mz_rt or target not in id_to_mz_rt:
-            return None, None, None
-
-        source_mz, source_rt = (
-            id_to_mz_rt[source][TargetIonsColumn.MZ],
-            id_to_mz_rt[source][TargetIonsColumn.RT],
-        )
-        target_mz, target_rt = (
-            id_to_mz_rt[target][TargetIonsColumn.MZ],
-            id_to_mz_rt[target][TargetIonsColumn.RT],
-        )
-
-        mz_difference = abs(source_mz - target_mz)
-        rt_difference = abs(source_rt - target_rt)
-
-        source_data = samples_df.loc[
-            targeted_ions_df[TargetIonsColumn.ID] == source, :
-        ].values[0]
-        target_data = samples_df.loc[
-            targeted_ions_df[TargetIonsColumn.ID] == target, :
-        ].values[0]
-
-        # Calculate the cosine similarity between the two IDs
-        correlation = 1 - cosine(source_data, target_data)
-
-        return correlation, rt_difference, mz_difference
-
-    edge_data_df[[EdgeColumn.CORRELATION, EdgeColumn.RT_DIFF, EdgeColumn.MZ_DIFF]] = (
-        edge_data_df.apply(calculate_metrics, axis=1, result_type="expand")
+    # Map ID to its first row so that all edges are looked up at once
+    positions = pd.Series(
+        np.arange(len(targeted_ions_df)), index=targeted_ions_df[TargetIonsColumn.ID]
     )
+    positions = positions[~positions.index.duplicated()]
+    source = positions.reindex(edge_data_df[EdgeColumn.ID1].values).values
+    target = positions.reindex(edge_data_df[EdgeColumn.ID2].values).values
+    # edges with an unknown ion get no metrics
+    known = ~(np.isnan(source) | np.isnan(target))
+    source, target = source[known].astype(np.intp), target[known].astype(np.intp)
+
+    mz = targeted_ions_df[TargetIonsColumn.MZ].values.astype(np.float64)
+    rt = targeted_ions_df[TargetIonsColumn.RT].values.astype(np.float64)
+    samples = _sample_matrix(samples_df, targeted_ions_df.index, memory_budget)
 
-    return edge_data_df
+    metrics = _zeros((len(edge_data_df), 3), memory_budget)
+    metrics[...] = np.nan
+    metrics[known, 0] = _cosine_similarity(samples, source, target, memory_budget)
+    metrics[known, 1] = np.abs(rt[source] - rt[target])
+    metrics[known, 2] = np.abs(mz[source] - mz[target])
+
+    return edge_data_df.assign(
+        **{
+            EdgeColumn.CORRELATION: metrics[:, 0],
+            EdgeColumn.RT_DIFF: metrics[:, 1],
+            EdgeColumn.MZ_DIFF: metrics[:, 2],
+        }
+    )
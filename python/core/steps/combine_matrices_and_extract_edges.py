@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 from core.utils.constants import EdgeColumn
 from core.utils.logger import log
+from core.utils.progress import current_progress
 from scipy.sparse import coo_matrix
 
 
@@ -28,5 +29,6 @@ async def combine_matrices_and_extract_edges(
             EdgeColumn.VALUE: data[valid_indices],
         }
     )
+    current_progress().add("edgesEmitted", len(edge_data))
 
     return edge_data
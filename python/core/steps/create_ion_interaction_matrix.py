@@ -1,17 +1,36 @@
 import numpy as np
 import pandas as pd
+from core.planner import InteractionEngine
 from core.utils.constants import ReactionColumn, TargetIonsColumn
 from core.utils.logger import log
+from core.utils.progress import current_progress
 from numba import jit
 from scipy.sparse import coo_matrix
 
+# ions whose pairs are found per kernel call, progress is reported in between
+ION_BLOCK_SIZE = 4096
 
-@jit(nopython=True)
-def _calculate_adj_matrix(ion_mass_values, theoretical_mz_diffs, mz_error_threshold):
+
+@jit(nopython=True, nogil=True, cache=True)
+def _grow(array):
+    grown = np.empty(2 * len(array), dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+# nogil lets the kernel overlap with other steps running in worker threads
+@jit(nopython=True, nogil=True, cache=True)
+def _calculate_adj_pairs(
+    ion_mass_values, theoretical_mz_diffs, mz_error_threshold, start, stop
+):
+    # only the interacting pairs (i <= j) are kept, a dense n x n matrix is what
+    # ran the largest alignments out of memory. Pairs of ions i in [start, stop)
     ion_count = len(ion_mass_values)
-    adj_matrix = np.zeros((ion_count, ion_count), dtype=np.float32)
+    rows = np.empty(max(stop - start, 1), dtype=np.int32)
+    cols = np.empty(max(stop - start, 1), dtype=np.int32)
+    pair_count = 0
 
-    for i in range(ion_count):
+    for i in range(start, stop):
         for j in range(i, ion_count):  # Optimize by considering only unique pairs
             mz_difference = np.abs(ion_mass_values[i] - ion_mass_values[j])
             # Find the nearest mass difference from sorted_mass_diffs
@@ -29,11 +48,91 @@ def _calculate_adj_matrix(ion_mass_values, theoretical_mz_diffs, mz_error_thresh
                     else left
                 )
 
-            # Apply threshold and populate symmetric matrix
+            # Apply threshold and record the pair
             if abs(mz_difference - nearest_diff) < mz_error_threshold:
-                adj_matrix[i, j] = adj_matrix[j, i] = 1
+                if pair_count == len(rows):
+                    rows, cols = _grow(rows), _grow(cols)
+                rows[pair_count], cols[pair_count] = i, j
+                pair_count += 1
+
+    return rows[:pair_count], cols[:pair_count]
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def _sweep_adj_pairs(
+    sorted_masses, order, theoretical_mz_diffs, mz_error_threshold, start, stop
+):
+    # Same pairs as `_calculate_adj_pairs`, but each ion is only compared to the
+    # ions around its mass plus every theoretical difference, found by binary
+    # search over the masses sorted by `order`. O(n * reactions * log n) instead
+    # of O(n^2). Pairs of the sorted ions p in [start, stop)
+    rows = np.empty(max(stop - start, 1), dtype=np.int32)
+    cols = np.empty(max(stop - start, 1), dtype=np.int32)
+    pair_count = 0
+
+    for p in range(start, stop):
+        # theoretical differences are ascending, so are their windows; starting
+        # each window past the last recorded ion keeps pairs unique
+        next_q = p
+        for diff in theoretical_mz_diffs:
+            # the window is twice as wide as needed, pairs are checked exactly below
+            low = sorted_masses[p] + diff - 2 * mz_error_threshold
+            high = sorted_masses[p] + diff + 2 * mz_error_threshold
+            q = max(next_q, np.searchsorted(sorted_masses, low, side="left"))
+            end = np.searchsorted(sorted_masses, high, side="right")
+            while q < end:
+                mz_difference = np.abs(sorted_masses[p] - sorted_masses[q])
+                if abs(mz_difference - diff) < mz_error_threshold:
+                    if pair_count == len(rows):
+                        rows, cols = _grow(rows), _grow(cols)
+                    rows[pair_count], cols[pair_count] = order[p], order[q]
+                    pair_count += 1
+                    next_q = q + 1
+                q += 1
+
+    return rows[:pair_count], cols[:pair_count]
 
-    return adj_matrix
+
+def _interacting_pairs(
+    ion_mass_values: np.ndarray,
+    theoretical_mz_diffs: np.ndarray,
+    mz_error_threshold: float,
+    engine: InteractionEngine,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Interacting pairs, found one block of ions at a time to report progress."""
+    ion_count = len(ion_mass_values)
+    progress = current_progress()
+    progress.set("ionsTotal", ion_count)
+    if engine is InteractionEngine.SWEEP:
+        order = np.argsort(ion_mass_values, kind="mergesort")
+        sorted_masses = ion_mass_values[order]
+
+    blocks = []
+    for start in range(0, ion_count, ION_BLOCK_SIZE):
+        stop = min(start + ION_BLOCK_SIZE, ion_count)
+        if engine is InteractionEngine.SWEEP:
+            block = _sweep_adj_pairs(
+                sorted_masses,
+                order,
+                theoretical_mz_diffs,
+                mz_error_threshold,
+                start,
+                stop,
+            )
+        else:
+            block = _calculate_adj_pairs(
+                ion_mass_values, theoretical_mz_diffs, mz_error_threshold, start, stop
+            )
+        blocks.append(block)
+        progress.add("pairsFound", len(block[0]))
+        progress.add("ionsMatched", stop - start)
+
+    if not blocks:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    return (
+        np.concatenate([rows for rows, _ in blocks]),
+        np.concatenate([cols for _, cols in blocks]),
+    )
 
 
 @log("Creating ion interaction matrix")
@@ -41,14 +140,24 @@ async def create_ion_interaction_matrix(
     targeted_ions_df: pd.DataFrame,
     reaction_df: pd.DataFrame,
     mz_error_threshold: float = 0.01,
+    engine: InteractionEngine = InteractionEngine.PAIRWISE,
 ) -> coo_matrix:
     ion_mass_values = targeted_ions_df[TargetIonsColumn.MZ].values
     theoretical_mz_diffs = np.sort(reaction_df[ReactionColumn.MZ_DIFF].values)
 
-    # Calculate the ppm difference matrix using the optimized Numba function
-    adj_matrix = _calculate_adj_matrix(
-        ion_mass_values, theoretical_mz_diffs, mz_error_threshold
+    # Find the interacting pairs using the optimized Numba function
+    rows, cols = _interacting_pairs(
+        ion_mass_values, theoretical_mz_diffs, mz_error_threshold, engine
     )
 
-    # Construct the interaction matrix
-    return coo_matrix(adj_matrix, dtype=np.int8)
+    # Construct the symmetric interaction matrix, mirroring the off-diagonal pairs
+    off_diagonal = rows != cols
+    rows, cols = (
+        np.concatenate([rows, cols[off_diagonal]]),
+        np.concatenate([cols, rows[off_diagonal]]),
+    )
+    ion_count = len(ion_mass_values)
+    return coo_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, cols)),
+        shape=(ion_count, ion_count),
+    )
@@ -1,20 +1,34 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
 import numpy as np
+from core.distributed import MapExecutor
+from core.planner import SimilarityEngine
 from core.utils.constants import SCANS_KEY
 from core.utils.logger import log
+from core.utils.progress import current_progress
 from matchms import Scores, calculate_scores
 from matchms.similarity import ModifiedCosine
 from matchms.Spectrum import Spectrum
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 
 # Constants
 SCORE_KEY = "ModifiedCosine_score"
 TOLERANCE = 0.005
+# peaks closer than the tolerance mostly share a bin of the approximate engine
+APPROXIMATE_BIN_WIDTH = 2 * TOLERANCE
+# pairs scored at once, bounds the rows gathered by the approximate engine
+PAIR_CHUNK_SIZE = 1 << 16
+# pairs per block scored in another container, about a minute of work
+FANOUT_BLOCK_PAIRS = 1 << 20
 
 
-@log("Creating similarity matrix")
-async def create_similarity_matrix(
+def _ion_spectra(
     spectra: list[Spectrum], ids: np.ndarray
-) -> coo_matrix:
+) -> tuple[list[Spectrum], np.ndarray]:
+    """The spectra of the ions of `ids`, and the index of their ion in `ids`."""
     id_to_index = {id_: index for index, id_ in enumerate(ids)}
     # Filter spectra and map to indices based on IDs
     filtered_spectra, filtered_indices = [], []
@@ -23,21 +37,252 @@ async def create_similarity_matrix(
         if spectrum_id in id_to_index:
             filtered_spectra.append(spectrum)
             filtered_indices.append(id_to_index[spectrum_id])
+    return filtered_spectra, np.array(filtered_indices, dtype=np.intp)
+
+
+def _candidate_pairs(
+    candidates: coo_matrix, indices: np.ndarray, ion_count: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Pairs (a <= b) of spectra whose ions are candidate edges."""
+    membership = csr_matrix(
+        (np.ones(len(indices)), (indices, np.arange(len(indices)))),
+        shape=(ion_count, len(indices)),
+    )
+    pairs = (membership.T @ candidates.tocsr() @ membership).tocoo()
+    upper = pairs.row <= pairs.col
+    return pairs.row[upper], pairs.col[upper]
+
+
+def _score_pairs(
+    spectra: list[Spectrum], rows: np.ndarray, cols: np.ndarray
+) -> np.ndarray:
+    # rows <= cols, the orientation matchms scores a symmetric matrix in
+    scores = ModifiedCosine(tolerance=TOLERANCE).sparse_array(
+        spectra, spectra, rows, cols
+    )
+    return scores["score"]
+
+
+def _pair_chunk(
+    spectra: list[Spectrum], rows: np.ndarray, cols: np.ndarray
+) -> tuple[list[Spectrum], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The spectra of some pairs, the pairs as positions among them, and the
+    positions of those spectra in `spectra`.
+    """
+    # sorted, so rows <= cols still holds for the positions in the chunk
+    used, inverse = np.unique(np.concatenate([rows, cols]), return_inverse=True)
+    return [spectra[i] for i in used], inverse[: len(rows)], inverse[len(rows) :], used
+
+
+def _score_pairs_parallel(
+    spectra: list[Spectrum], rows: np.ndarray, cols: np.ndarray, workers: int
+) -> np.ndarray:
+    progress = current_progress()
+    # sliced here, so that only the spectra of a chunk are sent to its worker
+    chunks = (
+        _pair_chunk(
+            spectra,
+            rows[start : start + PAIR_CHUNK_SIZE],
+            cols[start : start + PAIR_CHUNK_SIZE],
+        )
+        for start in range(0, len(rows), PAIR_CHUNK_SIZE)
+    )
+    if workers <= 1 or len(rows) <= PAIR_CHUNK_SIZE:
+        scores = []
+        # chunked all the same, so that progress is reported in between
+        for chunk_spectra, r, c, _ in chunks:
+            scores.append(_score_pairs(chunk_spectra, r, c))
+            progress.add("pairsScored", len(r))
+        return np.concatenate(scores) if scores else np.zeros(0)
+    # spawned rather than forked, the pipeline runs steps in threads
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(_score_pairs, chunk_spectra, r, c)
+            for chunk_spectra, r, c, _ in chunks
+        ]
+        scores = []
+        for future in futures:
+            scores.append(future.result())
+            progress.add("pairsScored", len(scores[-1]))
+        return np.concatenate(scores)
+
+
+@dataclass
+class SimilarityBlock:
+    """Pairs scored in another container, sent with only the spectra they need."""
+
+    spectra: list[Spectrum]
+    # the pairs, as positions in `spectra`
+    rows: np.ndarray
+    cols: np.ndarray
+    # positions of `spectra` among the `total` spectra of the step
+    positions: np.ndarray
+    total: int
+
+
+def _similarity_blocks(
+    spectra: list[Spectrum], rows: np.ndarray, cols: np.ndarray, parallelism: int
+) -> Iterator[SimilarityBlock]:
+    """At least `parallelism` blocks of at most `FANOUT_BLOCK_PAIRS` pairs each."""
+    size = max(1, min(FANOUT_BLOCK_PAIRS, -(-len(rows) // max(parallelism, 1))))
+    for start in range(0, len(rows), size):
+        chunk = _pair_chunk(
+            spectra, rows[start : start + size], cols[start : start + size]
+        )
+        yield SimilarityBlock(*chunk, total=len(spectra))
+
 
-    similarity_measure = ModifiedCosine(tolerance=TOLERANCE)
-    cosine_scores: Scores = calculate_scores(
-        filtered_spectra,
-        filtered_spectra,
-        similarity_measure,
-        is_symmetric=True,
+def _score_block(block: SimilarityBlock) -> coo_matrix:
+    """Scores of a block, as a sparse partial over all the spectra of the step."""
+    scores = _score_pairs(block.spectra, block.rows, block.cols)
+    return coo_matrix(
+        (scores, (block.positions[block.rows], block.positions[block.cols])),
+        shape=(block.total, block.total),
     )
 
-    filtered_indices_array = np.array(filtered_indices)
-    rows = filtered_indices_array[cosine_scores.scores.row]
-    cols = filtered_indices_array[cosine_scores.scores.col]
 
-    similarity_matrix = coo_matrix(
-        (cosine_scores.scores.data[SCORE_KEY], (rows, cols)), shape=(len(ids), len(ids))
+def _merge_partials(partials: Iterable[coo_matrix], total: int) -> coo_matrix:
+    """
+    Concatenate the partial matrices of disjoint blocks.
+
+    Entries keep the order of the blocks, so that merging the blocks of a
+    pair list gives back its scores in the order of the list.
+    """
+    partials = list(partials)
+    if not partials:
+        return coo_matrix((total, total))
+    return coo_matrix(
+        (
+            np.concatenate([p.data for p in partials]),
+            (
+                np.concatenate([p.row for p in partials]),
+                np.concatenate([p.col for p in partials]),
+            ),
+        ),
+        shape=(total, total),
     )
 
+
+def _score_pairs_distributed(
+    spectra: list[Spectrum], rows: np.ndarray, cols: np.ndarray, executor: MapExecutor
+) -> coo_matrix:
+    progress = current_progress()
+
+    def scored() -> Iterator[coo_matrix]:
+        blocks = _similarity_blocks(spectra, rows, cols, executor.parallelism)
+        for partial in executor.map(_score_block, blocks):
+            progress.add("pairsScored", len(partial.data))
+            yield partial
+
+    return _merge_partials(scored(), len(spectra))
+
+
+def _binned(spectra: list[Spectrum], neutral_losses: bool) -> csr_matrix:
+    """Unit length intensity vectors of the spectra over m/z (or loss) bins."""
+    rows, bins, intensities = [], [], []
+    for i, spectrum in enumerate(spectra):
+        mz, intensity = spectrum.peaks.mz, spectrum.peaks.intensities
+        if neutral_losses:
+            mz = float(spectrum.get("precursor_mz")) - mz
+            intensity = intensity[mz > 0]
+            mz = mz[mz > 0]
+        rows.append(np.full(len(mz), i))
+        bins.append((mz / APPROXIMATE_BIN_WIDTH).astype(np.int64))
+        intensities.append(intensity)
+
+    bins = np.concatenate(bins) if bins else np.zeros(0, dtype=np.int64)
+    matrix = csr_matrix(
+        (
+            np.concatenate(intensities) if intensities else np.zeros(0),
+            (np.concatenate(rows) if rows else np.zeros(0, dtype=int), bins),
+        ),
+        shape=(len(spectra), int(bins.max()) + 1 if len(bins) else 1),
+    )
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return csr_matrix(matrix.multiply(1 / norms[:, None]))
+
+
+def _approximate_scores(
+    spectra: list[Spectrum], rows: np.ndarray, cols: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized stand-in for the modified cosine.
+
+    Peaks matching without a shift share fragment bins and peaks matching with
+    the precursor shift share neutral loss bins. The greater of both cosines
+    is taken, which errs towards missing edges rather than adding false ones.
+    """
+    progress = current_progress()
+    scores = np.zeros(len(rows))
+    binned = (_binned(spectra, False), _binned(spectra, True))
+    for start in range(0, len(rows), PAIR_CHUNK_SIZE):
+        r = rows[start : start + PAIR_CHUNK_SIZE]
+        c = cols[start : start + PAIR_CHUNK_SIZE]
+        for vectors in binned:
+            dot = np.asarray(vectors[r].multiply(vectors[c]).sum(axis=1)).ravel()
+            scores[start : start + len(r)] = np.maximum(
+                scores[start : start + len(r)], dot
+            )
+        progress.add("pairsScored", len(r))
+    return np.minimum(scores, 1.0)
+
+
+@log("Creating similarity matrix")
+async def create_similarity_matrix(
+    spectra: list[Spectrum],
+    ids: np.ndarray,
+    engine: SimilarityEngine = SimilarityEngine.EXACT,
+    candidates: coo_matrix | None = None,
+    workers: int = 1,
+    distributed: bool = False,
+    executor: MapExecutor | None = None,
+) -> coo_matrix:
+    """
+    Modified cosine similarity of the spectra of the ions.
+
+    The exact engine scores every pair of spectra. Only ion pairs that interact
+    can become edges though, so the candidates and approximate engines only
+    score the pairs of `candidates`, the ion interaction matrix. When
+    `distributed`, the candidates engine scores blocks of them on `executor`.
+    """
+    filtered_spectra, filtered_indices_array = _ion_spectra(spectra, ids)
+    progress = current_progress()
+    if engine is SimilarityEngine.EXACT or candidates is None:
+        # scored by matchms in one call, only the total and the end are known
+        pair_count = len(filtered_spectra) * (len(filtered_spectra) + 1) // 2
+        progress.set("pairsTotal", pair_count)
+        similarity_measure = ModifiedCosine(tolerance=TOLERANCE)
+        cosine_scores: Scores = calculate_scores(
+            filtered_spectra,
+            filtered_spectra,
+            similarity_measure,
+            is_symmetric=True,
+        )
+
+        rows = filtered_indices_array[cosine_scores.scores.row]
+        cols = filtered_indices_array[cosine_scores.scores.col]
+        scores = cosine_scores.scores.data[SCORE_KEY]
+        progress.add("pairsScored", pair_count)
+    else:
+        a, b = _candidate_pairs(candidates, filtered_indices_array, len(ids))
+        progress.set("pairsTotal", len(a))
+        if engine is SimilarityEngine.APPROXIMATE:
+            pair_scores = _approximate_scores(filtered_spectra, a, b)
+        elif distributed and executor is not None:
+            merged = _score_pairs_distributed(filtered_spectra, a, b, executor)
+            a, b, pair_scores = merged.row, merged.col, merged.data
+        else:
+            pair_scores = _score_pairs_parallel(filtered_spectra, a, b, workers)
+        # both orientations, like the symmetric matrix of the exact engine
+        off_diagonal = a != b
+        rows = filtered_indices_array[np.concatenate([a, b[off_diagonal]])]
+        cols = filtered_indices_array[np.concatenate([b, a[off_diagonal]])]
+        scores = np.concatenate([pair_scores, pair_scores[off_diagonal]])
+
+    similarity_matrix = coo_matrix((scores, (rows, cols)), shape=(len(ids), len(ids)))
+
     return similarity_matrix
@@ -0,0 +1,20 @@
+import pandas as pd
+from core.utils.constants import EdgeColumn
+from core.utils.logger import log
+
+
+@log("Filtering edges")
+async def filter_edges(
+    edges: pd.DataFrame,
+    ms2_similarity_threshold: float = 0.7,
+) -> pd.DataFrame:
+    """
+    Narrow candidate edges down to the configured MS2 similarity threshold.
+
+    Candidates are extracted once at the loosest threshold the frontend allows,
+    so a re-analysis with a stricter one only has to filter them again.
+    """
+    # the edge value is 1 for the ion interaction plus the MS2 similarity
+    edges = edges[edges[EdgeColumn.VALUE] > 1 + ms2_similarity_threshold]
+    # an owned frame, later steps add columns to it
+    return edges.copy()
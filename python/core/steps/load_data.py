@@ -1,17 +1,20 @@
 import asyncio
 from typing import Literal
 
+import numpy as np
 import pandas as pd
+from core.artifacts import ArtifactStore, cached, content_key
 from core.models.analysis import (
-    Analysis,
     BioSample,
     DrugSample,
     IonMode,
+    RawFile,
     ReactionDatabase,
 )
-from core.utils.constants import DEFAULT_NEG_DF, DEFAULT_POS_DF, TargetIonsColumn
+from core.utils.constants import TargetIonsColumn, default_reactions
 from core.utils.convex import load_mgf, load_parquet
 from core.utils.logger import log
+from core.utils.memory import downcast
 from matchms.Spectrum import Spectrum
 
 from convex import ConvexClient
@@ -22,16 +25,16 @@ async def _load_reaction_db(
 ) -> pd.DataFrame:
     if reaction_db.startswith("default"):
         if reaction_db == "default-pos":
-            return DEFAULT_POS_DF
+            return default_reactions("pos")
         elif reaction_db == "default-neg":
-            return DEFAULT_NEG_DF
+            return default_reactions("neg")
         else:
             raise ValueError(f"Unknown reaction database: {reaction_db}")
     else:
         if reaction_db.ionMode is IonMode.POS:
-            default_reaction_df = DEFAULT_POS_DF
+            default_reaction_df = default_reactions("pos")
         elif reaction_db.ionMode is IonMode.NEG:
-            default_reaction_df = DEFAULT_NEG_DF
+            default_reaction_df = default_reactions("neg")
         else:
             raise ValueError(f"Unknown ion mode: {reaction_db.ionMode}")
 
@@ -45,6 +48,72 @@ async def _load_reaction_db(
         return reaction_df
 
 
+def _parquet_column(level: str, name: str) -> str:
+    # pandas stores MultiIndex columns in parquet under their stringified tuple
+    return str((level, name))
+
+
+def _referenced_columns(names: list[str]) -> list[str]:
+    # The annotation columns are never used past this step, but every sample
+    # column is: the edge correlation is computed over all of them, not only
+    # the ones the bio and drug samples refer to
+    annotations = [
+        _parquet_column("", col)
+        for col in (TargetIonsColumn.ID, TargetIonsColumn.MZ, TargetIonsColumn.RT)
+    ]
+    sample_prefix = _parquet_column(TargetIonsColumn.SAMPLE, "")[:-3]
+    return [
+        name for name in names if name in annotations or name.startswith(sample_prefix)
+    ]
+
+
+def _signal_filters(
+    bio_samples: list[BioSample], min_signal_threshold: float
+) -> list[list[tuple]] | None:
+    # A metabolite can only pass `_filter_metabolites` if at least one of its bio
+    # sample intensities exceeds the minimum signal, so every other row can be
+    # skipped while scanning the parquet file
+    sample_cols = dict.fromkeys(col for bio in bio_samples for col in bio.sample)
+    filters = [
+        [(_parquet_column(TargetIonsColumn.SAMPLE, col), ">", min_signal_threshold)]
+        for col in sample_cols
+    ]
+    return filters or None
+
+
+def _group_indices(columns: pd.Index, groups: list[list[str]]) -> list[np.ndarray]:
+    indices = [columns.get_indexer(group) for group in groups]
+    for group, index in zip(groups, indices):
+        if (index < 0).any():
+            missing = [col for col, i in zip(group, index) if i < 0]
+            raise KeyError(f"Sample columns not found: {missing}")
+    return indices
+
+
+def _group_means(matrix: np.ndarray, groups: list[np.ndarray]) -> np.ndarray:
+    """NaN-skipping mean of every group, computed as two matrix products."""
+    membership = np.zeros((matrix.shape[1], len(groups)), dtype=np.float32)
+    for i, group in enumerate(groups):
+        membership[group, i] = 1
+
+    present = ~np.isnan(matrix)
+    sums = np.where(present, matrix, 0) @ membership
+    counts = present.astype(np.float32) @ membership
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def _group_maxima(matrix: np.ndarray, groups: list[np.ndarray]) -> np.ndarray:
+    """NaN-skipping maximum of every group, computed with a single reduceat."""
+    maxima = np.full((matrix.shape[0], len(groups)), np.nan, dtype=np.float32)
+    non_empty = [i for i, group in enumerate(groups) if len(group)]
+    if non_empty:
+        order = np.concatenate([groups[i] for i in non_empty])
+        offsets = np.cumsum([0] + [len(groups[i]) for i in non_empty[:-1]])
+        maxima[:, non_empty] = np.fmax.reduceat(matrix[:, order], offsets, axis=1)
+    return maxima
+
+
 def _filter_metabolites(
     data: pd.DataFrame,
     bio_samples: list[BioSample],
@@ -53,56 +122,93 @@ def _filter_metabolites(
     signal_enrichment_factor: float,
 ) -> pd.DataFrame:
     samples_df = data[TargetIonsColumn.SAMPLE]
-    cond = pd.Series(False, index=data.index)
-    for bio in bio_samples:
-        sample_group, blank_group = (
-            bio.sample,
-            bio.blank,
-        )
+    matrix = np.ascontiguousarray(samples_df.to_numpy(dtype=np.float32))
 
-        blank_mean = samples_df[blank_group].mean(axis=1)
-        sample_max = samples_df[sample_group].max(axis=1)
+    mean_names = [bio.name for bio in bio_samples]
+    mean_groups = [bio.sample for bio in bio_samples]
+    if drug_sample:
+        mean_names.append(drug_sample.name)
+        mean_groups.append(drug_sample.groups)
+    blank_groups = [bio.blank for bio in bio_samples]
 
-        filter_cond = (sample_max > min_signal_threshold) & (
-            sample_max > signal_enrichment_factor * blank_mean
-        )
-        cond |= filter_cond
+    means = _group_means(
+        matrix, _group_indices(samples_df.columns, mean_groups + blank_groups)
+    )
+    group_means, blank_means = means[:, : len(mean_names)], means[:, len(mean_names) :]
+    sample_maxima = _group_maxima(
+        matrix, _group_indices(samples_df.columns, [bio.sample for bio in bio_samples])
+    )
 
-        data[(TargetIonsColumn.SAMPLE, bio.name)] = samples_df[sample_group].mean(
-            axis=1
-        )
+    cond = (
+        (sample_maxima > min_signal_threshold)
+        & (sample_maxima > signal_enrichment_factor * blank_means)
+    ).any(axis=1)
 
+    group_df = pd.DataFrame(
+        group_means[cond],
+        index=data.index[cond],
+        columns=pd.MultiIndex.from_product([[TargetIonsColumn.SAMPLE], mean_names]),
+    )
     if drug_sample:
-        data[(TargetIonsColumn.SAMPLE, drug_sample.name)] = samples_df[
-            drug_sample.groups
-        ].mean(axis=1)
         # If a specific m/z in the drug sample exceeds the minimum signal threshold and is more than the signal enrichment factor times the response of any blank sample,
         # it's flagged as a potential prototype compound
-        data[("", TargetIonsColumn.IS_PROTOTYPE)] = cond & (
-            data[(TargetIonsColumn.SAMPLE, drug_sample.name)] > min_signal_threshold
+        group_df[("", TargetIonsColumn.IS_PROTOTYPE)] = (
+            group_means[cond, -1] > min_signal_threshold
         )
 
-    return data[cond].drop_duplicates()
+    return pd.concat([data[cond], group_df], axis=1).drop_duplicates()
 
 
 @log("Loading data")
 async def load_data(
-    analysis: Analysis,
+    raw_file: RawFile,
+    reaction_db: ReactionDatabase | Literal["default-pos"] | Literal["default-neg"],
+    bio_samples: list[BioSample],
+    drug_sample: DrugSample | None,
+    min_signal_threshold: float,
+    signal_enrichment_factor: float,
     convex: ConvexClient,
+    spectra: list[Spectrum] | None = None,
+    low_memory: bool = False,
+    cache: ArtifactStore | None = None,
 ) -> tuple[list[Spectrum], pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # parsed spectra and custom reaction tables are reused across containers,
+    # keyed by the storage id of the immutable file and the table definition
+    if isinstance(reaction_db, str):
+        reactions = _load_reaction_db(reaction_db)
+    else:
+        reactions = cached(
+            cache,
+            content_key("reactions", reaction_db.model_dump(mode="json")),
+            lambda: _load_reaction_db(reaction_db),
+        )
     tasks = [
-        load_mgf(analysis.rawFile.mgf, convex=convex),
-        load_parquet(analysis.rawFile.targetedIons, convex=convex),
-        _load_reaction_db(analysis.reactionDb),
+        load_parquet(
+            raw_file.targetedIons,
+            convex=convex,
+            columns=_referenced_columns,
+            filters=_signal_filters(bio_samples, min_signal_threshold),
+        ),
+        reactions,
     ]
-    spectra, targeted_ions_df, reaction_df = await asyncio.gather(*tasks)
+    # spectra already loaded for a batch of analyses of the same file are reused
+    if spectra is None:
+        tasks.append(
+            cached(
+                cache,
+                content_key("mgf", raw_file.mgf),
+                lambda: load_mgf(raw_file.mgf, convex=convex),
+            )
+        )
+    targeted_ions_df, reaction_df, *loaded = await asyncio.gather(*tasks)
+    spectra = loaded[0] if loaded else spectra
 
     targeted_ions_df = _filter_metabolites(
         data=targeted_ions_df,
-        bio_samples=analysis.config.bioSamples,
-        drug_sample=analysis.config.drugSample,
-        min_signal_threshold=analysis.config.minSignalThreshold,
-        signal_enrichment_factor=analysis.config.signalEnrichmentFactor,
+        bio_samples=bio_samples,
+        drug_sample=drug_sample,
+        min_signal_threshold=min_signal_threshold,
+        signal_enrichment_factor=signal_enrichment_factor,
     )
 
     samples_df = targeted_ions_df[TargetIonsColumn.SAMPLE]
@@ -110,4 +216,9 @@ async def load_data(
     # drop rows that has id of nan
     targeted_ions_df = targeted_ions_df.dropna(subset=[TargetIonsColumn.ID])
 
+    if low_memory:
+        # intensities and ids fit 32 bits, m/z values keep their full precision
+        samples_df = downcast(samples_df)
+        targeted_ions_df = downcast(targeted_ions_df, columns=[TargetIonsColumn.ID])
+
     return spectra, targeted_ions_df, samples_df, reaction_df
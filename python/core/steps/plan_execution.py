@@ -0,0 +1,45 @@
+import json
+
+import pandas as pd
+from core.planner import (
+    DataProfile,
+    InteractionEngine,
+    SimilarityEngine,
+    choose_engines,
+)
+from core.utils.logger import log, logger
+from core.utils.memory import MemoryBudget
+from matchms.Spectrum import Spectrum
+
+
+@log("Planning execution")
+async def plan_execution(
+    spectra: list[Spectrum],
+    targeted_ions_df: pd.DataFrame,
+    reaction_df: pd.DataFrame,
+    mz_error_threshold: float = 0.01,
+    memory_budget: MemoryBudget | None = None,
+    fanout: int = 1,
+    approximate_similarity: bool = False,
+) -> tuple[InteractionEngine, SimilarityEngine, int, bool]:
+    """
+    Pick the engines of the matrix steps from the size of the loaded data.
+
+    The approximate similarity is only picked with `approximate_similarity`.
+
+    Returns:
+        The interaction engine, the similarity engine, the number of processes
+        scoring spectrum pairs and whether they are scored across `fanout`
+        containers instead
+    """
+    profile = DataProfile.measure(
+        spectra, targeted_ions_df, reaction_df, mz_error_threshold
+    )
+    plan = choose_engines(
+        profile,
+        memory_limit=memory_budget.limit_bytes if memory_budget else None,
+        fanout=fanout,
+        approximate=approximate_similarity,
+    )
+    logger.info("execution plan %s", json.dumps(plan.summary()))
+    return plan.interaction, plan.similarity, plan.workers, plan.distributed
@@ -8,7 +8,11 @@ from convex import ConvexClient
 
 @log("Uploading result")
 async def upload_result(
-    id: str, nodes: pd.DataFrame, edges: pd.DataFrame, convex: ConvexClient
+    id: str,
+    nodes: pd.DataFrame,
+    edges: pd.DataFrame,
+    convex: ConvexClient,
+    result_key: str | None = None,
 ):
     edges_storage_id = upload_csv(edges, file_name="edges", convex=convex)
     nodes_storage_id = upload_csv(nodes, file_name="nodes", convex=convex)
@@ -22,5 +26,7 @@ async def upload_result(
                 "edges": edges_storage_id,
             },
             "status": AnalysisStatus.COMPLETE,
+            # lets later analyses of the same inputs link this result
+            **({"resultKey": result_key} if result_key else {}),
         },
     )
@@ -0,0 +1,43 @@
+import os
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.feather as feather
+
+ASSET_DIR = Path(__file__).parents[2] / "asset"
+# binary copies of the reaction tables, written at image build time by
+# `python -m core.warmup --compile-assets`
+COMPILED_DIR = Path(os.environ.get("ASSET_CACHE_DIR", ASSET_DIR / "compiled"))
+
+
+def _compiled_path(name: str, directory: Path) -> Path:
+    return directory / f"{name}.feather"
+
+
+def read_asset_table(name: str) -> pd.DataFrame:
+    """
+    The table `asset/<name>.csv`.
+
+    Read from its compiled copy when one is at least as recent as the CSV,
+    which skips parsing the text, and from the CSV otherwise.
+    """
+    source = ASSET_DIR / f"{name}.csv"
+    compiled = _compiled_path(name, COMPILED_DIR)
+    try:
+        if compiled.stat().st_mtime >= source.stat().st_mtime:
+            return feather.read_feather(compiled)
+    except FileNotFoundError:
+        pass
+    return pd.read_csv(source)
+
+
+def compile_asset_tables(directory: Path | None = None) -> list[Path]:
+    """Write a compiled copy of every table in `asset/`, by default where it is read."""
+    directory = directory or COMPILED_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    written = []
+    for source in sorted(ASSET_DIR.glob("*.csv")):
+        path = _compiled_path(source.stem, directory)
+        feather.write_feather(pd.read_csv(source), path)
+        written.append(path)
+    return written
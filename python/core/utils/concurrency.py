@@ -0,0 +1,65 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class ConcurrencyLimiter:
+    """
+    Lets at most `limit` jobs run at once, the others wait in line.
+
+    `metrics` reports how deep the line is and how long jobs waited in it, so
+    that a limit too low for the load shows up before requests time out.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[float]:
+        """Wait for a free slot, yields the seconds waited for it."""
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        start = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - start
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+        self.running += 1
+        try:
+            yield waited
+        except BaseException:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+    def metrics(self) -> dict[str, float]:
+        started = self.completed + self.failed + self.running
+        return {
+            "limit": self.limit,
+            "running": self.running,
+            "waiting": self.waiting,
+            "maxWaiting": self.max_waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "meanWaitSeconds": round(self.total_wait_seconds / started, 3)
+            if started
+            else 0.0,
+            "maxWaitSeconds": round(self.max_wait_seconds, 3),
+        }
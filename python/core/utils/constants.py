@@ -1,9 +1,12 @@
 from enum import Enum, EnumMeta
-from pathlib import Path
+from functools import lru_cache
 
 import pandas as pd
+from core.utils.assets import read_asset_table
 
 SCANS_KEY = "scans"
+# lower bound of ms2SimilarityThreshold in the analysis config schema
+MIN_MS2_SIMILARITY_THRESHOLD = 0.5
 
 
 def _matched(x: str) -> str:
@@ -54,25 +57,30 @@ class MSDialColumn(str, Enum):
     MSMS_ASSIGNED = "MS/MS assigned"
 
 
-# load default reaction dataframe of 116 reactions from local file
+# default reaction dataframes: 116 common reactions and the adducts of an ion
+# mode. Loaded on first use rather than on import, which most containers never
+# need, see `default_reactions`.
 
 
-def _load_default_reactions():
-    folder = Path(__file__).parents[2] / "asset"
+@lru_cache(maxsize=None)
+def default_reactions(ion_mode: str) -> pd.DataFrame:
+    """The default reaction dataframe of `ion_mode`, "pos" or "neg"."""
+    if ion_mode not in ("pos", "neg"):
+        raise ValueError(f"Unknown ion mode: {ion_mode}")
     reaction_cols = [
         ReactionColumn.MZ_DIFF,
         ReactionColumn.FORMULA_CHANGE,
         ReactionColumn.REACTION_DESCRIPTION,
     ]
-    default_reaction_df = pd.read_csv(folder / "default-common-reactions.csv")[
-        reaction_cols
-    ]
-    pos_adduct_df = pd.read_csv(folder / "pos-adduct-ions.csv")[reaction_cols]
-    neg_adduct_df = pd.read_csv(folder / "neg-adduct-ions.csv")[reaction_cols]
+    default_reaction_df = read_asset_table("default-common-reactions")[reaction_cols]
+    adduct_df = read_asset_table(f"{ion_mode}-adduct-ions")[reaction_cols]
+    return pd.concat([default_reaction_df, adduct_df])
+
 
-    return pd.concat([default_reaction_df, pos_adduct_df]), pd.concat(
-        [default_reaction_df, neg_adduct_df]
-    )
+_DEFAULT_REACTIONS = {"DEFAULT_POS_DF": "pos", "DEFAULT_NEG_DF": "neg"}
 
 
-DEFAULT_POS_DF, DEFAULT_NEG_DF = _load_default_reactions()
+def __getattr__(name: str):
+    if name in _DEFAULT_REACTIONS:
+        return default_reactions(_DEFAULT_REACTIONS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,34 +1,92 @@
+import asyncio
 import io
 import os
+import shutil
 from tempfile import NamedTemporaryFile
+from typing import IO, TYPE_CHECKING, Any, Callable
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
 import aiohttp
 import pandas as pd
+import pyarrow.parquet as pq
 import requests
 from async_lru import alru_cache
+from core.utils.progress import current_progress
 from dotenv import load_dotenv
-from matchms.importing import load_from_mgf
-from matchms.Spectrum import Spectrum
 
 from convex import ConvexClient
 
+if TYPE_CHECKING:
+    # matchms takes seconds to import, the API never loads spectra
+    from matchms.Spectrum import Spectrum
+
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "../../.env.local"))
 
 
 ENCODING: str = "utf-8"
-CONVEX_URL = os.environ["CONVEX_URL"]
 # all magic strings
 CONTENT_TYPE = "Content-Type"
 MIME_TYPE_CSV = "text/csv"
 MIME_TYPE_PARQUET = "application/octet-stream"
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# signed URLs of the local stand-in (see `core.utils.local_convex`)
+FILE_SCHEME = "file"
 
 
 def get_convex(convex_token: str) -> ConvexClient:
-    convex = ConvexClient(CONVEX_URL)
+    convex = ConvexClient(os.environ["CONVEX_URL"])
     convex.set_auth(convex_token)
     return convex
 
 
+class AsyncConvexClient:
+    """
+    Awaitable calls to Convex, for code running on an event loop.
+
+    The Convex SDK only has blocking calls, they are run on threads so that
+    other requests keep being served while one waits on Convex.
+    """
+
+    def __init__(self, convex: ConvexClient):
+        self.convex = convex
+
+    async def query(self, name: str, args: dict[str, Any] | None = None) -> Any:
+        return await asyncio.to_thread(self.convex.query, name, args)
+
+    async def mutation(self, name: str, args: dict[str, Any] | None = None) -> Any:
+        return await asyncio.to_thread(self.convex.mutation, name, args)
+
+    async def action(self, name: str, args: dict[str, Any] | None = None) -> Any:
+        return await asyncio.to_thread(self.convex.action, name, args)
+
+
+def _as_async(convex: ConvexClient | AsyncConvexClient) -> AsyncConvexClient:
+    return (
+        convex if isinstance(convex, AsyncConvexClient) else AsyncConvexClient(convex)
+    )
+
+
+def _local_path(url: str) -> str | None:
+    parsed = urlparse(url)
+    return url2pathname(parsed.path) if parsed.scheme == FILE_SCHEME else None
+
+
+def _put(url: str, content_type: str, data: str | bytes | IO[bytes]) -> None:
+    path = _local_path(url)
+    if path is not None:
+        with open(path, "wb") as f:
+            if isinstance(data, (str, bytes)):
+                f.write(data.encode(ENCODING) if isinstance(data, str) else data)
+            else:
+                shutil.copyfileobj(data, f, DOWNLOAD_CHUNK_SIZE)
+        return
+
+    result = requests.put(url, headers={CONTENT_TYPE: content_type}, data=data)
+    if result.status_code != 200:
+        raise Exception(f"Failed to upload file: {result.text}")
+
+
 def upload_csv(df: pd.DataFrame, file_name: str, convex: ConvexClient) -> str:
     resp = convex.action(
         "actions:generateUploadUrl",
@@ -38,14 +96,7 @@ def upload_csv(df: pd.DataFrame, file_name: str, convex: ConvexClient) -> str:
         },
     )
     signedUrl, storage_id = resp["signedUrl"], resp["storageId"]
-    result = requests.put(
-        signedUrl,
-        headers={CONTENT_TYPE: MIME_TYPE_CSV},
-        data=df.to_csv(index=False),
-    )
-
-    if result.status_code != 200:
-        raise Exception(f"Failed to upload file: {result.text}")
+    _put(signedUrl, MIME_TYPE_CSV, df.to_csv(index=False))
     return storage_id
 
 
@@ -63,19 +114,28 @@ def upload_parquet(df: pd.DataFrame, file_name: str, convex: ConvexClient) -> st
     df.to_parquet(buffer, index=True)
     buffer.seek(0)  # Reset buffer's pointer to the beginning
 
-    result = requests.put(
-        signed_url,
-        headers={CONTENT_TYPE: MIME_TYPE_PARQUET},
-        data=buffer.read(),  # Read the binary content of the buffer
-    )
+    _put(signed_url, MIME_TYPE_PARQUET, buffer.read())
+    return storage_id
 
-    if result.status_code != 200:
-        raise Exception(f"Failed to upload file: {result.text}")
+
+def upload_parquet_file(path: str, file_name: str, convex: ConvexClient) -> str:
+    """Upload a parquet file from disk, streaming it instead of loading it in memory."""
+    resp = convex.action(
+        "actions:generateUploadUrl",
+        {
+            "mimeType": MIME_TYPE_PARQUET,
+            "fileName": f"{file_name}.parquet",
+        },
+    )
+    signed_url, storage_id = resp["signedUrl"], resp["storageId"]
+    _put_file(signed_url, MIME_TYPE_PARQUET, path)
     return storage_id
 
 
-async def _generate_download_url(storage_id: str, convex: ConvexClient) -> str:
-    response = convex.action(
+async def _generate_download_url(
+    storage_id: str, convex: ConvexClient | AsyncConvexClient
+) -> str:
+    response = await _as_async(convex).action(
         "actions:generateDownloadUrl",
         {"storageId": storage_id},
     )
@@ -86,14 +146,111 @@ async def _generate_download_url(storage_id: str, convex: ConvexClient) -> str:
 
 @alru_cache(maxsize=128, typed=False)
 async def _download_from_url(url: str) -> bytes:
+    path = _local_path(url)
+    if path is not None:
+        data = await asyncio.to_thread(_read_bytes, path)
+        current_progress().add("bytesDownloaded", len(data))
+        return data
     async with aiohttp.ClientSession() as session:
         async with session.get(url) as resp:
             if resp.status == 200:
-                return await resp.read()
+                chunks = []
+                async for chunk in _counted_chunks(resp):
+                    chunks.append(chunk)
+                return b"".join(chunks)
             else:
                 raise Exception(f"Failed to download file, status code: {resp.status}")
 
 
+async def _counted_chunks(resp: aiohttp.ClientResponse):
+    """The body of a response, counted towards the progress of the running step."""
+    progress = current_progress()
+    if resp.content_length is not None:
+        progress.add("bytesTotal", resp.content_length)
+    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+        progress.add("bytesDownloaded", len(chunk))
+        yield chunk
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def _download_to_file(url: str, path: str) -> None:
+    source = _local_path(url)
+    if source is not None:
+        await asyncio.to_thread(shutil.copyfile, source, path)
+        current_progress().add("bytesDownloaded", os.path.getsize(path))
+        return
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                raise Exception(f"Failed to download file, status code: {resp.status}")
+            with open(path, "wb") as f:
+                async for chunk in _counted_chunks(resp):
+                    f.write(chunk)
+
+
+async def upload_file(
+    path: str,
+    file_name: str,
+    mime_type: str,
+    convex: ConvexClient | AsyncConvexClient,
+) -> str:
+    """Stream a file from disk to storage without blocking the event loop."""
+    resp = await _as_async(convex).action(
+        "actions:generateUploadUrl",
+        {"mimeType": mime_type, "fileName": file_name},
+    )
+    signed_url, storage_id = resp["signedUrl"], resp["storageId"]
+    if _local_path(signed_url) is not None:
+        await asyncio.to_thread(_put_file, signed_url, mime_type, path)
+        return storage_id
+
+    async with aiohttp.ClientSession() as session:
+        with open(path, "rb") as f:
+            async with session.put(
+                signed_url,
+                headers={CONTENT_TYPE: mime_type},
+                data=f,
+            ) as result:
+                if result.status != 200:
+                    raise Exception(f"Failed to upload file: {await result.text()}")
+    return storage_id
+
+
+def _put_file(url: str, content_type: str, path: str) -> None:
+    with open(path, "rb") as f:
+        _put(url, content_type, f)
+
+
+async def download_file(
+    storage_id: str, path: str, convex: ConvexClient | AsyncConvexClient
+) -> None:
+    """Stream a stored file to `path` without holding it in memory."""
+    url = await _generate_download_url(storage_id, convex)
+    await _download_to_file(url, path)
+
+
+async def file_exists(
+    storage_id: str, convex: ConvexClient | AsyncConvexClient
+) -> bool:
+    """Whether a file is still stored under `storage_id`, without downloading it."""
+    try:
+        url = await _generate_download_url(storage_id, convex)
+    except ValueError:
+        # the local client refuses to sign urls to missing files
+        return False
+    path = _local_path(url)
+    if path is not None:
+        return os.path.exists(path)
+    async with aiohttp.ClientSession() as session:
+        # the url is signed for GET, so only the first byte is asked for
+        async with session.get(url, headers={"Range": "bytes=0-0"}) as resp:
+            return resp.status in (200, 206)
+
+
 async def load_binary(storage_id: str, convex: ConvexClient) -> bytes:
     url = await _generate_download_url(storage_id, convex)
     return await _download_from_url(url)
@@ -102,7 +259,9 @@ async def load_binary(storage_id: str, convex: ConvexClient) -> bytes:
 async def load_mgf(
     storage_id: str,
     convex: ConvexClient,
-) -> list[Spectrum]:
+) -> list["Spectrum"]:
+    from matchms.importing import load_from_mgf
+
     blob = await load_binary(storage_id, convex)
     try:
         content = blob.decode(ENCODING)
@@ -117,7 +276,33 @@ async def load_mgf(
         raise Exception("Failed to decode the blob with encoding {}".format(ENCODING))
 
 
-async def load_parquet(storage_id: str, convex: ConvexClient) -> pd.DataFrame:
-    blob = await load_binary(storage_id, convex)
-    buffer = io.BytesIO(blob)
-    return pd.read_parquet(buffer)
+async def load_parquet(
+    storage_id: str,
+    convex: ConvexClient,
+    columns: list[str] | Callable[[list[str]], list[str]] | None = None,
+    filters: list[list[tuple]] | None = None,
+) -> pd.DataFrame:
+    """
+    Download a parquet file to local disk and read it memory-mapped.
+
+    Only `columns` are decoded and `filters` (pyarrow DNF predicates) are
+    pushed down into the scan, so row groups and columns that are not needed
+    never get materialized. `columns` may also be a function selecting from
+    the column names in the file's schema.
+    """
+    with NamedTemporaryFile(suffix=".parquet") as temp_file:
+        await download_file(storage_id, temp_file.name, convex=convex)
+        # decoding is CPU-bound, keep it off the event loop
+        return await asyncio.to_thread(_read_parquet, temp_file.name, columns, filters)
+
+
+def _read_parquet(
+    path: str,
+    columns: list[str] | Callable[[list[str]], list[str]] | None,
+    filters: list[list[tuple]] | None,
+) -> pd.DataFrame:
+    if callable(columns):
+        columns = columns(pq.read_schema(path).names)
+    return pq.read_table(
+        path, columns=columns, filters=filters, memory_map=True
+    ).to_pandas()
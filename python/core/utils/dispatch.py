@@ -0,0 +1,165 @@
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import redis.asyncio as redis
+
+# placeholder of a run being spawned, other requests wait for its call id
+PENDING_PREFIX = "pending:"
+# how long a placeholder holds, a crashed spawn frees its key after this
+CLAIM_SECONDS = 30.0
+POLL_SECONDS = 0.1
+
+
+class MemoryRegistry:
+    """In-flight runs of this process, keys expire after their time to live."""
+
+    def __init__(self):
+        self._entries: dict[str, tuple[str, float]] = {}
+
+    async def get(self, key: str) -> str | None:
+        value, expires = self._entries.get(key, (None, 0.0))
+        if value is not None and expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        return value
+
+    async def claim(self, key: str, value: str, ttl: float) -> bool:
+        """Set `key` unless it is set already."""
+        if await self.get(key) is not None:
+            return False
+        self._entries[key] = (value, time.monotonic() + ttl)
+        return True
+
+    async def replace(self, key: str, old: str, new: str, ttl: float) -> bool:
+        """Set `key` to `new` if it is still `old`."""
+        if await self.get(key) != old:
+            return False
+        self._entries[key] = (new, time.monotonic() + ttl)
+        return True
+
+    async def release(self, key: str, value: str) -> None:
+        """Remove `key` if it is still `value`."""
+        if await self.get(key) == value:
+            del self._entries[key]
+
+
+# compare-and-set and compare-and-delete, atomic on the server
+_REPLACE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("SET", KEYS[1], ARGV[2], "PX", ARGV[3])
+end
+return false
+"""
+_RELEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisRegistry:
+    """In-flight runs shared by every process connected to the same Redis."""
+
+    def __init__(self, client: redis.Redis, prefix: str = "dispatch:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisRegistry":
+        return cls(redis.Redis.from_url(url, decode_responses=True))
+
+    async def get(self, key: str) -> str | None:
+        return await self.client.get(self.prefix + key)
+
+    async def claim(self, key: str, value: str, ttl: float) -> bool:
+        claimed = await self.client.set(
+            self.prefix + key, value, nx=True, px=int(ttl * 1000)
+        )
+        return bool(claimed)
+
+    async def replace(self, key: str, old: str, new: str, ttl: float) -> bool:
+        replaced = await self.client.eval(
+            _REPLACE, 1, self.prefix + key, old, new, int(ttl * 1000)
+        )
+        return bool(replaced)
+
+    async def release(self, key: str, value: str) -> None:
+        await self.client.eval(_RELEASE, 1, self.prefix + key, value)
+
+
+Registry = MemoryRegistry | RedisRegistry
+
+
+@dataclass
+class Dispatch:
+    call_id: str
+    # False when the call of a run already in progress was returned
+    spawned: bool
+
+
+class Dispatcher:
+    """
+    Spawns at most one run per key, such as an analysis id.
+
+    The call id of every run is kept in `registry` for `ttl` seconds, the
+    longest a run may take. Requests for a key whose run is still in progress
+    get its call id rather than a new run, including concurrent ones: the
+    first claims the key before spawning and the others wait for its call id.
+    With `restart`, the run in progress when the request arrives is cancelled
+    and replaced. Runs started since are returned as usual, so that a repeated
+    restart does not cancel the replacement of the first. A spawn that
+    outlasts its claim keeps its run only if the key is still free, otherwise
+    the run is cancelled in favour of the one registered meanwhile.
+    """
+
+    def __init__(
+        self,
+        registry: Registry,
+        is_running: Callable[[str], Awaitable[bool]],
+        cancel: Callable[[str], Awaitable[None]] | None = None,
+        ttl: float = 3600.0,
+    ):
+        self.registry = registry
+        self.is_running = is_running
+        self.cancel = cancel
+        self.ttl = ttl
+
+    async def dispatch(
+        self, key: str, spawn: Callable[[], Awaitable[str]], restart: bool = False
+    ) -> Dispatch:
+        superseded = await self.registry.get(key) if restart else None
+        while True:
+            current = await self.registry.get(key)
+            if current is None:
+                pending = PENDING_PREFIX + uuid.uuid4().hex
+                if not await self.registry.claim(key, pending, CLAIM_SECONDS):
+                    continue  # claimed by a concurrent request
+                try:
+                    call_id = await spawn()
+                except BaseException:
+                    await self.registry.release(key, pending)
+                    raise
+                if await self.registry.replace(
+                    key, pending, call_id, self.ttl
+                ) or await self.registry.claim(key, call_id, self.ttl):
+                    return Dispatch(call_id, spawned=True)
+                # the spawn outlasted the claim and another request took the
+                # key, its run is the one the registry knows
+                if self.cancel:
+                    await self.cancel(call_id)
+                continue
+
+            if current.startswith(PENDING_PREFIX):
+                await asyncio.sleep(POLL_SECONDS)
+                continue
+            if current != superseded and await self.is_running(current):
+                return Dispatch(current, spawned=False)
+
+            # finished, or superseded by this request
+            if current == superseded and self.cancel:
+                await self.cancel(current)
+            await self.registry.release(key, current)
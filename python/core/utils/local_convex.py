@@ -0,0 +1,167 @@
+import copy
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Callable
+
+from convex import ConvexClient
+
+Handler = Callable[[dict[str, Any]], Any]
+
+
+class LocalConvexClient(ConvexClient):
+    """
+    In-memory stand-in for `ConvexClient` to run the pipeline offline.
+
+    It subclasses `ConvexClient` so that it passes wherever one is expected, but
+    never calls its constructor, which would connect to a deployment.
+
+    Analyses are plain dicts keyed by id and the functions the pipeline calls
+    mirror their counterparts in `convex/`. More functions can be registered
+    through `handlers`. Every call is recorded in `calls`, and setting
+    `failures` makes that many upcoming calls raise `ConnectionError`.
+
+    Stored files live in `storage_dir`, a temporary directory when not given,
+    under their storage id. Signed URLs are `file://` URLs to them, which the
+    upload and download helpers of `core.utils.convex` read and write directly.
+    """
+
+    def __init__(
+        self,
+        analyses: dict[str, dict] | None = None,
+        storage_dir: str | os.PathLike | None = None,
+    ):
+        self.analyses: dict[str, dict] = analyses or {}
+        self.calls: list[tuple[str, dict[str, Any]]] = []
+        self.failures = 0
+        self.handlers: dict[str, Handler] = {
+            "analyses:get": self._get,
+            "analyses:getProgress": self._get_progress,
+            "analyses:findResult": self._find_result,
+            "analyses:update": self._update,
+            "analyses:updateStepStatus": self._update_step_status,
+            "analyses:updateStepStatuses": self._update_step_statuses,
+            "actions:generateUploadUrl": self._generate_upload_url,
+            "actions:generateDownloadUrl": self._generate_download_url,
+            "actions:removeFile": self._remove_file,
+        }
+        self._lock = threading.Lock()
+        self._storage_dir = Path(storage_dir) if storage_dir else None
+
+    def set_auth(self, token: str) -> None:
+        pass
+
+    def clear_auth(self) -> None:
+        pass
+
+    def _call(self, name: str, args: dict[str, Any] | None) -> Any:
+        args = args or {}
+        with self._lock:
+            self.calls.append((name, args))
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionError(f"Simulated failure calling {name}")
+            if name not in self.handlers:
+                raise NotImplementedError(f"No local handler for {name}")
+            return self.handlers[name](args)
+
+    query = mutation = action = _call
+
+    @property
+    def storage_dir(self) -> Path:
+        if self._storage_dir is None:
+            self._storage_dir = Path(tempfile.mkdtemp(prefix="convex-storage-"))
+        self._storage_dir.mkdir(parents=True, exist_ok=True)
+        return self._storage_dir
+
+    def path(self, storage_id: str) -> Path:
+        """Where the file stored under `storage_id` lives."""
+        # storage ids never contain a separator, anything else is not ours
+        if os.sep in storage_id or storage_id in ("", ".", ".."):
+            raise ValueError(f"Invalid storage id: {storage_id}")
+        return self.storage_dir / storage_id
+
+    def store_file(
+        self, source: str | os.PathLike, file_name: str | None = None
+    ) -> str:
+        """
+        Copy a local file into storage, like an upload from the frontend.
+
+        The prefix of the id is taken from the content rather than random, so
+        that storing the same file again gives the same id, and with it the
+        same step keys, letting a rerun resume from its checkpoints.
+        """
+        with open(source, "rb") as file:
+            digest = hashlib.file_digest(file, "sha256").hexdigest()
+        storage_id = digest[:10] + f".{file_name or Path(source).name}"
+        shutil.copyfile(source, self.path(storage_id))
+        return storage_id
+
+    @staticmethod
+    def _storage_id(file_name: str | None) -> str:
+        # same shape as the ids of the S3 bucket, a random prefix and the name
+        return uuid.uuid4().hex[:10] + (f".{file_name}" if file_name else "")
+
+    def _analysis(self, id: str) -> dict:
+        if id not in self.analyses:
+            raise ValueError("Analysis not found")
+        return self.analyses[id]
+
+    def _get(self, args: dict[str, Any]) -> dict:
+        return copy.deepcopy(self._analysis(args["id"]))
+
+    def _get_progress(self, args: dict[str, Any]) -> dict:
+        analysis = self._analysis(args["id"])
+        return copy.deepcopy(
+            {"status": analysis.get("status"), "progress": analysis.get("progress", [])}
+        )
+
+    def _find_result(self, args: dict[str, Any]) -> dict | None:
+        for analysis in self.analyses.values():
+            if (
+                analysis.get("resultKey") == args["resultKey"]
+                and analysis.get("status") == "complete"
+            ):
+                return copy.deepcopy(analysis.get("result"))
+        return None
+
+    def _update(self, args: dict[str, Any]) -> None:
+        analysis = self._analysis(args["id"])
+        analysis.update({k: v for k, v in args.items() if k != "id" and v is not None})
+
+    def _update_step_status(self, args: dict[str, Any]) -> None:
+        self._update_step_statuses(
+            {
+                "id": args["id"],
+                "updates": [{"step": args["step"], "status": args["status"]}],
+            }
+        )
+
+    def _update_step_statuses(self, args: dict[str, Any]) -> None:
+        analysis = self._analysis(args["id"])
+        progress = {p["step"]: p for p in analysis.setdefault("progress", [])}
+        for update in args["updates"]:
+            progress[update["step"]] = progress.get(update["step"], {}) | update
+            if update["status"] == "failed":
+                analysis["status"] = "failed"
+        analysis["progress"] = list(progress.values())
+
+    def _generate_upload_url(self, args: dict[str, Any]) -> dict[str, str]:
+        storage_id = self._storage_id(args.get("fileName"))
+        return {
+            "signedUrl": self.path(storage_id).resolve().as_uri(),
+            "storageId": storage_id,
+        }
+
+    def _generate_download_url(self, args: dict[str, Any]) -> dict[str, str]:
+        path = self.path(args["storageId"])
+        if not path.exists():
+            raise ValueError("File not found")
+        return {"signedUrl": path.resolve().as_uri()}
+
+    def _remove_file(self, args: dict[str, Any]) -> None:
+        self.path(args["storageId"]).unlink(missing_ok=True)
@@ -1,10 +1,111 @@
 import functools
+import json
 import logging
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
 
 # Configure your logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+@dataclass
+class StepMetrics:
+    step: str
+    message: str
+    wall_seconds: float
+    # CPU time of the whole process, steps running concurrently share it
+    cpu_seconds: float
+    # growth of the process peak RSS, 0 when the step stayed below an earlier peak
+    peak_rss_delta_bytes: int
+    inputs: dict[str, dict[str, int]] = field(default_factory=dict)
+    outputs: dict[str, dict[str, int]] = field(default_factory=dict)
+    failed: bool = False
+
+    def summary(self) -> dict[str, float]:
+        """The headline numbers, as stored with the step status in Convex."""
+        return {
+            "wallSeconds": round(self.wall_seconds, 3),
+            "cpuSeconds": round(self.cpu_seconds, 3),
+            "peakRssDeltaBytes": self.peak_rss_delta_bytes,
+        }
+
+
+_collected: ContextVar[list[StepMetrics] | None] = ContextVar(
+    "step_metrics", default=None
+)
+
+
+@contextmanager
+def collect_metrics() -> Iterator[list[StepMetrics]]:
+    """Collect the metrics of every step run within the block and its tasks."""
+    metrics: list[StepMetrics] = []
+    token = _collected.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _collected.reset(token)
+
+
+def step_metrics(step: str) -> StepMetrics | None:
+    """The latest metrics collected for `step`, if any."""
+    for metrics in reversed(_collected.get() or []):
+        if metrics.step == step:
+            return metrics
+    return None
+
+
+def write_metrics(metrics: list[StepMetrics], path: str | Path, **fields: Any) -> None:
+    """Write the step metrics as JSON, `fields` describe the run as a whole."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        json.dumps(fields | {"steps": [asdict(m) for m in metrics]}, indent=2)
+    )
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the process so far, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+def _size(value: Any) -> dict[str, int] | None:
+    """Rows, non-zeros and bytes of the data structures passed between steps."""
+    if isinstance(value, pd.DataFrame):
+        return {"rows": len(value), "bytes": int(value.memory_usage().sum())}
+    if sparse.issparse(value):
+        buffers = ("data", "indices", "indptr", "row", "col")
+        return {
+            "rows": value.shape[0],
+            "nnz": value.nnz,
+            "bytes": sum(
+                getattr(value, b).nbytes for b in buffers if hasattr(value, b)
+            ),
+        }
+    if isinstance(value, np.ndarray):
+        return {"rows": len(value) if value.ndim else 1, "bytes": value.nbytes}
+    if isinstance(value, list):
+        return {"rows": len(value)}
+    return None
+
+
+def _sizes(values: dict[str, Any]) -> dict[str, dict[str, int]]:
+    sizes = {name: _size(value) for name, value in values.items()}
+    return {name: size for name, size in sizes.items() if size is not None}
+
 
 def log(message: str):
     def decorator(func):
@@ -12,7 +113,28 @@ def log(message: str):
 
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            return await func(*args, **kwargs)
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            rss_start = peak_rss()
+            result, failed = None, True
+            try:
+                result = await func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                outputs = result if isinstance(result, tuple) else (result,)
+                metrics = StepMetrics(
+                    step=func.__name__,
+                    message=message,
+                    wall_seconds=time.perf_counter() - wall_start,
+                    cpu_seconds=time.process_time() - cpu_start,
+                    peak_rss_delta_bytes=peak_rss() - rss_start,
+                    inputs=_sizes(kwargs),
+                    outputs=_sizes({str(i): out for i, out in enumerate(outputs)}),
+                    failed=failed,
+                )
+                logger.info("step metrics %s", json.dumps(asdict(metrics)))
+                if (collected := _collected.get()) is not None:
+                    collected.append(metrics)
 
         return wrapper
 
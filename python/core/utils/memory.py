@@ -0,0 +1,162 @@
+import math
+import os
+import tempfile
+import threading
+import weakref
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+MB = 1 << 20
+# tmpfs whose files are shared memory, where `multiprocessing.shared_memory` lives
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+@dataclass(frozen=True)
+class SpilledArray:
+    """Picklable reference to an array spilled to disk, for worker processes."""
+
+    path: str
+    dtype: str
+    shape: tuple[int, ...]
+
+    def open(self) -> np.memmap:
+        return np.memmap(self.path, dtype=self.dtype, mode="r", shape=self.shape)
+
+
+def attach(array: np.ndarray | SpilledArray) -> np.ndarray:
+    """The array behind a value passed through `share`."""
+    return array.open() if isinstance(array, SpilledArray) else array
+
+
+def share(array: np.ndarray) -> np.ndarray | SpilledArray:
+    """
+    What to send to another process in place of `array`.
+
+    Pickling a memmap copies its data into the message, so spilled arrays are
+    passed by path instead and mapped again by the receiver with `attach`.
+    """
+    if isinstance(array, np.memmap) and array.filename:
+        return SpilledArray(array.filename, array.dtype.str, array.shape)
+    return array
+
+
+@dataclass
+class MemoryBudget:
+    """
+    Bounds the memory a worker is allowed to use for its intermediates.
+
+    Under a budget, loaded data is downcast to 32 bit types (see `downcast`) and
+    arrays are allocated as memmaps in `spill_dir` rather than in memory once
+    they would take the arrays already allocated in memory past the budget. An
+    array gives its bytes back when it is garbage collected.
+    """
+
+    limit_bytes: int
+    spill_dir: str = field(default_factory=tempfile.gettempdir)
+    allocated_bytes: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        # concurrent steps allocate from the same budget in executor threads
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, var: str = "MEMORY_BUDGET_MB") -> "MemoryBudget | None":
+        """The budget set in megabytes by the environment variable `var`, if any."""
+        value = os.environ.get(var)
+        return cls(int(float(value) * MB)) if value else None
+
+    def fits(self, nbytes: int) -> bool:
+        """Whether `nbytes` more fit in what is left of the budget."""
+        return self.allocated_bytes + nbytes <= self.limit_bytes
+
+    def zeros(self, shape: tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        """`np.zeros`, spilled to a file when it would not fit the budget."""
+        dtype = np.dtype(dtype)
+        nbytes = math.prod(shape) * dtype.itemsize
+        with self._lock:
+            fits = self.fits(nbytes)
+            if fits:
+                self.allocated_bytes += nbytes
+        if not fits:
+            return _mapped_file(shape, dtype, self.spill_dir)
+
+        array = np.zeros(shape, dtype=dtype)
+        weakref.finalize(array, self._release, nbytes)
+        return array
+
+    def _release(self, nbytes: int) -> None:
+        with self._lock:
+            self.allocated_bytes -= nbytes
+
+
+def _has_room(directory: str, nbytes: int) -> bool:
+    try:
+        stats = os.statvfs(directory)
+    except OSError:
+        return False
+    return nbytes <= stats.f_bavail * stats.f_frsize
+
+
+def _mapped_file(shape: tuple[int, ...], dtype: np.dtype, directory: str) -> np.memmap:
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".npy", dir=directory)
+    os.close(fd)
+    # a fresh file reads as zeros
+    array = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+    # the file goes with the last view of the array
+    weakref.finalize(array, _remove, path)
+    return array
+
+
+def shared_zeros(shape: tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    """
+    `np.zeros` that worker processes map through `share` rather than copy.
+
+    Backed by shared memory, or by a temporary file when shared memory is too
+    small for it (containers often cap it), which the page cache then shares.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = math.prod(shape) * dtype.itemsize
+    if nbytes == 0:
+        return np.zeros(shape, dtype=dtype)  # an empty file cannot be mapped
+    if _has_room(SHARED_MEMORY_DIR, nbytes):
+        return _mapped_file(shape, dtype, SHARED_MEMORY_DIR)
+    return _mapped_file(shape, dtype, tempfile.gettempdir())
+
+
+def shared_copy(array: np.ndarray) -> np.ndarray:
+    """A copy of `array` made with `shared_zeros`."""
+    copy = shared_zeros(array.shape, array.dtype)
+    copy[...] = array
+    return copy
+
+
+def downcast(df: pd.DataFrame, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    Narrow float columns to float32 and integer columns to int32 where they fit.
+
+    Only `columns` are considered when given, e.g. to keep m/z values precise.
+    """
+    dtypes = {}
+    for name, dtype in df.dtypes.items():
+        if columns is not None and name not in columns:
+            continue
+        if dtype == np.float64:
+            dtypes[name] = np.float32
+        elif dtype == np.int64 and _fits_int32(df[name]):
+            dtypes[name] = np.int32
+    return df.astype(dtypes) if dtypes else df
+
+
+def _fits_int32(column: pd.Series) -> bool:
+    info = np.iinfo(np.int32)
+    return column.empty or (info.min <= column.min() and column.max() <= info.max)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
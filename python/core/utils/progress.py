@@ -0,0 +1,106 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+# counters of a step are sent at most this often, however often its kernels add
+PROGRESS_INTERVAL_SECONDS = 1.0
+
+Counters = dict[str, int]
+
+
+class StepProgress:
+    """
+    Counters of the work done inside a running step, such as pairs scored.
+
+    Kernels add to them once per chunk of work, never per item, so reporting
+    costs a lock and a clock read per chunk. The counters are handed to `emit`
+    at most every `interval` seconds, and once more when the step ends.
+    """
+
+    def __init__(
+        self,
+        step: str,
+        emit: Callable[[str, Counters], None],
+        interval: float = PROGRESS_INTERVAL_SECONDS,
+    ):
+        self.step = step
+        self.counters: Counters = {}
+        self._emit = emit
+        self._interval = interval
+        self._next_emit = time.monotonic() + interval
+        self._changed = False
+        # steps may score chunks from several threads
+        self._lock = threading.Lock()
+
+    def add(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + int(amount)
+            self._changed = True
+            self._maybe_emit()
+
+    def set(self, counter: str, value: int) -> None:
+        """Set a counter outright, typically the total the others count towards."""
+        with self._lock:
+            self.counters[counter] = int(value)
+            self._changed = True
+            self._maybe_emit()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._changed:
+                self._send()
+
+    def _maybe_emit(self) -> None:
+        if time.monotonic() >= self._next_emit:
+            self._send()
+
+    def _send(self) -> None:
+        self._changed = False
+        self._next_emit = time.monotonic() + self._interval
+        self._emit(self.step, dict(self.counters))
+
+
+class _NoProgress(StepProgress):
+    """What steps report to when nobody listens, e.g. in benchmarks."""
+
+    def __init__(self):
+        super().__init__("", lambda step, counters: None)
+
+    def add(self, counter: str, amount: int = 1) -> None:
+        pass
+
+    def set(self, counter: str, value: int) -> None:
+        pass
+
+
+_NO_PROGRESS = _NoProgress()
+
+_progress: ContextVar[StepProgress | None] = ContextVar("step_progress", default=None)
+
+
+def current_progress() -> StepProgress:
+    """The progress of the step running in this context, a no-op outside of one."""
+    return _progress.get() or _NO_PROGRESS
+
+
+@contextmanager
+def track_progress(
+    step: str,
+    emit: Callable[[str, Counters], None],
+    interval: float = PROGRESS_INTERVAL_SECONDS,
+) -> Iterator[StepProgress]:
+    """
+    Report the progress of `step` to `emit` within the block.
+
+    The context is copied into the threads steps run in, so kernels find it
+    through `current_progress`. The latest counters are emitted on leaving.
+    """
+    progress = StepProgress(step, emit, interval)
+    token = _progress.set(progress)
+    try:
+        yield progress
+    finally:
+        _progress.reset(token)
+        progress.flush()
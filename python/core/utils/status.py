@@ -0,0 +1,137 @@
+import asyncio
+import contextlib
+
+from core.models.analysis import AnalysisStatus
+from core.utils.logger import logger
+
+from convex import ConvexClient
+
+MAX_RETRIES = 5
+BASE_DELAY_SECONDS = 0.5
+
+
+class StatusPublisher:
+    """
+    Publishes step status updates to Convex from a background task.
+
+    `publish` only enqueues the update, so reporting never waits on the network.
+    Updates that pile up while a request is in flight are coalesced, the latest
+    status of a step wins, and sent together in one `updateStepStatuses`
+    mutation. Failed requests are retried with exponential backoff.
+
+    Counters of the work done inside a running step (see `core.utils.progress`)
+    travel the same way, as the `counters` of its status.
+
+    Use it as an async context manager; leaving the block, normally or through
+    an exception, flushes everything published so far.
+    """
+
+    def __init__(
+        self,
+        id: str,
+        convex: ConvexClient,
+        max_retries: int = MAX_RETRIES,
+        base_delay: float = BASE_DELAY_SECONDS,
+    ):
+        self.id = id
+        self.convex = convex
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self._queue: asyncio.Queue[
+            tuple[str, AnalysisStatus, dict | None, dict | None]
+        ] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def __aenter__(self) -> "StatusPublisher":
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def publish(
+        self, step: str, status: AnalysisStatus, metrics: dict | None = None
+    ) -> None:
+        self._queue.put_nowait((step, status, metrics, None))
+
+    def progress(self, step: str, counters: dict[str, int]) -> None:
+        """Publish the counters of a running step, from any thread."""
+        update = (step, AnalysisStatus.RUNNING, None, counters)
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            # in order with the statuses published around it
+            self._queue.put_nowait(update)
+        elif self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._queue.put_nowait, update)
+            except RuntimeError:
+                # the loop is gone, progress is best effort
+                pass
+
+    async def flush(self) -> None:
+        """Wait until every update published so far has been sent or given up on."""
+        await self._queue.join()
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        try:
+            await self.flush()
+        finally:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def _drain(
+        self,
+        step: str,
+        status: AnalysisStatus,
+        metrics: dict | None,
+        counters: dict | None,
+    ) -> tuple[dict[str, dict], int]:
+        # steps keep the position of their first update, so the order is preserved
+        updates = {}
+        n_updates = 0
+        while True:
+            # a status update after counters, e.g. completion, keeps the last ones
+            counters = counters or updates.get(step, {}).get("counters")
+            updates[step] = (
+                {"step": step, "status": status}
+                | ({"metrics": metrics} if metrics else {})
+                | ({"counters": counters} if counters else {})
+            )
+            n_updates += 1
+            if self._queue.empty():
+                return updates, n_updates
+            step, status, metrics, counters = self._queue.get_nowait()
+
+    async def _send(self, updates: dict[str, dict]) -> None:
+        args = {"id": self.id, "updates": list(updates.values())}
+        for attempt in range(self.max_retries + 1):
+            try:
+                await asyncio.to_thread(
+                    self.convex.mutation, "analyses:updateStepStatuses", args
+                )
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    # status is best effort, an unreachable Convex must not fail
+                    # the analysis
+                    logger.warning(f"Dropping status updates {list(updates)}: {e}")
+                    return
+                await asyncio.sleep(self.base_delay * 2**attempt)
+
+    async def _run(self) -> None:
+        while True:
+            updates, n_updates = self._drain(*await self._queue.get())
+            try:
+                await self._send(updates)
+            finally:
+                for _ in range(n_updates):
+                    self._queue.task_done()
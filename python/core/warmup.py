@@ -0,0 +1,74 @@
+"""
+Warm-up of a fresh worker container, so that its first analysis does not pay
+for loading the reaction tables and compiling the numba kernels.
+
+Run at image build time, it also writes the compiled reaction tables and
+fills the numba cache baked into the image:
+
+    python -m core.warmup --compile-assets
+"""
+
+import argparse
+import time
+
+import numpy as np
+from core.recursive.reactions import load_reactions_data
+from core.recursive.run import _find_reaction_neighbors_fast
+from core.steps.create_ion_interaction_matrix import (
+    _calculate_adj_pairs,
+    _sweep_adj_pairs,
+)
+from core.utils.assets import compile_asset_tables
+from core.utils.constants import default_reactions
+
+# mass types the kernels are called with: float64, or float32 under a memory budget
+_MZ_DTYPES = (np.float64, np.float32)
+
+
+def _compile_kernels() -> None:
+    # numba compiles one specialization per argument types, so every kernel is
+    # called with the types of the pipeline, on inputs small enough to be free
+    diffs = np.array([1.0, 2.0])
+    for dtype in _MZ_DTYPES:
+        mz = np.array([100.0, 101.0, 103.0], dtype=dtype)
+        order = np.argsort(mz, kind="mergesort")
+        _calculate_adj_pairs(mz, diffs, 0.01, 0, len(mz))
+        _sweep_adj_pairs(mz[order], order, diffs, 0.01, 0, len(mz))
+        _find_reaction_neighbors_fast(mz[0], mz, diffs.astype(np.float32), 0.01)
+
+
+def warm_up() -> dict[str, float]:
+    """
+    Load everything a worker loads lazily, the seconds every part took.
+
+    With the numba cache of the image, compiling the kernels only loads them.
+    """
+    seconds = {}
+    for name, part in (
+        ("reactions", lambda: [default_reactions(mode) for mode in ("pos", "neg")]),
+        ("recursiveReactions", load_reactions_data),
+        ("kernels", _compile_kernels),
+    ):
+        start = time.perf_counter()
+        part()
+        seconds[name] = time.perf_counter() - start
+    return seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Warm up a worker container")
+    parser.add_argument(
+        "--compile-assets",
+        action="store_true",
+        help="Write the compiled reaction tables first",
+    )
+    args = parser.parse_args()
+    if args.compile_assets:
+        for path in compile_asset_tables():
+            print(f"compiled {path}")
+    for name, seconds in warm_up().items():
+        print(f"{name:<20}{seconds:>8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
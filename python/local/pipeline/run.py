@@ -0,0 +1,235 @@
+"""
+Run the full analysis pipeline offline, on a local MS1 export and MGF file.
+
+Convex and the file storage are replaced by `LocalConvexClient`, so a run
+needs neither a deployment nor Modal. Results, the final analysis document and
+the step metrics are written to the output directory:
+
+    python local/pipeline/run.py export.txt spectra.mgf --tool MSDial \\
+        --bio-sample bio:S1,S2,S3:B1 --drug-sample drug:D1,D2 --output out/
+
+An already preprocessed feature table (`.parquet`) is used as is.
+"""
+
+import argparse
+import ast
+import asyncio
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add python directory to Python path
+current_dir = Path(__file__).resolve().parent
+python_dir = current_dir.parent.parent
+sys.path.append(str(python_dir))
+
+import pyarrow.parquet as pq
+from core.analysis import AnalysisWorker
+from core.artifacts import LocalArtifactStore
+from core.models.analysis import AnalysisConfig, BioSample, DrugSample, MSTool
+from core.preprocess import preprocess_targeted_ions_file_streaming
+from core.utils.constants import TargetIonsColumn
+from core.utils.local_convex import LocalConvexClient
+from core.utils.memory import MB, MemoryBudget
+
+ANALYSIS_ID = "local"
+# defaults of `AnalysisConfigSchema` in convex/schema.ts
+DEFAULT_CONFIG = {
+    "minSignalThreshold": 5e5,
+    "signalEnrichmentFactor": 30,
+    "ms2SimilarityThreshold": 0.7,
+    "mzErrorThreshold": 0.01,
+    "rtTimeWindow": 0.02,
+    "correlationThreshold": 0.95,
+}
+
+
+def _names(value: str) -> list[str]:
+    return [name for name in value.split(",") if name]
+
+
+def parse_bio_sample(value: str) -> BioSample:
+    """`name:sample,sample,...:blank,blank,...`"""
+    try:
+        name, samples, blanks = value.split(":")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected name:samples:blanks, got {value!r}")
+    return BioSample(name=name, sample=_names(samples), blank=_names(blanks))
+
+
+def parse_drug_sample(value: str) -> DrugSample:
+    """`name:group,group,...`"""
+    try:
+        name, groups = value.split(":")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected name:groups, got {value!r}")
+    return DrugSample(name=name, groups=_names(groups))
+
+
+def _sample_cols(path: Path) -> list[str]:
+    # columns of a preprocessed table are stringified (level, name) tuples
+    columns = [
+        ast.literal_eval(name)
+        for name in pq.read_schema(path).names
+        if name.startswith("(")
+    ]
+    return [name for level, name in columns if level == TargetIonsColumn.SAMPLE]
+
+
+def store_inputs(convex: LocalConvexClient, ms1: Path, mgf: Path, tool: MSTool) -> dict:
+    """Store the input files the way the frontend and `preprocessIons` would."""
+    if ms1.suffix == ".parquet":
+        targeted_ions = convex.store_file(ms1, "target-ions.parquet")
+        sample_cols = _sample_cols(ms1)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            destination = Path(tmp_dir) / "target-ions.parquet"
+            sample_cols = preprocess_targeted_ions_file_streaming(
+                ms1, tool=tool, destination=destination
+            )
+            targeted_ions = convex.store_file(destination, "target-ions.parquet")
+    return {
+        "name": ms1.stem,
+        "tool": tool.value,
+        "mgf": convex.store_file(mgf),
+        "targetedIons": targeted_ions,
+        "sampleCols": sample_cols,
+    }
+
+
+def build_config(args: argparse.Namespace) -> dict:
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        config |= json.loads(args.config.read_text())
+    for field, value in (
+        ("minSignalThreshold", args.min_signal_threshold),
+        ("signalEnrichmentFactor", args.signal_enrichment_factor),
+        ("ms2SimilarityThreshold", args.ms2_similarity_threshold),
+        ("mzErrorThreshold", args.mz_error_threshold),
+        ("rtTimeWindow", args.rt_time_window),
+        ("correlationThreshold", args.correlation_threshold),
+        ("approximateSimilarity", args.approximate_similarity or None),
+    ):
+        if value is not None:
+            config[field] = value
+    if args.bio_sample:
+        config["bioSamples"] = [bio.model_dump() for bio in args.bio_sample]
+    if args.drug_sample:
+        config["drugSample"] = args.drug_sample.model_dump()
+    if not config.get("bioSamples"):
+        raise SystemExit(
+            "error: at least one --bio-sample (or a --config with bioSamples) "
+            "is required"
+        )
+    # fail before preprocessing rather than in the middle of the run
+    return AnalysisConfig(**config).model_dump(exclude_none=True)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    output: Path = args.output
+    output.mkdir(parents=True, exist_ok=True)
+    config = build_config(args)
+    convex = LocalConvexClient(storage_dir=output / "storage")
+
+    raw_file = store_inputs(convex, args.ms1, args.mgf, args.tool)
+    convex.analyses[ANALYSIS_ID] = {
+        "_id": ANALYSIS_ID,
+        "rawFile": raw_file,
+        "reactionDb": args.reaction_db,
+        "config": config,
+        "status": "running",
+        "progress": [],
+    }
+
+    worker = AnalysisWorker(
+        id=ANALYSIS_ID,
+        convex=convex,
+        store=LocalArtifactStore(args.checkpoints) if args.checkpoints else None,
+        metrics_path=str(output / "metrics.json"),
+        memory_budget=MemoryBudget(int(args.memory_budget_mb * MB))
+        if args.memory_budget_mb
+        else None,
+    )
+    start = time.perf_counter()
+    try:
+        await worker.run()
+    finally:
+        analysis = convex.analyses[ANALYSIS_ID]
+        (output / "analysis.json").write_text(json.dumps(analysis, indent=2))
+
+    for name, storage_id in analysis["result"].items():
+        shutil.copyfile(convex.path(storage_id), output / f"{name}.csv")
+    return {"analysis": analysis, "seconds": time.perf_counter() - start}
+
+
+def print_summary(output: Path, seconds: float) -> None:
+    metrics = json.loads((output / "metrics.json").read_text())
+    print(f"{'step':<40}{'wall':>10}{'cpu':>10}")
+    for step in metrics["steps"]:
+        print(
+            f"{step['step']:<40}{step['wall_seconds']:>9.2f}s"
+            f"{step['cpu_seconds']:>9.2f}s"
+        )
+    print(f"{'total':<40}{seconds:>9.2f}s")
+    print(f"peak RSS {metrics['peakRssBytes'] / MB:.0f} MB, results in {output}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the analysis pipeline offline")
+    parser.add_argument(
+        "ms1", type=Path, help="MS1 export, or a preprocessed .parquet feature table"
+    )
+    parser.add_argument("mgf", type=Path, help="MS2 spectra")
+    parser.add_argument(
+        "--tool",
+        type=MSTool,
+        default=MSTool.MSDial,
+        choices=list(MSTool),
+        help="Tool the MS1 export comes from",
+    )
+    parser.add_argument(
+        "--reaction-db", default="default-pos", choices=["default-pos", "default-neg"]
+    )
+    parser.add_argument(
+        "--config", type=Path, help="JSON analysis config, as stored in Convex"
+    )
+    parser.add_argument(
+        "--bio-sample",
+        type=parse_bio_sample,
+        action="append",
+        help="name:samples:blanks, repeatable",
+    )
+    parser.add_argument("--drug-sample", type=parse_drug_sample, help="name:groups")
+    parser.add_argument("--min-signal-threshold", type=float)
+    parser.add_argument("--signal-enrichment-factor", type=float)
+    parser.add_argument("--ms2-similarity-threshold", type=float)
+    parser.add_argument("--mz-error-threshold", type=float)
+    parser.add_argument("--rt-time-window", type=float)
+    parser.add_argument("--correlation-threshold", type=float)
+    parser.add_argument(
+        "--approximate-similarity",
+        action="store_true",
+        help="Allow the binned cosine for the largest runs",
+    )
+    parser.add_argument(
+        "--checkpoints", type=Path, help="Checkpoint directory, a rerun resumes from it"
+    )
+    parser.add_argument(
+        "--memory-budget-mb", type=float, help="Memory budget of the intermediates"
+    )
+    parser.add_argument("--output", type=Path, default=Path("pipeline-output"))
+    parser.add_argument("--quiet", action="store_true", help="Hide the step logs")
+    args = parser.parse_args()
+
+    if args.quiet:
+        logging.disable(logging.INFO)
+    result = asyncio.run(run(args))
+    print_summary(args.output, result["seconds"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1428 @@
+import asyncio
+import contextlib
+import fnmatch
+import functools
+import gc
+import importlib.util
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+from pathlib import Path
+from unittest import mock
+
+# Add python directory to Python path
+current_dir = Path(__file__).resolve().parent
+python_dir = current_dir.parent.parent
+sys.path.append(str(python_dir))
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import redis
+from benchmarks.mass import pyteomics_masses, reaction_formula_changes
+from benchmarks.synthetic import generate
+from core.artifacts import (
+    LocalArtifactStore,
+    RedisArtifactStore,
+    cached,
+    content_key,
+)
+from core.distributed import LocalMapExecutor
+from core.graph import ResultIndex
+from core.pipeline import Step, execute_step, run_dag, step_keys
+from core.mass import formula_masses
+from core.analysis import AnalysisWorker, result_key
+from core.models.analysis import (
+    Analysis,
+    AnalysisStatus,
+    BioSample,
+    DrugSample,
+    MSTool,
+)
+from core.planner import (
+    DataProfile,
+    InteractionEngine,
+    SimilarityEngine,
+    choose_engines,
+    plan_shared_similarity,
+)
+from core.utils import assets
+from core.batch import BatchAnalysisWorker
+from core.shared import SharedSpectra
+from core.steps import (
+    calculate_edge_metrics,
+    combine_matrices_and_extract_edges,
+    create_ion_interaction_matrix,
+    create_similarity_matrix,
+)
+from core.utils.concurrency import ConcurrencyLimiter
+from core.preprocess import (
+    preprocess_targeted_ions_file,
+    preprocess_targeted_ions_file_streaming,
+)
+from core.utils.constants import (
+    SCANS_KEY,
+    EdgeColumn,
+    MSDialColumn,
+    TargetIonsColumn,
+)
+from core.steps.load_data import _filter_metabolites, _referenced_columns
+from core.utils.convex import (
+    download_file,
+    load_binary,
+    load_parquet,
+    upload_csv,
+    upload_parquet,
+)
+from core.utils.dispatch import Dispatch, Dispatcher, MemoryRegistry
+from core.utils.local_convex import LocalConvexClient
+from core.utils.memory import MemoryBudget, attach, downcast, share, shared_copy
+from core.utils.progress import current_progress, track_progress
+from core.utils.status import StatusPublisher
+from matchms.Spectrum import Spectrum
+from scipy.sparse import coo_matrix, random as sparse_random
+
+
+class SlowConvexClient(LocalConvexClient):
+    """Takes a network round trip worth of time for every call."""
+
+    def _call(self, name, args):
+        time.sleep(0.05)
+        return super()._call(name, args)
+
+    query = mutation = action = _call
+
+
+class TestStatusPublisher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.convex = LocalConvexClient({"a1": {"status": "running", "progress": []}})
+
+    def progress(self) -> dict[str, str]:
+        return {p["step"]: p["status"] for p in self.convex.analyses["a1"]["progress"]}
+
+    async def test_publish_does_not_block(self):
+        convex = SlowConvexClient({"a1": {"status": "running", "progress": []}})
+        async with StatusPublisher("a1", convex) as status:
+            start = time.perf_counter()
+            for step in ("load_data", "create_similarity_matrix", "postprocessing"):
+                status.publish(step, AnalysisStatus.RUNNING)
+                await asyncio.sleep(0)
+            self.assertLess(time.perf_counter() - start, 0.05)
+
+        self.assertEqual(len(convex.analyses["a1"]["progress"]), 3)
+
+    async def test_updates_are_coalesced(self):
+        async with StatusPublisher("a1", self.convex) as status:
+            for step in ("load_data", "create_similarity_matrix"):
+                status.publish(step, AnalysisStatus.RUNNING)
+                status.publish(step, AnalysisStatus.COMPLETE)
+
+        self.assertEqual(len(self.convex.calls), 1)
+        self.assertEqual(
+            self.progress(),
+            {"load_data": "complete", "create_similarity_matrix": "complete"},
+        )
+
+    async def test_failed_calls_are_retried(self):
+        self.convex.failures = 2
+        async with StatusPublisher("a1", self.convex, base_delay=0) as status:
+            status.publish("load_data", AnalysisStatus.COMPLETE)
+
+        self.assertEqual(len(self.convex.calls), 3)
+        self.assertEqual(self.progress(), {"load_data": "complete"})
+
+    async def test_updates_are_dropped_after_max_retries(self):
+        self.convex.failures = 10
+        async with StatusPublisher(
+            "a1", self.convex, max_retries=2, base_delay=0
+        ) as status:
+            status.publish("load_data", AnalysisStatus.COMPLETE)
+
+        self.assertEqual(len(self.convex.calls), 3)
+        self.assertEqual(self.progress(), {})
+
+    async def test_flushes_on_failure(self):
+        with self.assertRaises(RuntimeError):
+            async with StatusPublisher("a1", self.convex) as status:
+                status.publish("postprocessing", AnalysisStatus.FAILED)
+                raise RuntimeError("step failed")
+
+        self.assertEqual(self.progress(), {"postprocessing": "failed"})
+        self.assertEqual(self.convex.analyses["a1"]["status"], "failed")
+
+    async def test_counters_from_a_step_thread(self):
+        def kernel():
+            progress = current_progress()
+            for _ in range(3):
+                progress.add("pairsScored", 10)
+
+        async with StatusPublisher("a1", self.convex) as status:
+            step = "create_similarity_matrix"
+            status.publish(step, AnalysisStatus.RUNNING)
+            with track_progress(step, status.progress):
+                await asyncio.to_thread(kernel)
+            status.publish(step, AnalysisStatus.COMPLETE)
+
+        (update,) = self.convex.analyses["a1"]["progress"]
+        self.assertEqual(update["status"], "complete")
+        self.assertEqual(update["counters"], {"pairsScored": 30})
+
+
+class TestLocalStorage(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.storage_dir = tempfile.TemporaryDirectory()
+        self.convex = LocalConvexClient(storage_dir=self.storage_dir.name)
+
+    def tearDown(self):
+        self.storage_dir.cleanup()
+
+    async def test_upload_and_download(self):
+        df = pd.DataFrame({"id": [1, 2], "mz": [100.5, 200.25]})
+        storage_id = upload_csv(df, file_name="nodes", convex=self.convex)
+        self.assertTrue(storage_id.endswith(".nodes.csv"))
+
+        blob = await load_binary(storage_id, self.convex)
+        self.assertEqual(blob.decode(), df.to_csv(index=False))
+
+        path = Path(self.storage_dir.name) / "copy.csv"
+        await download_file(storage_id, str(path), self.convex)
+        self.assertEqual(path.read_bytes(), blob)
+
+        self.convex.action("actions:removeFile", {"storageId": storage_id})
+        with self.assertRaises(ValueError):
+            self.convex.action("actions:generateDownloadUrl", {"storageId": storage_id})
+
+    async def test_load_parquet_keeps_every_sample_column(self):
+        df = pd.DataFrame(
+            {
+                ("", TargetIonsColumn.ID): [1, 2],
+                ("", TargetIonsColumn.MZ): [100.5, 200.25],
+                ("", TargetIonsColumn.RT): [1.0, 2.0],
+                ("", "Adduct"): ["[M+H]+", "[M+Na]+"],
+                (TargetIonsColumn.SAMPLE, "S0"): [1e6, 2e6],
+                (TargetIonsColumn.SAMPLE, "unreferenced"): [3e6, 4e6],
+            }
+        )
+        storage_id = upload_parquet(df, file_name="ions", convex=self.convex)
+
+        loaded = await load_parquet(
+            storage_id, self.convex, columns=_referenced_columns
+        )
+        self.assertEqual(
+            [col for col in df.columns if col[1] != "Adduct"], list(loaded.columns)
+        )
+
+
+class TestConcurrencyLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_limits_concurrent_jobs(self):
+        limiter = ConcurrencyLimiter(2)
+        peak = 0
+
+        async def job():
+            nonlocal peak
+            async with limiter.slot():
+                peak = max(peak, limiter.running)
+                await asyncio.sleep(0.01)
+
+        jobs = [asyncio.create_task(job()) for _ in range(5)]
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.metrics()["waiting"], 3)
+        await asyncio.gather(*jobs)
+
+        metrics = limiter.metrics()
+        self.assertEqual(peak, 2)
+        self.assertEqual((metrics["completed"], metrics["maxWaiting"]), (5, 3))
+        self.assertEqual((metrics["running"], metrics["waiting"]), (0, 0))
+        self.assertGreater(metrics["maxWaitSeconds"], 0)
+
+
+class TestDispatcher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.running: set[str] = set()
+        self.cancelled: list[str] = []
+        self.spawned = 0
+
+        async def is_running(call_id: str) -> bool:
+            return call_id in self.running
+
+        async def cancel(call_id: str) -> None:
+            self.running.discard(call_id)
+            self.cancelled.append(call_id)
+
+        self.dispatcher = Dispatcher(MemoryRegistry(), is_running, cancel)
+
+    async def spawn(self) -> str:
+        await asyncio.sleep(0.01)
+        self.spawned += 1
+        call_id = f"call-{self.spawned}"
+        self.running.add(call_id)
+        return call_id
+
+    async def test_concurrent_requests_share_a_run(self):
+        dispatches = await asyncio.gather(
+            *(self.dispatcher.dispatch("a1", self.spawn) for _ in range(5))
+        )
+        self.assertEqual({d.call_id for d in dispatches}, {"call-1"})
+        self.assertEqual(sum(d.spawned for d in dispatches), 1)
+
+    async def test_finished_runs_are_started_again(self):
+        await self.dispatcher.dispatch("a1", self.spawn)
+        self.running.clear()
+        dispatch = await self.dispatcher.dispatch("a1", self.spawn)
+        self.assertEqual((dispatch.call_id, dispatch.spawned), ("call-2", True))
+
+    async def test_restart_supersedes_the_run_in_progress_once(self):
+        await self.dispatcher.dispatch("a1", self.spawn)
+        restart = functools.partial(self.dispatcher.dispatch, restart=True)
+        dispatches = await asyncio.gather(
+            *(restart("a1", self.spawn) for _ in range(2))
+        )
+        self.assertEqual(self.cancelled, ["call-1"])
+        self.assertEqual({d.call_id for d in dispatches}, {"call-2"})
+
+    async def test_failed_spawns_free_the_key(self):
+        async def fail() -> str:
+            raise ConnectionError("modal unreachable")
+
+        with self.assertRaises(ConnectionError):
+            await self.dispatcher.dispatch("a1", fail)
+        dispatch = await self.dispatcher.dispatch("a1", self.spawn)
+        self.assertTrue(dispatch.spawned)
+
+    async def slow_spawn(self) -> str:
+        await asyncio.sleep(0.05)
+        return await self.spawn()
+
+    @mock.patch("core.utils.dispatch.CLAIM_SECONDS", 0.01)
+    async def test_spawns_outlasting_their_claim_keep_a_free_key(self):
+        dispatch = await self.dispatcher.dispatch("a1", self.slow_spawn)
+        self.assertEqual((dispatch.call_id, dispatch.spawned), ("call-1", True))
+        again = await self.dispatcher.dispatch("a1", self.spawn)
+        self.assertEqual((again.call_id, again.spawned), ("call-1", False))
+
+    @mock.patch("core.utils.dispatch.CLAIM_SECONDS", 0.01)
+    async def test_spawns_outlasting_their_claim_yield_to_a_later_run(self):
+        async def later() -> Dispatch:
+            await asyncio.sleep(0.02)  # the claim of the first has expired
+            return await self.dispatcher.dispatch("a1", self.spawn)
+
+        dispatches = await asyncio.gather(
+            self.dispatcher.dispatch("a1", self.slow_spawn), later()
+        )
+        # the later run was registered first, the slow one is cancelled
+        self.assertEqual(self.cancelled, ["call-2"])
+        self.assertEqual([d.call_id for d in dispatches], ["call-1", "call-1"])
+        self.assertEqual([d.spawned for d in dispatches], [False, True])
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.TemporaryDirectory()
+        self.budget = MemoryBudget(1024, self.spill_dir.name)
+
+    def tearDown(self):
+        self.spill_dir.cleanup()
+
+    def test_arrays_within_budget_stay_in_memory(self):
+        array = self.budget.zeros((16, 16), np.float32)
+        self.assertNotIsInstance(array, np.memmap)
+        self.assertIs(attach(share(array)), array)
+
+    def test_arrays_over_budget_are_spilled(self):
+        array = self.budget.zeros((64, 64), np.float32)
+        self.assertIsInstance(array, np.memmap)
+        array[3, 5] = 1.5
+
+        # other processes map the same file rather than receiving a copy
+        shared = attach(share(array))
+        self.assertEqual(shared.filename, array.filename)
+        self.assertEqual(shared[3, 5], 1.5)
+
+        del array, shared
+        gc.collect()
+        self.assertEqual(list(Path(self.spill_dir.name).iterdir()), [])
+
+    def test_budget_is_shared_by_live_arrays(self):
+        # each fits the budget on its own, but not both together
+        first = self.budget.zeros((12, 12), np.float32)
+        second = self.budget.zeros((12, 12), np.float32)
+        self.assertNotIsInstance(first, np.memmap)
+        self.assertIsInstance(second, np.memmap)
+        self.assertEqual(self.budget.allocated_bytes, first.nbytes)
+
+        del first
+        gc.collect()
+        self.assertEqual(self.budget.allocated_bytes, 0)
+        self.assertNotIsInstance(self.budget.zeros((12, 12), np.float32), np.memmap)
+
+    def test_shared_copies_are_mapped(self):
+        source = np.arange(12, dtype=np.float32).reshape(3, 4)
+        array = shared_copy(source)
+        self.assertIsInstance(array, np.memmap)
+        np.testing.assert_array_equal(array, source)
+
+        shared = attach(share(array))
+        self.assertEqual(shared.filename, array.filename)
+        path = Path(array.filename)
+        del array, shared
+        gc.collect()
+        self.assertFalse(path.exists())
+
+    def test_edge_metrics_spill_over_budget(self):
+        rng = np.random.default_rng(0)
+        ions = pd.DataFrame(
+            {
+                TargetIonsColumn.ID: np.arange(40),
+                TargetIonsColumn.MZ: rng.uniform(100, 500, 40),
+                TargetIonsColumn.RT: rng.uniform(0, 10, 40),
+            }
+        )
+        samples = pd.DataFrame(rng.uniform(0, 1e6, (40, 12)).astype(np.float32))
+        edges = pd.DataFrame(
+            {
+                EdgeColumn.ID1: rng.integers(0, 45, 200),
+                EdgeColumn.ID2: rng.integers(0, 40, 200),
+            }
+        )
+
+        with mock.patch.object(MemoryBudget, "zeros", wraps=self.budget.zeros) as zeros:
+            spilled = asyncio.run(
+                calculate_edge_metrics(samples, ions, edges, self.budget)
+            )
+        self.assertTrue(zeros.call_count)
+        expected = asyncio.run(calculate_edge_metrics(samples, ions, edges))
+        pd.testing.assert_frame_equal(spilled, expected)
+
+    def test_downcast(self):
+        df = pd.DataFrame({"id": [1, 2], "mz": [100.00001, 200.5], "big": [0, 2**40]})
+        downcast_df = downcast(df, columns=["id", "big"])
+        self.assertEqual(downcast_df["id"].dtype, np.int32)
+        self.assertEqual(downcast_df["mz"].dtype, np.float64)
+        self.assertEqual(downcast_df["big"].dtype, np.int64)
+        self.assertEqual(downcast(df)["mz"].dtype, np.float32)
+
+
+def _profile(ions: int, density: float = 0.005) -> DataProfile:
+    return DataProfile(
+        ions=ions,
+        spectra=ions,
+        reactions=120,
+        candidate_density=density,
+        mean_peaks=50,
+    )
+
+
+class TestPlanner(unittest.TestCase):
+    def test_small_runs_avoid_setup_costs(self):
+        plan = choose_engines(_profile(500), cpu_count=8)
+        self.assertEqual(plan.interaction, InteractionEngine.PAIRWISE)
+        self.assertEqual(plan.similarity, SimilarityEngine.CANDIDATES)
+        self.assertEqual(plan.workers, 1)
+
+    def test_large_runs_avoid_quadratic_work(self):
+        plan = choose_engines(_profile(50_000), cpu_count=8)
+        self.assertEqual(plan.interaction, InteractionEngine.SWEEP)
+        self.assertEqual(plan.similarity, SimilarityEngine.CANDIDATES)
+        self.assertEqual(plan.workers, 8)
+
+        plan = choose_engines(_profile(500_000), cpu_count=8)
+        self.assertEqual(plan.similarity, SimilarityEngine.CANDIDATES)
+        plan = choose_engines(_profile(500_000), cpu_count=8, approximate=True)
+        self.assertEqual(plan.similarity, SimilarityEngine.APPROXIMATE)
+
+    def test_shared_similarity_is_planned_like_any_other(self):
+        # three analyses of the same ions, scored once rather than three times
+        plan = plan_shared_similarity(
+            _profile(50_000), [_profile(50_000)] * 3, cpu_count=8
+        )
+        self.assertEqual(plan.similarity, SimilarityEngine.CANDIDATES)
+        self.assertEqual(plan.workers, 8)
+
+        # the exact engine would not fit, and the candidates do
+        plan = plan_shared_similarity(
+            _profile(20_000), [_profile(20_000)] * 2, memory_limit=1 << 30
+        )
+        self.assertEqual(plan.similarity, SimilarityEngine.CANDIDATES)
+        self.assertLessEqual(plan.predicted_bytes["create_similarity_matrix"], 1 << 30)
+
+    def test_disjoint_members_are_scored_separately(self):
+        # no pair in common, the union only adds the startup of its workers
+        union = _profile(20_000, density=500_050 / 200_010_000)
+        self.assertIsNone(
+            plan_shared_similarity(union, [_profile(10_000)] * 2, cpu_count=8)
+        )
+
+    def test_fanout_keeps_the_candidates_exact(self):
+        plan = choose_engines(_profile(150_000), cpu_count=8, approximate=True)
+        self.assertEqual(plan.similarity, SimilarityEngine.APPROXIMATE)
+
+        plan = choose_engines(
+            _profile(150_000), cpu_count=8, fanout=16, approximate=True
+        )
+        self.assertEqual(plan.similarity, SimilarityEngine.CANDIDATES)
+        self.assertTrue(plan.distributed)
+        self.assertFalse(choose_engines(_profile(500), fanout=16).distributed)
+
+
+class TestRunDag(unittest.IsolatedAsyncioTestCase):
+    """A diamond: `load` feeds `left` and `right`, which both feed `merge`."""
+
+    def setUp(self):
+        self.events: list[str] = []
+        self.started = {"left": asyncio.Event(), "right": asyncio.Event()}
+
+    def steps(self, left=None, right=None, scale: int = 2) -> list[Step]:
+        async def load():
+            self.events.append("load")
+            return 3
+
+        async def default_left(value, scale):
+            self.started["left"].set()
+            await self.started["right"].wait()
+            self.events.append("left")
+            return value * scale
+
+        async def default_right(value):
+            self.started["right"].set()
+            await self.started["left"].wait()
+            self.events.append("right")
+            return value + 1
+
+        async def merge(a, b):
+            self.events.append("merge")
+            return a + b
+
+        left = left or default_left
+        right = right or default_right
+        left.__name__, right.__name__ = "left", "right"
+        return [
+            Step(
+                merge, inputs={"a": "doubled", "b": "incremented"}, outputs=("total",)
+            ),
+            Step(left, inputs=["value"], outputs=("doubled",), params={"scale": scale}),
+            Step(right, inputs=["value"], outputs=("incremented",)),
+            Step(load, outputs=("value",)),
+        ]
+
+    async def run_steps(self, steps: list[Step]) -> dict:
+        return await asyncio.wait_for(
+            run_dag(steps, run_step=lambda step, kwargs: execute_step(step, kwargs)),
+            timeout=5,
+        )
+
+    async def test_steps_run_after_their_inputs(self):
+        artifacts = await self.run_steps(self.steps())
+        self.assertEqual(artifacts["total"], 10)
+        self.assertEqual(self.events[0], "load")
+        self.assertEqual(self.events[-1], "merge")
+
+    async def test_independent_steps_run_concurrently(self):
+        # each branch waits for the other to have started, run one after the
+        # other they would never finish
+        artifacts = await self.run_steps(self.steps())
+        self.assertEqual(set(self.events[1:3]), {"left", "right"})
+        self.assertEqual(artifacts["doubled"], 6)
+
+    async def test_a_failure_stops_the_dependent_steps(self):
+        cancelled = asyncio.Event()
+
+        async def left(value, scale):
+            await self.started["right"].wait()
+            raise RuntimeError("left failed")
+
+        async def right(value):
+            self.started["right"].set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with self.assertRaisesRegex(RuntimeError, "left failed"):
+            await self.run_steps(self.steps(left, right))
+        self.assertTrue(cancelled.is_set())
+        self.assertNotIn("merge", self.events)
+
+    async def test_unknown_inputs_are_rejected(self):
+        steps = self.steps()[:-1]
+        with self.assertRaisesRegex(ValueError, "unknown artifacts"):
+            await self.run_steps(steps)
+        self.assertEqual(self.events, [])
+
+    def test_keys_change_downstream_of_a_change(self):
+        keys, changed = step_keys(self.steps()), step_keys(self.steps(scale=3))
+        self.assertEqual(keys["load"], changed["load"])
+        self.assertEqual(keys["right"], changed["right"])
+        self.assertNotEqual(keys["left"], changed["left"])
+        self.assertNotEqual(keys["merge"], changed["merge"])
+
+
+class TestStepKeys(unittest.TestCase):
+    def keys(self, approximate: bool, fanout: int) -> dict[str, str]:
+        analysis = Analysis(
+            reactionDb="default-pos",
+            rawFile={
+                "name": "raw",
+                "tool": "MSDial",
+                "mgf": "spectra.mgf",
+                "targetedIons": "ions.parquet",
+                "sampleCols": ["S0", "B0"],
+            },
+            config={
+                "minSignalThreshold": 1e5,
+                "signalEnrichmentFactor": 3.0,
+                "ms2SimilarityThreshold": 0.7,
+                "mzErrorThreshold": 0.01,
+                "rtTimeWindow": 0.02,
+                "correlationThreshold": 0.95,
+                "bioSamples": [{"name": "bio", "sample": ["S0"], "blank": ["B0"]}],
+                "approximateSimilarity": approximate,
+            },
+        )
+        worker = AnalysisWorker(
+            id="a1",
+            convex=LocalConvexClient(),
+            map_executor=LocalMapExecutor(fanout),
+        )
+        return step_keys(worker._steps(analysis))
+
+    def test_fanout_keys_the_matrices_when_it_picks_the_engine(self):
+        # exact engines give the same matrices on every deployment
+        self.assertEqual(
+            self.keys(False, 1)["create_similarity_matrix"],
+            self.keys(False, 16)["create_similarity_matrix"],
+        )
+        self.assertNotEqual(
+            self.keys(True, 1)["create_similarity_matrix"],
+            self.keys(True, 16)["create_similarity_matrix"],
+        )
+        self.assertNotEqual(
+            self.keys(False, 1)["create_similarity_matrix"],
+            self.keys(True, 1)["create_similarity_matrix"],
+        )
+
+
+class TestDistributedSimilarity(unittest.TestCase):
+    def test_blocks_merge_into_the_local_matrix(self):
+        rng = np.random.default_rng(0)
+        spectra = [
+            Spectrum(
+                mz=np.sort(rng.uniform(50, 300, 20)),
+                intensities=rng.uniform(0.1, 1, 20),
+                metadata={SCANS_KEY: str(i), "precursor_mz": 300.0 + i},
+            )
+            for i in range(30)
+        ]
+        ids = np.arange(30)
+        rows, cols = rng.integers(0, 30, 200), rng.integers(0, 30, 200)
+        candidates = coo_matrix(
+            (np.ones(400), (np.r_[rows, cols], np.r_[cols, rows])), shape=(30, 30)
+        )
+        score = functools.partial(
+            create_similarity_matrix,
+            spectra,
+            ids,
+            SimilarityEngine.CANDIDATES,
+            candidates,
+        )
+        local = asyncio.run(score())
+
+        module = sys.modules["core.steps.create_similarity_matrix"]
+        with mock.patch.object(module, "FANOUT_BLOCK_PAIRS", 16):
+            distributed = asyncio.run(
+                score(distributed=True, executor=LocalMapExecutor(2))
+            )
+        np.testing.assert_array_equal(distributed.row, local.row)
+        np.testing.assert_array_equal(distributed.col, local.col)
+        np.testing.assert_allclose(distributed.data, local.data)
+
+
+class TestSharedSimilarity(unittest.TestCase):
+    def edges(self, matrix: coo_matrix, candidates: coo_matrix, ids) -> pd.DataFrame:
+        return asyncio.run(combine_matrices_and_extract_edges(candidates, matrix, ids))
+
+    def test_members_get_the_edges_of_separate_runs(self):
+        dataset = generate(ions=300, seed=3)
+        ions = dataset.targeted_ions_df
+        # overlapping members share pairs, disjoint ones are scored separately
+        for members, shared in (
+            ({"a": ions[:200], "b": ions[100:]}, True),
+            ({"a": ions[:150], "b": ions[150:]}, False),
+        ):
+            candidates = {
+                member: asyncio.run(
+                    create_ion_interaction_matrix(df, dataset.reaction_df)
+                )
+                for member, df in members.items()
+            }
+            ids = {
+                member: df[TargetIonsColumn.ID].values for member, df in members.items()
+            }
+            spectra = SharedSpectra(dataset.spectra, members)
+
+            async def batch():
+                return await asyncio.gather(
+                    *(
+                        spectra.create_similarity_matrix(
+                            dataset.spectra,
+                            ids[member],
+                            member,
+                            SimilarityEngine.CANDIDATES,
+                            candidates[member],
+                        )
+                        for member in members
+                    )
+                )
+
+            matrices = asyncio.run(batch())
+            self.assertEqual(spectra._task.result() is not None, shared)
+            for member, matrix in zip(members, matrices):
+                separate = asyncio.run(
+                    create_similarity_matrix(
+                        dataset.spectra,
+                        ids[member],
+                        SimilarityEngine.CANDIDATES,
+                        candidates[member],
+                    )
+                )
+                pd.testing.assert_frame_equal(
+                    self.edges(matrix, candidates[member], ids[member]),
+                    self.edges(separate, candidates[member], ids[member]),
+                )
+
+
+class TestFormulaMasses(unittest.TestCase):
+    def test_matches_pyteomics(self):
+        changes = reaction_formula_changes() + [
+            "(C5H5N5-H2O)",  # "-" within a fragment is invalid
+            "(+H2+CH2)",  # so is the empty fragment of a leading "+"
+            "C2H4O2+-H2O",
+            "C[13]2H-2",
+            "()",
+            "-",
+            "Xx2",
+        ]
+        np.testing.assert_allclose(
+            formula_masses(changes), pyteomics_masses(changes), rtol=0, atol=1e-9
+        )
+
+    def test_empty_change_is_an_error(self):
+        with self.assertRaises(ValueError):
+            formula_masses(["H2O", ""])
+
+
+class TestResultIndex(unittest.TestCase):
+    def setUp(self):
+        nodes = pd.DataFrame(
+            {
+                "id": [1, 2, 3, 4, 5, 6],
+                "mz": [100.0, 150.0, 200.0, 300.0, 350.0, 400.0],
+                "rt": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+                "isPrototype": [True, False, False, False, False, False],
+                "drug_ratio": [0.9, 0.5, 0.1, 0.2, 0.3, 0.0],
+            }
+        )
+        edges = pd.DataFrame(
+            {
+                "id1": [1, 2, 4, 4],
+                "id2": [2, 3, 5, 9],  # 9 is not a node
+                "matchedFormulaChange": ["(+O)", "(+H2)", "(+O)", "(+O)"],
+            }
+        )
+        self.index = ResultIndex(nodes, edges)
+
+    def components(self, **query) -> list[list[int]]:
+        nodes = self.index.query(**query).nodes
+        return [sorted(group["id"]) for _, group in nodes.groupby("component")]
+
+    def test_components_largest_first(self):
+        self.assertEqual(self.components(), [[1, 2, 3], [4, 5], [6]])
+        self.assertEqual(self.components(include_isolated=False, offset=1), [[4, 5]])
+
+    def test_filters(self):
+        self.assertEqual(self.components(mz_range=(120, 320)), [[2, 3], [4]])
+        self.assertEqual(
+            self.components(reactions=["(+O)"], include_isolated=False),
+            [[1, 2], [4, 5]],
+        )
+        self.assertEqual(self.components(prototype_only=True), [[1, 2, 3]])
+        self.assertEqual(
+            self.components(ratio_column="drug_ratio", ratio_range=(0.2, None)),
+            [[1, 2], [4, 5]],
+        )
+
+    def test_totals_cover_every_page(self):
+        result = self.index.query(limit=1)
+        self.assertEqual(
+            (result.total_components, result.total_nodes, result.total_edges),
+            (3, 6, 3),
+        )
+        self.assertEqual(len(result.edges), 2)
+
+
+class TestAssetTables(unittest.TestCase):
+    def test_compiled_tables_match_the_csvs(self):
+        with (
+            tempfile.TemporaryDirectory() as tmp_dir,
+            mock.patch.object(assets, "COMPILED_DIR", Path(tmp_dir)),
+        ):
+            from_csv = assets.read_asset_table("deduplicated_reactions")
+            assets.compile_asset_tables()
+            compiled = assets.read_asset_table("deduplicated_reactions")
+        pd.testing.assert_frame_equal(compiled, from_csv)
+
+
+class FakeRedis:
+    """The commands the artifact store sends to Redis, kept in process."""
+
+    def __init__(self):
+        self.hashes: dict[str, dict[bytes, bytes]] = {}
+        self.ttls: dict[str, int] = {}
+
+    def exists(self, key):
+        return int(key in self.hashes)
+
+    def delete(self, key):
+        self.ttls.pop(key, None)
+        return int(self.hashes.pop(key, None) is not None)
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(
+            {name.encode(): value for name, value in mapping.items()}
+        )
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def expire(self, key, seconds):
+        if key in self.hashes:
+            self.ttls[key] = seconds
+        return int(key in self.hashes)
+
+    def scan_iter(self, match):
+        return [key for key in list(self.hashes) if fnmatch.fnmatchcase(key, match)]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*a, **kw) for name, a, kw in self.calls]
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        # against a real server when one is configured, in process otherwise
+        url = os.environ.get("REDIS_URL")
+        client = redis.Redis.from_url(url) if url else FakeRedis()
+        self.redis = RedisArtifactStore(
+            client, ttl=60, max_bytes=2**20, prefix=f"test-{uuid.uuid4().hex}:"
+        )
+        self.addCleanup(self.redis.clear, "a1")
+        self.addCleanup(self.redis.clear, "content")
+
+    def artifacts(self) -> dict:
+        rng = np.random.default_rng(0)
+        spectra = [
+            Spectrum(
+                mz=np.sort(rng.uniform(50, 300, n)),
+                intensities=rng.uniform(0.1, 1, n),
+                metadata={SCANS_KEY: str(n), "precursor_mz": 300.0 + n},
+            )
+            for n in (3, 10, 1)
+        ]
+        return {
+            "spectra": spectra,
+            "matrix": sparse_random(50, 50, density=0.1, random_state=0).tocoo(),
+            "frame": pd.DataFrame({"id": [1, 2], "mz": [100.5, 200.25]}),
+            "ids": np.arange(5),
+            "engine": SimilarityEngine.CANDIDATES,
+        }
+
+    def assert_artifacts_equal(self, loaded: dict, artifacts: dict):
+        self.assertEqual(loaded.keys(), artifacts.keys())
+        self.assertEqual(loaded["spectra"], artifacts["spectra"])
+        self.assertEqual((loaded["matrix"] != artifacts["matrix"]).nnz, 0)
+        pd.testing.assert_frame_equal(loaded["frame"], artifacts["frame"])
+        np.testing.assert_array_equal(loaded["ids"], artifacts["ids"])
+        self.assertIs(loaded["engine"], artifacts["engine"])
+
+    def test_artifacts_round_trip(self):
+        artifacts = self.artifacts()
+        self.redis.save("a1", "k1", artifacts)
+        self.assertTrue(self.redis.exists("a1", "k1"))
+        self.assert_artifacts_equal(self.redis.load("a1", "k1"), artifacts)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local = LocalArtifactStore(tmp_dir)
+            local.save("a1", "k1", artifacts)
+            self.assert_artifacts_equal(local.load("a1", "k1"), artifacts)
+
+        self.redis.clear("a1")
+        self.assertFalse(self.redis.exists("a1", "k1"))
+
+    def test_large_steps_are_not_cached(self):
+        self.redis.max_bytes = 100
+        self.redis.save("a1", "k1", {"ids": np.arange(10_000)})
+        self.assertFalse(self.redis.exists("a1", "k1"))
+
+    def test_cached_loads_once(self):
+        calls = []
+
+        async def load():
+            calls.append(1)
+            return self.artifacts()["spectra"]
+
+        key = content_key("mgf", "storage-id")
+        first = asyncio.run(cached(self.redis, key, load))
+        second = asyncio.run(cached(self.redis, key, load))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(first, second)
+
+    def test_server_errors_are_misses(self):
+        self.redis.save("content", content_key("ids"), {"value": np.arange(3)})
+        failing = mock.Mock()
+        failing.execute.side_effect = redis.ConnectionError("unavailable")
+
+        async def load():
+            return np.arange(3)
+
+        with mock.patch.object(self.redis.client, "pipeline", return_value=failing):
+            with self.assertRaises(KeyError):
+                self.redis.load("content", content_key("ids"))
+            value = asyncio.run(cached(self.redis, content_key("ids"), load))
+        np.testing.assert_array_equal(value, np.arange(3))
+
+    def test_local_store_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            step = {"ids": np.arange(1000)}
+            local = LocalArtifactStore(tmp_dir, max_bytes=int(8000 * 2.5))
+            local.save("a1", "k1", step)
+            local.save("a1", "k2", step)
+            local.load("a1", "k1")
+            local.save("a1", "k3", step)
+            self.assertTrue(local.exists("a1", "k1"))
+            self.assertFalse(local.exists("a1", "k2"))
+            self.assertTrue(local.exists("a1", "k3"))
+
+            local.ttl = 0
+            self.assertFalse(local.exists("a1", "k1"))
+
+
+class TestStepProgress(unittest.TestCase):
+    def test_emits_are_throttled(self):
+        events = []
+        with track_progress("step", lambda step, c: events.append(c), interval=60):
+            for _ in range(1000):
+                current_progress().add("pairsScored")
+        # nothing within the interval, the final counters on leaving
+        self.assertEqual(events, [{"pairsScored": 1000}])
+
+        events.clear()
+        with track_progress("step", lambda step, c: events.append(c), interval=0):
+            current_progress().set("pairsTotal", 2)
+            current_progress().add("pairsScored", 2)
+        self.assertEqual(
+            events, [{"pairsTotal": 2}, {"pairsTotal": 2, "pairsScored": 2}]
+        )
+
+    def test_no_progress_outside_of_a_step(self):
+        current_progress().add("pairsScored")
+        self.assertEqual(current_progress().counters, {})
+
+
+@contextlib.contextmanager
+def _executed_steps():
+    """Names of the steps a worker executes rather than restores or skips."""
+    executed = []
+
+    async def execute(step, kwargs, executor=None):
+        executed.append(step.name)
+        return await execute_step(step, kwargs, executor)
+
+    with mock.patch("core.analysis.execute_step", execute):
+        yield executed
+
+
+class AnalysisTestCase(unittest.TestCase):
+    """Analyses of a small synthetic dataset, stored in a local Convex."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.dataset = generate(ions=200, seed=0)
+        paths = self.dataset.write(self.dir.name)
+        self.convex = self.client()
+        self.raw_file = {
+            "name": "raw",
+            "tool": "MSDial",
+            "mgf": self.convex.store_file(paths["spectra"]),
+            "targetedIons": self.convex.store_file(paths["features"]),
+            "sampleCols": list(self.dataset.samples_df.columns),
+        }
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def client(self) -> LocalConvexClient:
+        # storage ids follow the content, every client sees the same files
+        return LocalConvexClient(storage_dir=f"{self.dir.name}/storage")
+
+    def add_analysis(
+        self, id: str, convex: LocalConvexClient | None = None, **config
+    ) -> None:
+        (convex or self.convex).analyses[id] = {
+            "_id": id,
+            "rawFile": self.raw_file,
+            "reactionDb": "default-pos",
+            "config": {
+                "minSignalThreshold": 1e5,
+                "signalEnrichmentFactor": 3.0,
+                "ms2SimilarityThreshold": 0.7,
+                "mzErrorThreshold": 0.01,
+                "rtTimeWindow": 0.02,
+                "correlationThreshold": 0.95,
+                "bioSamples": [bio.model_dump() for bio in self.dataset.bio_samples],
+                "drugSample": self.dataset.drug_sample.model_dump(),
+            }
+            | config,
+            "status": "running",
+            "progress": [],
+        }
+
+    def edges(self, id: str, convex: LocalConvexClient | None = None) -> pd.DataFrame:
+        convex = convex or self.convex
+        return pd.read_csv(convex.path(convex.analyses[id]["result"]["edges"]))
+
+    def separate_edges(self, **config) -> pd.DataFrame:
+        """Edges of an analysis run from scratch, on a Convex of its own."""
+        convex = self.client()
+        self.add_analysis("separate", convex, **config)
+        asyncio.run(AnalysisWorker(id="separate", convex=convex).run())
+        return self.edges("separate", convex)
+
+
+class TestResume(AnalysisTestCase):
+    def test_retry_runs_only_the_steps_after_the_failure(self):
+        store = LocalArtifactStore(f"{self.dir.name}/checkpoints")
+        self.add_analysis("a1")
+        worker = AnalysisWorker(id="a1", convex=self.convex, store=store)
+
+        async def edge_value_matching(**kwargs):
+            raise RuntimeError("matching failed")
+
+        with mock.patch("core.steps.edge_value_matching", edge_value_matching):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(worker.run())
+        self.assertEqual(self.convex.analyses["a1"]["status"], "failed")
+
+        with _executed_steps() as executed:
+            asyncio.run(worker.run())
+        # everything upstream of the failed step is restored or skipped
+        self.assertEqual(
+            set(executed),
+            {"filter_edges", "edge_value_matching", "postprocessing", "upload_result"},
+        )
+        self.assertEqual(self.convex.analyses["a1"]["status"], "complete")
+        pd.testing.assert_frame_equal(self.edges("a1"), self.separate_edges())
+
+
+class TestIncrementalAnalysis(AnalysisTestCase):
+    def test_new_thresholds_only_filter_the_cached_candidates(self):
+        store = LocalArtifactStore(f"{self.dir.name}/checkpoints")
+        self.add_analysis("a1")
+        asyncio.run(AnalysisWorker(id="a1", convex=self.convex, store=store).run())
+
+        thresholds = {"ms2SimilarityThreshold": 0.994, "correlationThreshold": 0.9}
+        self.add_analysis("a2", **thresholds)
+        with _executed_steps() as executed:
+            asyncio.run(AnalysisWorker(id="a2", convex=self.convex, store=store).run())
+        self.assertIn("filter_edges", executed)
+        for step in (
+            "create_ion_interaction_matrix",
+            "create_similarity_matrix",
+            "combine_matrices_and_extract_edges",
+            "calculate_edge_metrics",
+        ):
+            self.assertNotIn(step, executed)
+
+        edges = self.edges("a2")
+        self.assertTrue(len(edges))
+        self.assertLess(len(edges), len(self.edges("a1")))
+        pd.testing.assert_frame_equal(edges, self.separate_edges(**thresholds))
+
+
+class TestResultCache(AnalysisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_analysis("a1")
+        asyncio.run(AnalysisWorker(id="a1", convex=self.convex).run())
+
+    def run_analysis(self, id: str) -> list[str]:
+        with _executed_steps() as executed:
+            asyncio.run(AnalysisWorker(id=id, convex=self.convex).run())
+        self.assertEqual(self.convex.analyses[id]["status"], "complete")
+        return executed
+
+    def test_identical_inputs_link_the_same_result(self):
+        # a renamed duplicate
+        self.add_analysis("a2")
+        self.convex.analyses["a2"]["rawFile"] = self.raw_file | {"name": "copy"}
+        self.assertEqual(self.run_analysis("a2"), [])
+        a1, a2 = self.convex.analyses["a1"], self.convex.analyses["a2"]
+        self.assertEqual(a2["result"], a1["result"])
+        self.assertEqual(a2["resultKey"], a1["resultKey"])
+
+    def test_any_change_misses(self):
+        analysis = self.convex.analyses["a1"]
+        key = result_key(Analysis(**analysis))
+        for changed in (
+            analysis | {"config": analysis["config"] | {"rtTimeWindow": 0.05}},
+            analysis | {"rawFile": self.raw_file | {"mgf": "other.mgf"}},
+            analysis | {"reactionDb": "default-neg"},
+        ):
+            self.assertNotEqual(result_key(Analysis(**changed)), key)
+        with mock.patch("core.analysis.RESULT_VERSION", -1):
+            self.assertNotEqual(result_key(Analysis(**analysis)), key)
+
+        self.add_analysis("a2", rtTimeWindow=0.05)
+        self.assertIn("edge_value_matching", self.run_analysis("a2"))
+        self.assertNotEqual(
+            self.convex.analyses["a2"]["result"], self.convex.analyses["a1"]["result"]
+        )
+
+    def test_a_result_no_longer_stored_is_computed_again(self):
+        edges = self.edges("a1")
+        storage_id = self.convex.analyses["a1"]["result"]["edges"]
+        self.convex.action("actions:removeFile", {"storageId": storage_id})
+
+        self.add_analysis("a2")
+        self.assertIn("edge_value_matching", self.run_analysis("a2"))
+        self.assertNotEqual(self.convex.analyses["a2"]["result"]["edges"], storage_id)
+        pd.testing.assert_frame_equal(self.edges("a2"), edges)
+
+
+class TestBatch(AnalysisTestCase):
+    def test_analyses_get_the_edges_of_separate_runs(self):
+        configs = {
+            "a1": {},
+            "a2": {"mzErrorThreshold": 0.02, "correlationThreshold": 0.9},
+            "a3": {"ms2SimilarityThreshold": 0.994},
+        }
+        for id, config in configs.items():
+            self.add_analysis(id, **config)
+
+        plans = []
+
+        def plan(*args, **kwargs):
+            plans.append(plan_shared_similarity(*args, **kwargs))
+            return plans[-1]
+
+        with mock.patch("core.shared.plan_shared_similarity", plan):
+            errors = asyncio.run(
+                BatchAnalysisWorker(ids=list(configs), convex=self.convex).run()
+            )
+        self.assertEqual(errors, {})
+        # the members share most of their pairs, they are scored once
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(plans[0].similarity, SimilarityEngine.CANDIDATES)
+
+        for id, config in configs.items():
+            pd.testing.assert_frame_equal(self.edges(id), self.separate_edges(**config))
+
+
+def _pandas_preprocess(blob: bytes, tool: MSTool) -> tuple[pd.DataFrame, list[str]]:
+    """The preprocessing of exports before it was moved to pyarrow, as a reference."""
+    if tool is MSTool.MZmine3:
+        df = pd.read_csv(io.BytesIO(blob))
+        rename_dict = {
+            col: col.split(".")[0] for col in df.columns if ".raw Peak" in col
+        }
+        df.dropna(axis=1, how="all", inplace=True)
+        df = df.rename(
+            columns={
+                "row m/z": TargetIonsColumn.MZ,
+                "row retention time": TargetIonsColumn.RT,
+                "row ID": TargetIonsColumn.ID,
+            }
+            | rename_dict
+        )
+        sample_cols = list(rename_dict.values())
+    else:
+        na_cols_mask = pd.read_csv(
+            io.BytesIO(blob), sep="\t", nrows=1
+        ).columns.str.contains("NA", na=False)
+        df = pd.read_csv(io.BytesIO(blob), sep="\t", skiprows=4)
+        df = df[df[MSDialColumn.MSMS_ASSIGNED]]
+        df = df.drop(df.columns[na_cols_mask | (df.isna() | (df == "")).all()], axis=1)
+        df = df.rename(
+            columns={
+                "Average Mz": TargetIonsColumn.MZ,
+                "Average Rt(min)": TargetIonsColumn.RT,
+                "Alignment ID": TargetIonsColumn.ID,
+            }
+        )
+        sample_cols = df.columns[
+            df.columns.get_loc(MSDialColumn.MSMS_SPECTRUM) + 1 :
+        ].tolist()
+    df.columns = pd.MultiIndex.from_tuples(
+        [("sample" if col in sample_cols else "", col) for col in df.columns]
+    )
+    return df.reset_index(drop=True), sample_cols
+
+
+def _export(rows: list[str], delimiter: str) -> bytes:
+    """An export from rows written with commas between the fields."""
+    return "\n".join(row.replace(",", delimiter) for row in rows).encode()
+
+
+# S2 only has values in a row without MS/MS, S3 has none at all, S1 misses one
+MSDIAL_EXPORT = _export(
+    [
+        ",,,,,,Class,G1,G1,G1,G1,NA,NA",
+        ",,,,,,File type,0,1,2,3,NA,NA",
+        ",,,,,,Injection order,0,1,2,3,NA,NA",
+        ",,,,,,Batch ID,0,1,2,3,NA,NA",
+        "Alignment ID,Average Rt(min),Average Mz,Metabolite name,"
+        "Post curation result,MS/MS assigned,MS/MS spectrum,S0,S1,S2,S3,G1,G1",
+        "1,1.5,100.1,Unknown,,True,100:20 200:30,1e6,2e6,,,1.5e6,5e5",
+        "2,2.5,200.2,Unknown,,False,,3e6,4e6,7e5,,3.5e6,5e5",
+        "3,3.5,300.3,Glucose,,True,150:10,5e5,,,,5e5,0",
+    ],
+    "\t",
+)
+
+# c is empty, the comment only filled for one row
+MZMINE3_EXPORT = _export(
+    [
+        "row ID,row m/z,row retention time,"
+        "a.raw Peak height,b.raw Peak height,c.raw Peak height,comment",
+        "1,100.1,1.5,1000.0,2000.0,,note",
+        "2,200.2,2.5,3000.0,,,",
+    ],
+    ",",
+)
+
+
+class TestPreprocess(unittest.TestCase):
+    def test_msdial_keeps_the_rows_with_msms_and_non_empty_columns(self):
+        df, sample_cols = preprocess_targeted_ions_file(MSDIAL_EXPORT, MSTool.MSDial)
+        self.assertEqual(sample_cols, ["S0", "S1"])
+        self.assertEqual(df[("", TargetIonsColumn.ID)].tolist(), [1, 3])
+        self.assertEqual(
+            list(df.columns),
+            [
+                ("", TargetIonsColumn.ID),
+                ("", TargetIonsColumn.RT),
+                ("", TargetIonsColumn.MZ),
+                ("", "Metabolite name"),
+                ("", MSDialColumn.MSMS_ASSIGNED),
+                ("", MSDialColumn.MSMS_SPECTRUM),
+                (TargetIonsColumn.SAMPLE, "S0"),
+                (TargetIonsColumn.SAMPLE, "S1"),
+            ],
+        )
+        # a missing value is kept as NaN, only entirely empty columns go
+        self.assertTrue(np.isnan(df[(TargetIonsColumn.SAMPLE, "S1")].iloc[1]))
+        self.assertEqual(df[(TargetIonsColumn.SAMPLE, "S0")].dtype, np.float32)
+
+    def test_mzmine3_renames_the_peak_columns(self):
+        df, sample_cols = preprocess_targeted_ions_file(MZMINE3_EXPORT, MSTool.MZmine3)
+        self.assertEqual(sample_cols, ["a", "b"])
+        self.assertEqual(
+            list(df.columns),
+            [
+                ("", TargetIonsColumn.ID),
+                ("", TargetIonsColumn.MZ),
+                ("", TargetIonsColumn.RT),
+                (TargetIonsColumn.SAMPLE, "a"),
+                (TargetIonsColumn.SAMPLE, "b"),
+                ("", "comment"),
+            ],
+        )
+
+    def test_matches_the_pandas_parser(self):
+        for export, tool in (
+            (MSDIAL_EXPORT, MSTool.MSDial),
+            (MZMINE3_EXPORT, MSTool.MZmine3),
+        ):
+            with self.subTest(tool=tool):
+                df, sample_cols = preprocess_targeted_ions_file(export, tool)
+                expected, expected_sample_cols = _pandas_preprocess(export, tool)
+                # intensities are parsed as float32 now
+                pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+                # the pandas parser listed empty sample columns it had dropped
+                self.assertEqual(
+                    sample_cols,
+                    [
+                        col
+                        for col in expected_sample_cols
+                        if (TargetIonsColumn.SAMPLE, col) in expected.columns
+                    ],
+                )
+
+
+class TestStreamingPreprocess(unittest.TestCase):
+    def test_matches_the_in_memory_preprocess(self):
+        module = sys.modules["core.preprocess"]
+        # a block holds at least one row, the rows of each export are shorter
+        for export, tool, block_size in (
+            (MSDIAL_EXPORT, MSTool.MSDial, 64),
+            (MZMINE3_EXPORT, MSTool.MZmine3, 32),
+        ):
+            with self.subTest(tool=tool), tempfile.TemporaryDirectory() as tmp_dir:
+                source = Path(tmp_dir) / "export.txt"
+                source.write_bytes(export)
+                destination = Path(tmp_dir) / "target-ions.parquet"
+                # so that several row groups are written
+                with mock.patch.object(module, "STREAM_BLOCK_SIZE", block_size):
+                    sample_cols = preprocess_targeted_ions_file_streaming(
+                        source, tool, destination
+                    )
+                self.assertGreater(pq.ParquetFile(destination).num_row_groups, 1)
+
+                expected, expected_sample_cols = preprocess_targeted_ions_file(
+                    export, tool
+                )
+                self.assertEqual(sample_cols, expected_sample_cols)
+                # the pandas metadata restores the MultiIndex columns, empty
+                # columns stay in the streamed file
+                df = pd.read_parquet(destination)
+                self.assertIsInstance(df.columns, pd.MultiIndex)
+                pd.testing.assert_frame_equal(df[expected.columns], expected)
+
+
+def _pandas_filter_metabolites(
+    data: pd.DataFrame,
+    bio_samples: list[BioSample],
+    drug_sample: DrugSample | None,
+    min_signal_threshold: float,
+    signal_enrichment_factor: float,
+) -> pd.DataFrame:
+    """The filter before it was vectorized, one group at a time, as a reference."""
+    data = data.copy()
+    samples_df = data[TargetIonsColumn.SAMPLE]
+    cond = pd.Series(False, index=data.index)
+    for bio in bio_samples:
+        blank_mean = samples_df[bio.blank].mean(axis=1)
+        sample_max = samples_df[bio.sample].max(axis=1)
+        cond |= (sample_max > min_signal_threshold) & (
+            sample_max > signal_enrichment_factor * blank_mean
+        )
+        data[(TargetIonsColumn.SAMPLE, bio.name)] = samples_df[bio.sample].mean(axis=1)
+    if drug_sample:
+        data[(TargetIonsColumn.SAMPLE, drug_sample.name)] = samples_df[
+            drug_sample.groups
+        ].mean(axis=1)
+        data[("", TargetIonsColumn.IS_PROTOTYPE)] = cond & (
+            data[(TargetIonsColumn.SAMPLE, drug_sample.name)] > min_signal_threshold
+        )
+    return data[cond].drop_duplicates()
+
+
+class TestFilterMetabolites(unittest.TestCase):
+    def test_matches_the_per_group_filter(self):
+        rng = np.random.default_rng(0)
+        names = ["S0", "S1", "S2", "S3", "S4", "D0", "D1", "B0", "B1"]
+        matrix = rng.lognormal(13, 2, (400, len(names))).astype(np.float32)
+        matrix[rng.random(matrix.shape) < 0.2] = np.nan
+        # all-NaN sample groups, blanks and rows, and a duplicated row
+        matrix[:20, :3] = np.nan
+        matrix[20:40, 7:] = np.nan
+        matrix[40:50] = np.nan
+        matrix[51] = matrix[50] = matrix[60]
+        data = pd.DataFrame(
+            matrix,
+            columns=pd.MultiIndex.from_product([[TargetIonsColumn.SAMPLE], names]),
+        )
+        data[("", TargetIonsColumn.ID)] = np.arange(len(data))
+        data.loc[51, ("", TargetIonsColumn.ID)] = 50
+        data.loc[50, ("", TargetIonsColumn.ID)] = 50
+
+        bio_samples = [
+            BioSample(name="bio", sample=["S0", "S1", "S2"], blank=["B0", "B1"]),
+            # no blank at all, and a sample shared with the other group
+            BioSample(name="other", sample=["S2", "S3", "S4"], blank=[]),
+        ]
+        for drug_sample in (DrugSample(name="drug", groups=["D0", "D1"]), None):
+            with self.subTest(drug_sample=drug_sample):
+                args = (bio_samples, drug_sample, 5e5, 3.0)
+                filtered = _filter_metabolites(data.copy(), *args)
+                expected = _pandas_filter_metabolites(data, *args)
+                self.assertGreater(len(expected), 0)
+                self.assertLess(len(expected), len(data))
+                # the group means are float32 sums now
+                pd.testing.assert_frame_equal(
+                    filtered, expected, check_dtype=False, rtol=1e-5
+                )
+
+
+class TestLocalRun(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.paths = generate(ions=200, seed=0).write(self.dir.name)
+        spec = importlib.util.spec_from_file_location("run", current_dir / "run.py")
+        self.run = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.run)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def main(self, output: str) -> dict:
+        argv = [
+            "run.py",
+            str(self.paths["features"]),
+            str(self.paths["spectra"]),
+            "--bio-sample",
+            "bio:S0,S1,S2:B0",
+            "--drug-sample",
+            "drug:S3,S4,S5",
+            "--min-signal-threshold",
+            "1e5",
+            "--checkpoints",
+            f"{self.dir.name}/checkpoints",
+            "--output",
+            f"{self.dir.name}/{output}",
+            "--quiet",
+        ]
+        with (
+            mock.patch.object(sys, "argv", argv),
+            contextlib.redirect_stdout(io.StringIO()),
+        ):
+            self.run.main()
+        logging.disable(logging.NOTSET)
+        metrics = json.loads(Path(self.dir.name, output, "metrics.json").read_text())
+        return {step["step"] for step in metrics["steps"]}
+
+    def test_rerun_resumes_from_the_checkpoints(self):
+        first = self.main("first")
+        second = self.main("second")
+        self.assertIn("create_similarity_matrix", first)
+        # the inputs get the same storage ids, so the shared steps are restored
+        for step in (
+            "create_ion_interaction_matrix",
+            "create_similarity_matrix",
+            "calculate_edge_metrics",
+        ):
+            self.assertNotIn(step, second)
+        pd.testing.assert_frame_equal(
+            pd.read_csv(Path(self.dir.name, "first", "edges.csv")),
+            pd.read_csv(Path(self.dir.name, "second", "edges.csv")),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,7 +16,11 @@ sys.path.append(str(python_dir))
 import pandas as pd
 from core.models.analysis import MSTool
 from core.preprocess import preprocess_targeted_ions_file
-from core.recursive.run import RecursiveAnalysisConfig, RecursiveAnalyzer
+from core.recursive.run import (
+    RecursiveAnalysisConfig,
+    RecursiveAnalyzer,
+    _find_reaction_neighbors_fast,
+)
 import numpy as np
 
 
@@ -173,6 +177,34 @@ class TestRecursiveAnalyzer(unittest.TestCase):
         asyncio.run(run_test())
 
 
+class TestReactionNeighbors(unittest.TestCase):
+    def test_matches_every_pair_within_threshold(self):
+        rng = np.random.default_rng(0)
+        mz = np.sort(rng.uniform(100, 1000, 2000))
+        # reactions smaller than the threshold match on both sides at once
+        reaction_mz_diffs = np.concatenate(
+            [[0.0, 0.004], rng.uniform(0.5, 400, 200)]
+        ).astype(np.float32)
+        threshold = 0.01
+
+        for source in (0, 1000, 1999):
+            positions, reactions = _find_reaction_neighbors_fast(
+                mz[source], mz, reaction_mz_diffs, threshold
+            )
+            found = set(zip(positions.tolist(), reactions.tolist()))
+            self.assertEqual(len(found), len(positions))
+
+            differences = np.abs(mz - mz[source])
+            expected = {
+                (int(position), int(reaction))
+                for reaction, reaction_mz_diff in enumerate(reaction_mz_diffs)
+                for position in np.flatnonzero(
+                    np.abs(differences - reaction_mz_diff) <= threshold
+                )
+            }
+            self.assertEqual(found, expected)
+
+
 async def run_analysis(ms1_file: Path, ms2_file: Path, parent_mz_list: list, parent_mz_error: float = 0.01):
     """Run the analysis with specified MS1 and MS2 files.
 
@@ -1,15 +1,44 @@
+import asyncio
+import functools
+import json
 import logging
+import multiprocessing
+import os
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tempfile import mkdtemp
 
 import fastapi
 import modal
 import pandas as pd
-import pyteomics.mass
-from core.models.analysis import AnalysisTriggerInput, MassInput, PreprocessIonsInput
-from core.preprocess import preprocess_targeted_ions_file
-from core.utils.convex import ConvexClient, get_convex, load_binary
+import pyarrow.csv as pacsv
+from core.graph import ResultIndex
+from core.mass import formula_masses
+from core.models.analysis import (
+    AnalysisBatchTriggerInput,
+    AnalysisStatus,
+    AnalysisTriggerInput,
+    MassInput,
+    MSTool,
+    PreprocessIonsInput,
+    SubgraphQueryInput,
+)
+from core.preprocess import preprocess_targeted_ions_file_streaming
+from core.utils.concurrency import ConcurrencyLimiter
+from core.utils.dispatch import Dispatcher, MemoryRegistry, RedisRegistry
+from core.utils.convex import (
+    MIME_TYPE_PARQUET,
+    AsyncConvexClient,
+    download_file,
+    get_convex,
+    upload_file,
+)
 from core.utils.logger import logger
+from core.utils.constants import TargetIonsColumn
 from fastapi import Depends, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from pydantic import BaseModel
 from remote.image import image
@@ -18,9 +47,102 @@ app = modal.App("analysis-api")
 web = fastapi.FastAPI()
 security = HTTPBearer()
 
+# files preprocessed at once, more wait in line rather than compete for the CPU
+PREPROCESS_CONCURRENCY = int(os.environ.get("PREPROCESS_CONCURRENCY", 2))
+preprocess_limiter = ConcurrencyLimiter(PREPROCESS_CONCURRENCY)
+# parsing holds the GIL for long stretches, in a process it cannot stall the
+# event loop. Created on first use, spawned rather than forked from the loop.
+_preprocess_pool: ProcessPoolExecutor | None = None
+
+
+def _get_preprocess_pool() -> ProcessPoolExecutor:
+    global _preprocess_pool
+    if _preprocess_pool is None:
+        _preprocess_pool = ProcessPoolExecutor(
+            max_workers=PREPROCESS_CONCURRENCY,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _preprocess_pool
+
+
+async def _preprocess_in_pool(source: str, tool: MSTool, destination: str) -> list[str]:
+    global _preprocess_pool
+    pool = _get_preprocess_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            pool, preprocess_targeted_ions_file_streaming, source, tool, destination
+        )
+    except BrokenProcessPool:
+        # a worker died (e.g. out of memory), later requests get a fresh pool
+        if _preprocess_pool is pool:
+            _preprocess_pool = None
+        pool.shutdown(wait=False)
+        raise
+
+
+# indexed results kept in memory, the graph view queries the same one repeatedly
+RESULT_INDEX_CACHE_SIZE = int(os.environ.get("RESULT_INDEX_CACHE_SIZE", 8))
+# loads are shared by concurrent queries of the same result
+_result_indexes: OrderedDict[tuple[str, str], asyncio.Task[ResultIndex]] = OrderedDict()
+
+# how often the progress stream looks for new counters, workers send them at
+# most once a second
+PROGRESS_POLL_SECONDS = float(os.environ.get("PROGRESS_POLL_SECONDS", 1.0))
+# comment lines sent while nothing changes, so that proxies keep the stream open
+PROGRESS_KEEPALIVE_SECONDS = 15.0
+
+
+# runs are kept in flight at most as long as the worker functions may take
+RUN_TTL_SECONDS = 60 * 60
+WORKER_APP = "analysis-worker"
+
+
+@functools.cache
+def _worker_function(name: str) -> modal.Function:
+    # looked up once per container rather than on every request
+    return modal.Function.lookup(WORKER_APP, name)
+
+
+def _is_running(call_id: str) -> bool:
+    try:
+        modal.FunctionCall.from_id(call_id).get(timeout=0)
+    except modal.exception.FunctionTimeoutError:
+        return False
+    except (TimeoutError, modal.exception.TimeoutError):
+        # no output yet
+        return True
+    except Exception:
+        # failed, cancelled or expired, done either way
+        return False
+    return False
+
+
+def _cancel(call_id: str) -> None:
+    modal.FunctionCall.from_id(call_id).cancel()
+
+
+# REDIS_URL shares the runs in flight between API containers, without it every
+# container only deduplicates the requests it receives itself
+dispatcher = Dispatcher(
+    registry=RedisRegistry.from_url(os.environ["REDIS_URL"])
+    if os.environ.get("REDIS_URL")
+    else MemoryRegistry(),
+    is_running=lambda call_id: asyncio.to_thread(_is_running, call_id),
+    cancel=lambda call_id: asyncio.to_thread(_cancel, call_id),
+    ttl=RUN_TTL_SECONDS,
+)
+
+
+async def _spawn(function: str, input: BaseModel, convex_token: str) -> str:
+    worker = await asyncio.to_thread(_worker_function, function)
+    call = await asyncio.to_thread(worker.spawn, input, convex_token=convex_token)
+    return call.object_id
+
 
 class AnalysisResponse(BaseModel):
     call_id: str
+    # whether the call of a run already in progress was returned
+    deduplicated: bool = False
 
 
 class PreprocessIonsResponse(BaseModel):
@@ -38,9 +160,31 @@ def api():
 async def start_analysis(
     input: AnalysisTriggerInput, token: HTTPAuthorizationCredentials = Depends(security)
 ) -> AnalysisResponse:
-    process_analysis = modal.Function.lookup("analysis-worker", "run_analysis_workflow")
-    call = process_analysis.spawn(input, convex_token=token.credentials)
-    return AnalysisResponse(call_id=call.object_id)
+    """
+    Start the worker of an analysis, once.
+
+    While a run of the analysis is in progress, repeated requests (double
+    clicks, retries of the frontend) get its call id rather than a new run,
+    unless `restart` asks to cancel it and start over.
+    """
+    dispatch = await dispatcher.dispatch(
+        input.id,
+        lambda: _spawn("run_analysis_workflow", input, token.credentials),
+        restart=input.restart,
+    )
+    return AnalysisResponse(call_id=dispatch.call_id, deduplicated=not dispatch.spawned)
+
+
+@web.post("/analysis/startBatch")
+async def start_analysis_batch(
+    input: AnalysisBatchTriggerInput,
+    token: HTTPAuthorizationCredentials = Depends(security),
+) -> AnalysisResponse:
+    dispatch = await dispatcher.dispatch(
+        "batch:" + ",".join(sorted(input.ids)),
+        lambda: _spawn("run_analysis_batch", input, token.credentials),
+    )
+    return AnalysisResponse(call_id=dispatch.call_id, deduplicated=not dispatch.spawned)
 
 
 @web.post("/analysis/mass")
@@ -58,39 +202,13 @@ async def mass(input: MassInput) -> dict[str, list[float]]:
         HTTPException: If there's an error in calculation or invalid input
     """
     try:
-        masses = []
-        for formula_change in input.formulaChanges:
-            if formula_change[0] == "(" and formula_change[-1] == ")":
-                formula_change = formula_change[1:-1]
-            try:
-                mass = sum(
-                    [
-                        -pyteomics.mass.calculate_mass(formula=formula[1:])
-                        if formula[0] == "-"
-                        else pyteomics.mass.calculate_mass(formula=formula)
-                        for formula in formula_change.split("+")
-                    ]
-                )
-            except Exception:
-                mass = 0
-            masses.append(mass)
-        return {"masses": masses}
+        # invalid formulas get a mass of 0 rather than failing the whole request
+        return {"masses": formula_masses(input.formulaChanges).tolist()}
     except Exception as e:
         logger.log(logging.ERROR, e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
-def _upload_parquet(df: pd.DataFrame, file_name: str, convex: ConvexClient) -> str:
-    """Helper function to upload parquet file to storage"""
-    parquet_buffer = df.to_parquet()
-    response = convex.action(
-        "actions:uploadFile",
-        {"file": parquet_buffer, "fileName": f"{file_name}.parquet"},
-    )
-    # Extract storageId from the response
-    return response["storageId"]
-
-
 @web.post("/analysis/preprocessIons")
 async def preprocess_ions(
     input: PreprocessIonsInput, token: HTTPAuthorizationCredentials = Depends(security)
@@ -108,11 +226,30 @@ async def preprocess_ions(
     Raises:
         HTTPException: If preprocessing fails
     """
-    convex = get_convex(token.credentials)
+    convex = AsyncConvexClient(get_convex(token.credentials))
     try:
-        blob: bytes = await load_binary(input.targetedIons, convex=convex)
-        df, sample_cols = preprocess_targeted_ions_file(blob=blob, tool=input.tool)
-        storage_id = _upload_parquet(df, file_name="target-ions", convex=convex)
+        async with preprocess_limiter.slot() as waited:
+            logger.info(
+                "preprocess queue %s",
+                json.dumps(
+                    preprocess_limiter.metrics() | {"waitedSeconds": round(waited, 3)}
+                ),
+            )
+            # stream the export through disk so memory stays flat for multi-GB files
+            tmp_dir = mkdtemp()
+            try:
+                source = os.path.join(tmp_dir, "targeted-ions")
+                destination = os.path.join(tmp_dir, "target-ions.parquet")
+                await download_file(input.targetedIons, source, convex=convex)
+                sample_cols = await _preprocess_in_pool(source, input.tool, destination)
+                storage_id = await upload_file(
+                    destination,
+                    file_name="target-ions.parquet",
+                    mime_type=MIME_TYPE_PARQUET,
+                    convex=convex,
+                )
+            finally:
+                await asyncio.to_thread(shutil.rmtree, tmp_dir, ignore_errors=True)
 
         return PreprocessIonsResponse(
             storageId=storage_id,
@@ -122,5 +259,149 @@ async def preprocess_ions(
         logger.log(logging.ERROR, e)
         raise HTTPException(status_code=400, detail=str(e))
     finally:
-        convex.action("actions:removeFile", {"storageId": input.targetedIons})
-        convex.action("actions:removeFile", {"storageId": input.targetedIons})
+        await convex.action("actions:removeFile", {"storageId": input.targetedIons})
+
+
+@web.get("/analysis/preprocessIons/queue")
+async def preprocess_queue() -> dict[str, float]:
+    """Depth of the preprocessing line and how long requests waited in it."""
+    return preprocess_limiter.metrics()
+
+
+def _read_result_csv(path: str) -> pd.DataFrame:
+    return pacsv.read_csv(path).to_pandas()
+
+
+async def _load_result_index(
+    nodes_id: str, edges_id: str, convex: AsyncConvexClient
+) -> ResultIndex:
+    tmp_dir = mkdtemp()
+    try:
+        paths = [os.path.join(tmp_dir, name) for name in ("nodes.csv", "edges.csv")]
+        await asyncio.gather(
+            *(
+                download_file(storage_id, path, convex=convex)
+                for storage_id, path in zip((nodes_id, edges_id), paths)
+            )
+        )
+        nodes, edges = await asyncio.gather(
+            *(asyncio.to_thread(_read_result_csv, path) for path in paths)
+        )
+    finally:
+        await asyncio.to_thread(shutil.rmtree, tmp_dir, ignore_errors=True)
+    return await asyncio.to_thread(ResultIndex, nodes, edges)
+
+
+async def _result_index(result: dict, convex: AsyncConvexClient) -> ResultIndex:
+    key = (result["nodes"], result["edges"])
+    task = _result_indexes.pop(key, None)
+    if task is None or (task.done() and (task.cancelled() or task.exception())):
+        task = asyncio.create_task(_load_result_index(*key, convex))
+    _result_indexes[key] = task
+    while len(_result_indexes) > RESULT_INDEX_CACHE_SIZE:
+        _result_indexes.popitem(last=False)
+    return await task
+
+
+def _records(df: pd.DataFrame) -> list[dict]:
+    df = df.astype(object).where(pd.notna(df), None)
+    records = df.to_dict(orient="records")
+    for record in records:
+        # spectra are stored as JSON text, only the returned ones are decoded
+        spectrum = record.get(TargetIonsColumn.MSMS_SPECTRUM)
+        if isinstance(spectrum, str):
+            record[TargetIonsColumn.MSMS_SPECTRUM] = json.loads(spectrum)
+    return records
+
+
+@web.post("/analysis/subgraph")
+async def subgraph(
+    input: SubgraphQueryInput, token: HTTPAuthorizationCredentials = Depends(security)
+) -> dict:
+    """
+    Query a page of the network of an analysis result.
+
+    The result is loaded and indexed on the first query and kept in memory,
+    later queries filter it in milliseconds. Components are returned whole,
+    largest first, `offset` and `limit` count components.
+
+    Raises:
+        HTTPException: If the analysis has no result or the query is invalid
+    """
+    convex = AsyncConvexClient(get_convex(token.credentials))
+    try:
+        # also checks that the analysis belongs to the caller
+        analysis = await convex.query("analyses:get", {"id": input.id})
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if not analysis.get("result"):
+        raise HTTPException(status_code=404, detail="Analysis has no result")
+
+    index = await _result_index(analysis["result"], convex)
+    try:
+        result = index.query(
+            mz_range=(input.mzMin, input.mzMax),
+            rt_range=(input.rtMin, input.rtMax),
+            reactions=input.reactions,
+            ratio_column=input.ratioColumn,
+            ratio_range=(input.ratioMin, input.ratioMax),
+            prototype_only=input.prototypeOnly,
+            include_isolated=input.includeIsolated,
+            offset=input.offset,
+            limit=input.limit,
+        )
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "nodes": _records(result.nodes),
+        "edges": _records(result.edges),
+        "offset": input.offset,
+        "limit": input.limit,
+        "totalComponents": result.total_components,
+        "totalNodes": result.total_nodes,
+        "totalEdges": result.total_edges,
+    }
+
+
+async def _progress_events(id: str, analysis: dict, convex: AsyncConvexClient):
+    last, quiet = None, 0.0
+    while True:
+        if analysis != last:
+            yield f"data: {json.dumps(analysis)}\n\n"
+            last, quiet = analysis, 0.0
+        elif quiet >= PROGRESS_KEEPALIVE_SECONDS:
+            yield ": keep-alive\n\n"
+            quiet = 0.0
+        if analysis["status"] != AnalysisStatus.RUNNING:
+            return
+        await asyncio.sleep(PROGRESS_POLL_SECONDS)
+        quiet += PROGRESS_POLL_SECONDS
+        analysis = await convex.query("analyses:getProgress", {"id": id})
+
+
+@web.get("/analysis/progress")
+async def progress(
+    id: str, token: HTTPAuthorizationCredentials = Depends(security)
+) -> StreamingResponse:
+    """
+    Stream the progress of an analysis as server-sent events.
+
+    Every event holds the status of the analysis and the progress of its
+    steps, including the counters of the running ones (pairs scored, bytes
+    downloaded, edges emitted). An event is sent whenever they change, the
+    stream ends once the analysis completed or failed.
+
+    Raises:
+        HTTPException: If the analysis does not exist or belongs to someone else
+    """
+    convex = AsyncConvexClient(get_convex(token.credentials))
+    try:
+        analysis = await convex.query("analyses:getProgress", {"id": id})
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return StreamingResponse(
+        _progress_events(id, analysis, convex),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
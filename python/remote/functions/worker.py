@@ -1,19 +1,102 @@
+import os
+from typing import Any, Callable
+
 import modal
-from core.analysis import AnalysisWorker
-from core.models.analysis import AnalysisResult, AnalysisStatus, AnalysisTriggerInput
+from core.analysis import SHARED_NAMESPACE, AnalysisWorker
+from core.artifacts import (
+    CONTENT_NAMESPACE,
+    ArtifactStore,
+    LocalArtifactStore,
+    RedisArtifactStore,
+    TieredArtifactStore,
+)
+from core.batch import BatchAnalysisWorker
+from core.distributed import ModalMapExecutor
+from core.models.analysis import (
+    AnalysisBatchTriggerInput,
+    AnalysisResult,
+    AnalysisStatus,
+    AnalysisTriggerInput,
+)
 from core.utils.convex import ConvexClient, get_convex
+from core.utils.memory import MemoryBudget
 from core.utils.rprint import rlog as log
+from core.warmup import warm_up
 from remote.image import image
 
 app = modal.App("analysis-worker")
 
 TIMEOUT_MINUTES = 60
 
+# step checkpoints outlive the container so that a retry can resume from them
+CHECKPOINT_DIR = "/checkpoints"
+checkpoints = modal.Volume.from_name("analysis-checkpoints", create_if_missing=True)
+
+# checkpoints unused for this long, or beyond this size, are removed
+CHECKPOINT_TTL_SECONDS = int(os.environ.get("CHECKPOINT_TTL_SECONDS", 7 * 24 * 3600))
+CHECKPOINT_MAX_BYTES = int(os.environ.get("CHECKPOINT_MAX_MB", 50_000)) * 2**20
+# parsed inputs and shared step outputs stay in Redis for this long, steps
+# larger than CACHE_MAX_MB are left to the volume
+CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", 24 * 3600))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_MB", 256)) * 2**20
+
+# per-step timings and sizes of every run, to see which step dominates in production
+METRICS_DIR = "/metrics"
+metrics = modal.Volume.from_name("analysis-metrics", create_if_missing=True)
+
+# MEMORY_BUDGET_MB bounds the intermediates of an analysis, so that the largest
+# alignments spill to disk rather than run out of memory
+memory_budget = MemoryBudget.from_env()
+
+
+def _artifact_store() -> ArtifactStore:
+    """
+    Checkpoints and parsed inputs on the volume. With REDIS_URL, what other
+    analyses can reuse is also shared with the containers running
+    concurrently, which only see the volume as of their start.
+    """
+    local = LocalArtifactStore(
+        CHECKPOINT_DIR, ttl=CHECKPOINT_TTL_SECONDS, max_bytes=CHECKPOINT_MAX_BYTES
+    )
+    if not os.environ.get("REDIS_URL"):
+        return local
+    shared = RedisArtifactStore.from_url(
+        os.environ["REDIS_URL"], ttl=CACHE_TTL_SECONDS, max_bytes=CACHE_MAX_BYTES
+    )
+    return TieredArtifactStore(
+        local, shared, namespaces={SHARED_NAMESPACE, CONTENT_NAMESPACE}
+    )
+
+
+# containers the similarity of the largest analyses is spread over
+FANOUT_CONTAINERS = int(os.environ.get("FANOUT_CONTAINERS", 16))
+
+# the reaction tables and numba kernels are loaded when the container starts,
+# and restored from its memory snapshot after that, not by the first analysis
+if not modal.is_local():
+    warm_up()
+
+
+@app.function(
+    image=image,
+    timeout=60 * TIMEOUT_MINUTES,
+    concurrency_limit=FANOUT_CONTAINERS,
+    enable_memory_snapshot=True,
+)
+def run_block(fn: Callable[[Any], Any], item: Any) -> Any:
+    """One block of the work an analysis fans out, see `ModalMapExecutor`."""
+    return fn(item)
+
+
+fanout = ModalMapExecutor(run_block, FANOUT_CONTAINERS)
+
 
 @app.function(
     image=image,
     secrets=[modal.Secret.from_name("yaolab")],
     timeout=60 * TIMEOUT_MINUTES,
+    volumes={CHECKPOINT_DIR: checkpoints, METRICS_DIR: metrics},
+    enable_memory_snapshot=True,
 )
 async def run_analysis_workflow(
     input: AnalysisTriggerInput, convex_token: str
@@ -38,10 +121,17 @@ async def run_analysis_workflow(
         AnalysisResult containing nodes and edges
     """
     convex: ConvexClient = get_convex(convex_token)
+    checkpoints.reload()
+    store = _artifact_store()
     try:
         worker = AnalysisWorker(
             id=input.id,
             convex=convex,
+            store=store,
+            cache=store,
+            metrics_path=f"{METRICS_DIR}/{input.id}.json",
+            memory_budget=memory_budget,
+            map_executor=fanout,
         )
         await worker.run()
 
@@ -52,3 +142,52 @@ async def run_analysis_workflow(
             {"id": input.id, "step": "start", "status": AnalysisStatus.FAILED},
         )
         raise
+    finally:
+        checkpoints.commit()
+        metrics.commit()
+
+
+@app.function(
+    image=image,
+    secrets=[modal.Secret.from_name("yaolab")],
+    timeout=60 * TIMEOUT_MINUTES,
+    volumes={CHECKPOINT_DIR: checkpoints, METRICS_DIR: metrics},
+    enable_memory_snapshot=True,
+)
+async def run_analysis_batch(
+    input: AnalysisBatchTriggerInput, convex_token: str
+) -> None:
+    """
+    Process several analyses in one container.
+
+    Analyses of the same MGF file share loading the spectra and computing the
+    similarity matrix, everything else runs per analysis.
+
+    Args:
+        input: Ids of the analyses to process
+    """
+    convex: ConvexClient = get_convex(convex_token)
+    checkpoints.reload()
+    store = _artifact_store()
+    try:
+        worker = BatchAnalysisWorker(
+            ids=input.ids,
+            convex=convex,
+            store=store,
+            cache=store,
+            metrics_dir=METRICS_DIR,
+            memory_budget=memory_budget,
+        )
+        errors = await worker.run()
+    finally:
+        checkpoints.commit()
+        metrics.commit()
+
+    for id, e in errors.items():
+        log(f"Analysis workflow {id} failed: {str(e)}")
+        convex.mutation(
+            "analyses:updateStepStatus",
+            {"id": id, "step": "start", "status": AnalysisStatus.FAILED},
+        )
+    if errors:
+        raise next(iter(errors.values()))
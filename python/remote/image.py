@@ -13,5 +13,8 @@ image = (
     .copy_local_dir(local_dir, PROJECT_DIR)
     .run_commands(
         "uv pip install --system --compile-bytecode -r pyproject.toml",
+        # compiled reaction tables and the numba cache ship with the image,
+        # containers start without parsing CSVs or compiling kernels
+        "python -m core.warmup --compile-assets",
     )
 )